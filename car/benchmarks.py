@@ -0,0 +1,395 @@
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from car.datastore import Catalog
+from car.tub import Tub
+
+
+def _percentile(sorted_values, percentile):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100.0))
+    return sorted_values[index]
+
+
+def bench_catalog_writes(records=100000, window=10000):
+    """
+    Writes records into a new catalog and reports the write latency for every
+    window of records. Latency should stay flat as the catalog grows.
+    """
+    record = {
+        'cam/image_array': '0_cam_image_array_.jpg',
+        'user/angle': 0.25,
+        'user/throttle': 0.5,
+        'user/mode': 'user',
+        '_timestamp_ms': 0,
+        '_index': 0,
+    }
+    latencies = list()
+    with tempfile.TemporaryDirectory() as path:
+        catalog = Catalog(os.path.join(path, 'catalog_0.catalog'))
+        for index in range(records):
+            record['_index'] = index
+            start = time.perf_counter()
+            catalog.write_record(record)
+            latencies.append(time.perf_counter() - start)
+        catalog.close()
+
+    print('Catalog write latency (times in us)')
+    for start in range(0, records, window):
+        values = sorted(latencies[start:start + window])
+        print('records %7d - %7d  p50 %8.1f  p99 %8.1f  max %8.1f' % (
+            start + 1, start + len(values), _percentile(values, 50) * 1e6,
+            _percentile(values, 99) * 1e6, values[-1] * 1e6))
+
+
+def bench_line_index(lines=1000000):
+    """
+    Opens a catalog sized file with a `Seekable`, and reports the memory used by
+    its line index, next to the list based index it replaced.
+    """
+    import tracemalloc
+
+    from car.datastore import Seekable
+
+    line = b'{"_index": 0, "_timestamp_ms": 0, "cam/image_array": "0_cam_image_array_.jpg", "user/angle": 0.25}\n'
+    with tempfile.TemporaryDirectory() as path:
+        file_path = os.path.join(path, 'catalog_0.catalog')
+        with open(file_path, 'wb') as catalog_file:
+            catalog_file.write(line * lines)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        seekable = Seekable(file_path, read_only=True)
+        elapsed = time.perf_counter() - start
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        line_lengths = [len(line)] * lines
+        cumulative_lengths = list(range(len(line), len(line) * (lines + 1), len(line)))
+        list_size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del line_lengths, cumulative_lengths
+
+        seekable.seek_line_start(lines)
+        assert len(seekable.read_line()) == len(line) - 1
+        seekable.close()
+
+    print('Line index for %d lines, opened in %.1f ms' % (lines, elapsed * 1e3))
+    print('array index  %8.1f MB  %5.1f bytes/line' % (size / 1e6, size / lines))
+    print('list index   %8.1f MB  %5.1f bytes/line' % (list_size / 1e6, list_size / lines))
+
+
+def _synthetic_frames(count, shape=(128, 160, 3), seed=0):
+    # A smooth gradient with some noise, closer to camera frames than pure noise
+    random = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, shape[1] * shape[0]).reshape(shape[0], shape[1], 1)
+    frames = list()
+    for _ in range(count):
+        noise = random.normal(0, 12, shape)
+        frames.append(np.clip(gradient + noise, 0, 255).astype(np.uint8))
+    return frames
+
+
+def _directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def bench_image_encoding(records=500, workers=(0, 2, 4)):
+    """
+    Writes records with a camera frame into a tub, for several image formats and
+    encoder pool sizes, and reports throughput and disk usage per record.
+    """
+    frames = _synthetic_frames(32)
+    settings = [
+        ('jpg', dict()),
+        ('jpg', {'quality': 95, 'subsampling': 0}),
+        ('png', dict()),
+        ('npy', dict()),
+    ]
+    print('Image encoding throughput')
+    for image_format, image_options in settings:
+        for worker_count in workers:
+            with tempfile.TemporaryDirectory() as path:
+                tub = Tub(path, inputs=['cam/image_array', 'user/angle'], types=['image_array', 'float'],
+                          image_format=image_format, image_options=image_options, image_workers=worker_count)
+                start = time.perf_counter()
+                for index in range(records):
+                    tub.write_record({'cam/image_array': frames[index % len(frames)], 'user/angle': 0.0})
+                tub.flush()
+                elapsed = time.perf_counter() - start
+                tub.close()
+                size = _directory_size(os.path.join(path, Tub.images()))
+            print('%-4s %-32s workers %d  %8.1f records/s  %8.1f KB/record' % (
+                image_format, image_options, worker_count, records / elapsed, size / records / 1024.0))
+
+
+def bench_loader(tubs=4, records=500, workers=(0, 1, 2, 4), batch_size=64):
+    """
+    Streams shuffled batches from several tubs of jpg frames, and reports
+    throughput for several worker process counts.
+    """
+    from car.loader import TubLoader
+
+    frames = _synthetic_frames(32)
+    print('Tub loader throughput')
+    with tempfile.TemporaryDirectory() as path:
+        tub_paths = list()
+        for tub_number in range(tubs):
+            tub_path = os.path.join(path, 'tub_%d' % tub_number)
+            tub = Tub(tub_path, inputs=['cam/image_array', 'user/angle'], types=['image_array', 'float'])
+            for index in range(records):
+                tub.write_record({'cam/image_array': frames[index % len(frames)], 'user/angle': 0.0})
+            tub.close()
+            tub_paths.append(tub_path)
+
+        for worker_count in workers:
+            loader = TubLoader(tub_paths, batch_size=batch_size, workers=worker_count)
+            count = 0
+            start = time.perf_counter()
+            for batch in loader:
+                count += len(batch['user/angle'])
+            elapsed = time.perf_counter() - start
+            print('workers %d  %8.1f records/s' % (worker_count, count / elapsed))
+
+
+def bench_merge(records=1000000, tubs=10):
+    """
+    Merges tubs holding `records` records in total, and reports throughput of the
+    catalog level merge next to a record by record copy.
+    """
+    from car.tub import merge_tubs
+
+    record = {
+        'cam/image_array': '0_cam_image_array_.jpg',
+        'user/angle': 0.25,
+        'user/throttle': 0.5,
+        'user/mode': 'user',
+    }
+    with tempfile.TemporaryDirectory() as path:
+        tub_paths = list()
+        for tub_number in range(tubs):
+            tub_path = os.path.join(path, 'tub_%d' % tub_number)
+            tub = Tub(tub_path, inputs=list(record), types=['image_array', 'float', 'float', 'str'],
+                      max_catalog_len=10000)
+            # Records are written straight to the manifest, images are not part of the benchmark
+            for _ in range(records // tubs):
+                tub.manifest.write_record(record)
+            tub.close()
+            tub_paths.append(tub_path)
+
+        start = time.perf_counter()
+        merged = merge_tubs(tub_paths, os.path.join(path, 'merged'))
+        elapsed = time.perf_counter() - start
+        print('Merged %d records from %d tubs' % (merged, tubs))
+        print('catalog merge    %10.0f records/s  %8.2f s' % (merged / elapsed, elapsed))
+
+        start = time.perf_counter()
+        copy = Tub(os.path.join(path, 'copy'), inputs=list(record), types=['image_array', 'float', 'float', 'str'],
+                   max_catalog_len=10000)
+        for tub_path in tub_paths:
+            tub = Tub(tub_path, read_only=True)
+            for tub_record in tub:
+                copy.manifest.write_record(tub_record)
+            tub.close()
+        copy.close()
+        elapsed = time.perf_counter() - start
+        print('record by record %10.0f records/s  %8.2f s' % (merged / elapsed, elapsed))
+
+
+def bench_compression(records=100000, reads=10000, max_catalog_len=1000):
+    """
+    Writes the same records into a plain and a compressed json datastore, and reports
+    the size of the catalogs and the latency of random record reads.
+    """
+    from car.datastore import Manifest
+
+    record = {
+        'cam/image_array': '0_cam_image_array_.jpg',
+        'user/angle': 0.25,
+        'user/throttle': 0.5,
+        'user/mode': 'user',
+    }
+    random = np.random.default_rng(0)
+    positions = random.integers(0, records, reads)
+    print('Catalog compression, %d records' % records)
+    for compression in (None, 'zlib', 'zstd'):
+        with tempfile.TemporaryDirectory() as path:
+            manifest = Manifest(path, inputs=list(record), types=['image_array', 'float', 'float', 'str'],
+                                max_len=max_catalog_len, compression=compression)
+            for index in range(records):
+                record['user/angle'] = float(random.normal())
+                record['_timestamp_ms'] = 1600000000000 + index * 50
+                manifest.write_record(record)
+            manifest.close()
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+                       if name.endswith('.catalog') or name.endswith('.catalogz'))
+
+            manifest = Manifest(path, read_only=True)
+            latencies = list()
+            for position in positions:
+                start = time.perf_counter()
+                manifest.get_batch([int(position)])
+                latencies.append(time.perf_counter() - start)
+            manifest.close()
+            latencies.sort()
+        print('%-5s %8.1f KB  %5.1f bytes/record  read p50 %6.1f us  p99 %6.1f us' % (
+            compression, size / 1024.0, size / records, _percentile(latencies, 50) * 1e6,
+            _percentile(latencies, 99) * 1e6))
+
+
+class _BusyPart(object):
+    # Spends `duration` seconds per loop, and overruns every `overrun_every` loops
+    def __init__(self, duration, overrun_every=None, overrun=0.0):
+        self.duration = duration
+        self.overrun_every = overrun_every
+        self.overrun = overrun
+        self.loops = 0
+
+    def run(self):
+        self.loops += 1
+        duration = self.duration
+        if self.overrun_every and self.loops % self.overrun_every == 0:
+            duration += self.overrun
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            pass
+
+
+def bench_drive_loop(rate_hz=100, seconds=3, max_p99_us=None):
+    """
+    Runs a synthetic vehicle at `rate_hz` with each overrun policy, with and without
+    spinning, and reports how late loops start. With `max_p99_us`, fails when the
+    p99 lateness of a run without overruns is above it.
+    """
+    from car.vehicle import Vehicle
+
+    print('Drive loop at %d Hz (times in us)' % rate_hz)
+    runs = [('skip', 0, None), ('skip', 1, None), ('skip', 0, 4), ('catch_up', 0, 4), ('degrade', 0, 4)]
+    for overrun_policy, spin_ms, overrun_periods in runs:
+        vehicle = Vehicle()
+        overrun = overrun_periods / float(rate_hz) if overrun_periods else 0.0
+        vehicle.add(_BusyPart(0.2 / rate_hz, overrun_every=50 if overrun else None, overrun=overrun))
+        vehicle.start(rate_hz=rate_hz, max_loop_count=rate_hz * seconds,
+                      overrun_policy=overrun_policy, spin_ms=spin_ms)
+        stats = vehicle.scheduler.stats()
+        print('%-8s spin %d ms  overruns %-3s  %6.1f Hz  p50 %7.1f  p90 %7.1f  p99 %7.1f  max %8.1f  '
+              'overruns %3d  skipped %3d' % (overrun_policy, spin_ms, 'yes' if overrun else 'no',
+                                              stats['rate_hz'], stats['jitter_p50_us'], stats['jitter_p90_us'],
+                                              stats['jitter_p99_us'], stats['jitter_max_us'],
+                                              stats['overruns'], stats['skipped']))
+        if max_p99_us is not None and not overrun:
+            assert stats['jitter_p99_us'] <= max_p99_us, 'p99 lateness %.1f us' % stats['jitter_p99_us']
+
+
+class _NoopPart(object):
+    def run(self, value):
+        return value
+
+
+def bench_profiler(parts=10, loops=1000, rounds=100):
+    """
+    Runs the parts of a vehicle with and without the part profiler, and reports the
+    overhead of profiling per part and per loop. Runs of `loops` loops alternate for
+    `rounds` rounds, and the medians are reported to leave out the noise of other processes.
+    """
+    from car.vehicle import Vehicle
+
+    vehicles = dict()
+    for profile in (False, True):
+        vehicle = Vehicle(profile=profile)
+        for number in range(parts):
+            vehicle.add(_NoopPart(), inputs=['value/%d' % number], outputs=['value/%d' % (number + 1)])
+        vehicle.mem.put(['value/0'], 0)
+        vehicles[profile] = vehicle
+    elapsed = {False: list(), True: list()}
+    for _ in range(rounds):
+        for profile, vehicle in vehicles.items():
+            start = time.perf_counter()
+            for _ in range(loops):
+                vehicle.update_parts()
+            elapsed[profile].append((time.perf_counter() - start) / loops)
+    snapshot = vehicles[True].profiler.snapshot()
+    overhead = np.median(np.subtract(elapsed[True], elapsed[False])) / parts
+    print('Part profiler, %d parts' % parts)
+    print('loop without profiler %8.1f us' % (np.median(elapsed[False]) * 1e6))
+    print('loop with profiler    %8.1f us' % (np.median(elapsed[True]) * 1e6))
+    print('overhead per part     %8.3f us' % (overhead * 1e6))
+    print('part p50 of a part    %8.3f us' % snapshot['parts']['_NoopPart']['part']['p50_us'])
+    print('run p50 of a part     %8.3f us' % snapshot['parts']['_NoopPart']['run']['p50_us'])
+
+
+class _SleepPart(object):
+    # Waits for I/O, e.g. an actuator or a network client
+    def __init__(self, duration):
+        self.duration = duration
+
+    def run(self, *inputs):
+        time.sleep(self.duration)
+        return 0.0
+
+
+class _NumpyPart(object):
+    # NumPy releases the GIL while it multiplies matrices
+    def __init__(self, size=200):
+        self.matrix = np.random.default_rng(0).random((size, size))
+
+    def run(self, *inputs):
+        return float(np.dot(self.matrix, self.matrix)[0, 0])
+
+
+def bench_parallel_parts(loops=100, workers=(0, 2, 4)):
+    """
+    Runs a vehicle with independent sleep bound and GIL releasing parts, and a chain
+    of dependent parts, and reports the loop time for several worker thread counts.
+    """
+    from car.vehicle import Vehicle, part_stages
+
+    def build(worker_count):
+        vehicle = Vehicle(workers=worker_count)
+        vehicle.add(_SleepPart(0.002), inputs=['cam/image_array'], outputs=['tub/num_records'])
+        vehicle.add(_SleepPart(0.002), inputs=['user/angle'], outputs=['steering/pwm'])
+        vehicle.add(_SleepPart(0.002), inputs=['user/throttle'], outputs=['throttle/pwm'])
+        vehicle.add(_NumpyPart(), inputs=['cam/image_array'], outputs=['pilot/angle'])
+        vehicle.add(_NumpyPart(), inputs=['cam/image_array'], outputs=['pilot/throttle'])
+        # Depends on both pilot outputs
+        vehicle.add(_SleepPart(0.001), inputs=['pilot/angle', 'pilot/throttle'], outputs=['telemetry'])
+        return vehicle
+
+    stages = part_stages(build(0).parts)
+    print('Parallel parts, %d stages of %s parts' % (len(stages), [len(stage) for stage in stages]))
+    for worker_count in workers:
+        vehicle = build(worker_count)
+        start = time.perf_counter()
+        for _ in range(loops):
+            vehicle.update_parts()
+        elapsed = time.perf_counter() - start
+        vehicle.stop()
+        print('workers %d  loop %8.2f ms' % (worker_count, elapsed / loops * 1e3))
+
+
+BENCHMARKS = {
+    'catalog_writes': bench_catalog_writes,
+    'line_index': bench_line_index,
+    'image_encoding': bench_image_encoding,
+    'loader': bench_loader,
+    'merge': bench_merge,
+    'compression': bench_compression,
+    'drive_loop': bench_drive_loop,
+    'profiler': bench_profiler,
+    'parallel_parts': bench_parallel_parts,
+}
+
+
+if __name__ == '__main__':
+    # python -m car.benchmarks [name ...]
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
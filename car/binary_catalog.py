@@ -0,0 +1,290 @@
+import json
+import os
+import shutil
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from car.catalog_base import CatalogMetadata, GroupCommit, remap_columns, remap_record, unmap_record
+
+# Input types with a fixed width binary representation: (struct code, numpy dtype)
+FIXED_WIDTH_TYPES = {
+    'float': ('f', '<f4'),
+    'int': ('q', '<i8'),
+    'boolean': ('?', '?'),
+    # Strings are dictionary encoded, the dictionary lives in the catalog manifest.
+    'str': ('i', '<i4'),
+}
+
+# Everything else is stored in the heap file, rows keep an (offset, length) reference.
+HEAP_REFERENCE = ('QI', [('offset', '<u8'), ('length', '<u4')])
+JSON_HEAP_TYPES = ('list', 'vector')
+
+# Private properties written by the Tub for every record.
+PRIVATE_FIELDS = [('_index', 'q', '<i8'), ('_timestamp_ms', 'q', '<i8')]
+PRESENT_FIELD = ('_present', 'Q', '<u8')
+MAX_INPUTS = 64
+
+
+class BinaryCatalog(object):
+    """
+    A catalog that stores records as fixed width binary rows. \n
+
+    The row layout is derived from the declared inputs and types, so the
+    catalog can be read back as NumPy arrays (one per input) without any per
+    record parsing. Strings are dictionary encoded, and variable length values
+    (image names, lists) are stored in a heap file next to the catalog.
+    Writes are committed according to `commit_policy`.
+    """
+
+    def __init__(self, path, inputs, types, read_only=False, start_index=0, commit_policy=None):
+        if len(inputs) > MAX_INPUTS:
+            raise ValueError('A binary catalog supports at most %s inputs' % MAX_INPUTS)
+
+        self.path = Path(os.path.expanduser(path))
+        self.heap_path = self.path.with_suffix('.binheap')
+        self.inputs = list(inputs)
+        self.types = list(types)
+        self.read_only = read_only
+        self.manifest = CatalogMetadata(self.path, read_only=read_only, start_index=start_index)
+        self.dictionaries = dict()
+        self.codes = dict()
+        for key, values in self.manifest.contents.get('dictionaries', dict()).items():
+            self.dictionaries[key] = list(values)
+            self.codes[key] = {value: code for code, value in enumerate(values)}
+
+        struct_format = '<'
+        dtype = list()
+        for key, input_type in zip(self.inputs, self.types):
+            if input_type in FIXED_WIDTH_TYPES:
+                code, field_type = FIXED_WIDTH_TYPES[input_type]
+            else:
+                code, field_type = HEAP_REFERENCE
+            struct_format += code
+            dtype.append((key, field_type))
+        for key, code, field_type in PRIVATE_FIELDS + [PRESENT_FIELD]:
+            struct_format += code
+            dtype.append((key, field_type))
+
+        self.row = struct.Struct(struct_format)
+        self.dtype = np.dtype(dtype)
+        assert self.row.size == self.dtype.itemsize
+
+        method = 'rb' if read_only else 'ab+'
+        self.file = open(self.path, method)
+        self.heap = open(self.heap_path, method)
+        size = os.fstat(self.file.fileno()).st_size
+        self.count = size // self.row.size
+        if not read_only and size != self.count * self.row.size:
+            # Drop a torn trailing row
+            self.file.truncate(self.count * self.row.size)
+        self.heap_length = os.fstat(self.heap.fileno()).st_size
+        # The heap is committed before the rows that refer to it
+        self.group_commit = GroupCommit([self.heap, self.file], commit_policy)
+        self.update_descriptor = None
+        self.remap = self.manifest.remap()
+        self.cursor = 0
+
+    def _encode_string(self, key, value):
+        codes = self.codes.setdefault(key, dict())
+        code = codes.get(value)
+        if code is None:
+            dictionary = self.dictionaries.setdefault(key, list())
+            code = len(dictionary)
+            dictionary.append(value)
+            codes[value] = code
+            # Persist the dictionary before any row refers to the new code.
+            self.manifest.update_contents('dictionaries', self.dictionaries)
+        return code
+
+    def _encode_heap(self, input_type, value):
+        if input_type in JSON_HEAP_TYPES:
+            contents = json.dumps(list(value), allow_nan=False).encode('utf-8')
+        else:
+            contents = str(value).encode('utf-8')
+        offset = self.heap_length
+        self.heap.write(contents)
+        self.heap_length += len(contents)
+        return offset, len(contents)
+
+    def write_record(self, record):
+        if self.read_only:
+            raise RuntimeError('Catalog %s is read-only.' % self.path)
+        self.file.write(self._encode(record, self.manifest.start_index() + self.count))
+        self.group_commit.written()
+        self.count += 1
+
+    def update_record(self, line, record):
+        """
+        Overwrites the row in the given (0 based) line, rows have a fixed width so nothing else moves.
+        """
+        if self.read_only:
+            raise RuntimeError('Catalog %s is read-only.' % self.path)
+        if not 0 <= line < self.count:
+            raise IndexError('Line %s out of range' % line)
+        self.group_commit.commit()
+        if self.update_descriptor is None:
+            self._unshare()
+            # The rows file is opened for appending, so it is written through another descriptor.
+            self.update_descriptor = os.open(self.path, os.O_WRONLY)
+        if self.remap is not None:
+            record = unmap_record(record, self.remap)
+        row = self._encode(record, self.manifest.start_index() + line)
+        os.pwrite(self.update_descriptor, row, line * self.row.size)
+        if self.group_commit.policy.durability == 'fsync':
+            os.fsync(self.update_descriptor)
+
+    def _unshare(self):
+        # Files shared with another datastore are copied before they change, see `link_or_copy`
+        for path, name in ((self.path, 'file'), (self.heap_path, 'heap')):
+            if os.fstat(getattr(self, name).fileno()).st_nlink > 1:
+                getattr(self, name).close()
+                copy_path = path.with_suffix(path.suffix + '_copy')
+                shutil.copyfile(path, copy_path)
+                os.replace(copy_path, path)
+                setattr(self, name, open(path, 'ab+'))
+        self.group_commit = GroupCommit([self.heap, self.file], self.group_commit.policy)
+
+    def compact(self):
+        # Rows are updated in place, there is nothing to compact.
+        pass
+
+    def _encode(self, record, index):
+        values = list()
+        present = 0
+        for position, (key, input_type) in enumerate(zip(self.inputs, self.types)):
+            value = record.get(key)
+            if value is not None:
+                present |= 1 << position
+            if input_type == 'str':
+                values.append(self._encode_string(key, value) if value is not None else -1)
+            elif input_type in FIXED_WIDTH_TYPES:
+                values.append(value if value is not None else 0)
+            elif value is not None:
+                values.extend(self._encode_heap(input_type, value))
+            else:
+                values.extend((0, 0))
+
+        values.append(record.get('_index', index))
+        values.append(record.get('_timestamp_ms', 0))
+        values.append(present)
+        return self.row.pack(*values)
+
+    def _decode(self, values):
+        record = dict()
+        present = values[-1]
+        position = 0
+        for bit, (key, input_type) in enumerate(zip(self.inputs, self.types)):
+            if input_type in FIXED_WIDTH_TYPES:
+                value = values[position]
+                position += 1
+            else:
+                value = values[position:position + 2]
+                position += 2
+            if not present & (1 << bit):
+                continue
+            if input_type == 'str':
+                record[key] = self.dictionaries[key][value]
+            elif input_type in FIXED_WIDTH_TYPES:
+                record[key] = value
+            else:
+                record[key] = self._read_heap(input_type, *value)
+        record['_index'] = values[position]
+        record['_timestamp_ms'] = values[position + 1]
+        if self.remap is not None:
+            record = remap_record(record, self.remap)
+        return record
+
+    def _make_readable(self):
+        # Reads go through the file descriptor, so buffered rows must reach the OS first.
+        if not self.read_only and self.group_commit.pending > 0:
+            self.group_commit.commit()
+
+    def _read_heap(self, input_type, offset, length):
+        contents = os.pread(self.heap.fileno(), length, offset).decode('utf-8')
+        if input_type in JSON_HEAP_TYPES:
+            return json.loads(contents)
+        return contents
+
+    def read_record_at(self, line):
+        """
+        Returns the record stored in the given (0 based) row.
+        """
+        if line >= self.count:
+            return None
+        self._make_readable()
+        contents = os.pread(self.file.fileno(), self.row.size, line * self.row.size)
+        if len(contents) < self.row.size:
+            return None
+        return self._decode(self.row.unpack(contents))
+
+    def seek_record(self, line):
+        self.cursor = line
+
+    def read_record(self):
+        record = self.read_record_at(self.cursor)
+        if record is not None:
+            self.cursor += 1
+        return record
+
+    def lines(self):
+        return self.count
+
+    def rows(self):
+        """
+        Returns all rows as a NumPy structured array, without parsing them.
+        Unlike `columns()`, the rows of a merged catalog are not remapped.
+        """
+        if self.count == 0:
+            return np.zeros(0, dtype=self.dtype)
+        self._make_readable()
+        return np.memmap(self.path, dtype=self.dtype, mode='r', shape=(self.count,))
+
+    def columns(self, keys=None):
+        """
+        Returns a dictionary of NumPy arrays, one per key. \n
+        Dictionary encoded strings are decoded, missing values are `None` (`NaN` for floats).
+        `_valid` is True for every row, it is there for compatibility with `Catalog.columns`.
+        """
+        rows = self.rows()
+        keys = keys if keys is not None else self.inputs + [key for key, _, _ in PRIVATE_FIELDS]
+        input_types = dict(zip(self.inputs, self.types))
+        columns = dict()
+        for key in keys:
+            input_type = input_types.get(key)
+            column = rows[key]
+            if input_type is None:
+                columns[key] = np.array(column)
+                continue
+            present = (rows[PRESENT_FIELD[0]] >> np.uint64(self.inputs.index(key))) & np.uint64(1)
+            present = present.astype(bool)
+            if input_type == 'str':
+                dictionary = np.array(self.dictionaries.get(key, list()) + [None], dtype=object)
+                columns[key] = dictionary[np.where(present, column, -1)]
+            elif input_type == 'float':
+                columns[key] = np.where(present, column, np.nan)
+            elif input_type in FIXED_WIDTH_TYPES:
+                columns[key] = np.array(column)
+            else:
+                values = np.empty(len(rows), dtype=object)
+                for line in np.flatnonzero(present):
+                    values[line] = self._read_heap(input_type, int(column['offset'][line]),
+                                                   int(column['length'][line]))
+                columns[key] = values
+        columns['_valid'] = np.ones(len(rows), dtype=bool)
+        if self.remap is not None:
+            remap_columns(columns, self.remap)
+        return columns
+
+    def commit(self):
+        if not self.read_only:
+            self.group_commit.commit()
+
+    def close(self):
+        self.commit()
+        if self.update_descriptor is not None:
+            os.close(self.update_descriptor)
+        self.manifest.close()
+        self.file.close()
+        self.heap.close()
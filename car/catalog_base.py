@@ -0,0 +1,460 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+NEWLINE = '\n'
+NEWLINE_STRIP = '\r\n'
+NEWLINE_BYTE = ord(NEWLINE)
+
+
+class CommitPolicy(object):
+    """
+    Decides when writes buffered by a datastore file are committed. \n
+
+    `durability` is one of:
+    `none`: never flush explicitly, data reaches the disk when buffers fill up or the file is closed.
+    `flush`: flush to the OS once per batch.
+    `fsync`: flush and fsync once per batch.
+
+    A batch is committed after `batch_size` writes, or when a write happens more than
+    `batch_interval_ms` after the first uncommitted write. The defaults commit every write.
+    When writes stop, the last batch is only committed by a call to `commit()` (`TubWriter`
+    does it every `batch_interval_ms`) or on close.
+    """
+
+    DURABILITY = ('none', 'flush', 'fsync')
+
+    def __init__(self, durability='flush', batch_size=1, batch_interval_ms=None):
+        if durability not in CommitPolicy.DURABILITY:
+            raise ValueError('Unknown durability %s' % durability)
+        assert batch_size > 0, 'batch_size must be > 0: %r' % batch_size
+        self.durability = durability
+        self.batch_size = batch_size
+        self.batch_interval_ms = batch_interval_ms
+
+    def is_due(self, pending, pending_since):
+        if self.durability == 'none':
+            return False
+        if pending >= self.batch_size:
+            return True
+        return self.batch_interval_ms is not None and \
+            (time.monotonic() - pending_since) * 1000 >= self.batch_interval_ms
+
+    def commit(self, file):
+        file.flush()
+        if self.durability == 'fsync':
+            os.fsync(file.fileno())
+
+
+class GroupCommit(object):
+    """
+    Tracks the writes made to a list of files since their last commit. \n
+    Files are committed in order, so a file can be listed after the files it refers to.
+    """
+
+    def __init__(self, files, policy=None):
+        self.files = files
+        self.policy = policy if policy is not None else CommitPolicy()
+        self.pending = 0
+        self.pending_since = 0
+
+    def written(self):
+        if self.pending == 0:
+            self.pending_since = time.monotonic()
+        self.pending += 1
+        if self.policy.is_due(self.pending, self.pending_since):
+            self.commit()
+
+    def commit(self):
+        if self.pending > 0:
+            for file in self.files:
+                self.policy.commit(file)
+            self.pending = 0
+
+
+class Seekable(object):
+    """
+    A seekable file reader, writer which deals with newline delimited records. \n
+    This reader maintains an index of cumulative line offsets, stored as a compact `array('Q')`,
+    so seeking a line is a O(1) operation. Line lengths are derived from the offsets.
+
+    Writes are committed according to `commit_policy`. When opened for writing, a torn
+    line at the end of the file (e.g. after a crash) is truncated, and `line_offsets`
+    that do not match the file are rebuilt from its contents.
+    """
+
+    def __init__(self, file, read_only=False, line_offsets=None, commit_policy=None):
+        self.offsets = array('Q')
+        self.method = 'r' if read_only else 'a+'
+        self.file = open(file, self.method, newline=NEWLINE)
+        if self.method == 'r' and os.fstat(self.file.fileno()).st_size > 0:
+            # If file is read only improve performance by memory mapping the file.
+            self.file = mmap.mmap(self.file.fileno(), length=0, access=mmap.ACCESS_READ)
+        else:
+            self.group_commit = GroupCommit([self.file], commit_policy)
+        if self.method != 'r':
+            self._truncate_torn_line()
+        self.total_length = 0
+        if line_offsets is not None and len(line_offsets) > 0 and line_offsets[-1] != self._file_size():
+            # The index does not describe the file (e.g. a crash between writes), rebuild it.
+            print('Rebuilding line index for %s' % file)
+            line_offsets = None
+        if line_offsets is None or len(line_offsets) <= 0:
+            self._read_contents()
+        else:
+            self.offsets.extend(line_offsets)
+            self.total_length = self.offsets[-1]
+
+    def _file_size(self):
+        if isinstance(self.file, mmap.mmap):
+            return self.file.size()
+        return os.fstat(self.file.fileno()).st_size
+
+    def _truncate_torn_line(self):
+        size = self._file_size()
+        descriptor = self.file.fileno()
+        if size == 0 or os.pread(descriptor, 1, size - 1) == NEWLINE.encode():
+            return
+        valid_size = 0
+        end = size
+        while end > 0:
+            start = max(0, end - mmap.PAGESIZE)
+            position = os.pread(descriptor, end - start, start).rfind(NEWLINE.encode())
+            if position >= 0:
+                valid_size = start + position + 1
+                break
+            end = start
+        print('Truncating a torn line at the end of %s' % self.file.name)
+        self.file.truncate(valid_size)
+        self.file.seek(valid_size)
+
+    def _read_contents(self):
+        self.offsets = array('Q')
+        self.total_length = 0
+        size = self._file_size()
+        if size > 0:
+            if isinstance(self.file, mmap.mmap):
+                offsets = _line_offsets(self.file, size)
+            else:
+                self.file.flush()
+                with mmap.mmap(self.file.fileno(), length=size, access=mmap.ACCESS_READ) as contents:
+                    offsets = _line_offsets(contents, size)
+            self.offsets.frombytes(offsets.astype(np.uint64).tobytes())
+            self.total_length = size
+        self.seek_end_of_file()
+
+    def __enter__(self):
+        return self
+
+    def write_line(self, contents):
+        if self.method == 'r':
+            raise RuntimeError(f'Seekable {self.file} is read-only.')
+
+        has_newline = contents[-1] == NEWLINE
+        if has_newline:
+            line = contents
+        else:
+            line = f'{contents}{NEWLINE}'
+
+        offset = len(line)
+        self.total_length += offset
+        self.offsets.append(self.total_length)
+        self.file.write(line)
+        self.group_commit.written()
+        return offset
+
+    def commit(self):
+        if self.method != 'r':
+            self.group_commit.commit()
+
+    def _line_start_offset(self, line_number):
+        return self._offset_until(line_number - 1)
+
+    def _line_end_offset(self, line_number):
+        return self._offset_until(line_number)
+
+    def _offset_until(self, line_index):
+        end_index = line_index - 1
+        return self.offsets[end_index] if 0 <= end_index < len(self.offsets) else 0
+
+    def line_length(self, line_number):
+        return self._line_end_offset(line_number) - self._line_start_offset(line_number)
+
+    def read_line(self):
+        contents = self.file.readline()
+        # When Seekable is a memory mapped file, read_line() returns a `bytes`
+        if isinstance(contents, bytes):
+            contents = contents.decode(encoding='utf-8')
+        return contents.rstrip(NEWLINE_STRIP)
+
+    def seek_line_start(self, line_number):
+        self.file.seek(self._line_start_offset(line_number))
+
+    def seek_end_of_file(self):
+        self.file.seek(self.total_length)
+
+    def truncate_until_end(self, line_number):
+        del self.offsets[max(line_number, 0):]
+        self.total_length = self.offsets[-1] if len(self.offsets) > 0 else 0
+        self.seek_end_of_file()
+        self.file.truncate()
+
+    def read_all(self):
+        """
+        Returns the indexed contents of the file as a single string.
+        """
+        if isinstance(self.file, mmap.mmap):
+            contents = self.file[:self.total_length]
+        else:
+            self.commit()
+            contents = os.pread(self.file.fileno(), self.total_length, 0)
+        return contents.decode(encoding='utf-8')
+
+    def lines(self):
+        return len(self.offsets)
+
+    def has_content(self):
+        return self.lines() > 0
+
+    def close(self):
+        self.commit()
+        self.file.close()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def _line_offsets(contents, size, block_size=1 << 24):
+    """
+    Returns the cumulative line offsets of a buffer, scanning it for newlines in blocks.
+    A last line without a newline ends at `size`.
+    """
+    offsets = list()
+    for start in range(0, size, block_size):
+        block = np.frombuffer(contents, dtype=np.uint8, count=min(block_size, size - start), offset=start)
+        offsets.append(np.flatnonzero(block == NEWLINE_BYTE) + (start + 1))
+        del block
+    offsets = np.concatenate(offsets)
+    if len(offsets) == 0 or offsets[-1] != size:
+        offsets = np.append(offsets, size)
+    return offsets.astype(np.int64)
+
+
+class CatalogMetadata(object):
+    """
+    Manifest for a Catalog. \n
+
+    A small json header, and an append-only `.catalog_offsets` sidecar holding the
+    cumulative line offsets of the catalog as little endian uint64 values, so adding
+    a line only appends 8 bytes. The header is checkpointed every `checkpoint_interval`
+    lines and when the catalog is closed.
+    """
+
+    def __init__(self, catalog_path, read_only=False, start_index=0, checkpoint_interval=1000,
+                 commit_policy=None):
+        path = Path(catalog_path)
+        self.catalog_path = path
+        manifest_name = '%s.catalog_manifest' % path.stem
+        self.manifest_path = Path(os.path.join(path.parent.as_posix(), manifest_name))
+        self.offsets_path = Path(os.path.join(path.parent.as_posix(), '%s.catalog_offsets' % path.stem))
+        self.read_only = read_only
+        self.checkpoint_interval = checkpoint_interval
+        self.commit_policy = commit_policy
+        self.group_commit = None
+        self.seekable = Seekable(self.manifest_path, read_only=read_only)
+        has_contents = False
+        if os.path.exists(self.manifest_path) and self.seekable.has_content():
+            self.seekable.seek_line_start(1)
+            contents = self.seekable.read_line()
+            if contents:
+                self.contents = json.loads(contents)
+                has_contents = True
+
+        if not has_contents:
+            # New catalog metadata entry
+            self.contents = dict()
+            self.contents['path'] = self.manifest_path.name
+            created_at = time.time()
+            self.contents['created_at'] = created_at
+            self.contents['start_index'] = start_index
+            self._update()
+
+        self.offsets = array('Q')
+        self.offsets_file = None
+        offsets_length = 0
+        if os.path.exists(self.offsets_path):
+            with open(self.offsets_path, 'rb') as offsets_file:
+                contents = offsets_file.read()
+            offsets_length = len(contents)
+            entries = offsets_length // self.offsets.itemsize
+            self.offsets.frombytes(contents[:entries * self.offsets.itemsize])
+        elif self.contents.get('line_lengths'):
+            # Catalogs written before the offsets sidecar existed
+            total_length = 0
+            for line_length in self.contents['line_lengths']:
+                total_length += line_length
+                self.offsets.append(total_length)
+
+        if not read_only:
+            if offsets_length != len(self.offsets) * self.offsets.itemsize:
+                # Migrates legacy catalogs, and drops a torn trailing entry
+                self._write_offsets()
+            if 'line_lengths' in self.contents:
+                self.checkpoint()
+
+    def _offsets_writer(self):
+        if self.offsets_file is None:
+            self.offsets_file = open(self.offsets_path, 'ab')
+            self.group_commit = GroupCommit([self.offsets_file], self.commit_policy)
+        return self.offsets_file
+
+    def _write_offsets(self):
+        # Rewrites the whole sidecar, only used when the index is rebuilt.
+        offsets_file = self._offsets_writer()
+        offsets_file.truncate(0)
+        offsets_file.write(self.offsets.tobytes())
+        offsets_file.flush()
+
+    def append_line_length(self, line_length):
+        self.offsets.append(self.total_length() + line_length)
+        offsets_file = self._offsets_writer()
+        offsets_file.write(struct.pack('<Q', self.offsets[-1]))
+        self.group_commit.written()
+        if len(self.offsets) % self.checkpoint_interval == 0:
+            self.checkpoint()
+
+    def update_offsets(self, offsets):
+        self.offsets = array('Q', offsets)
+        self._write_offsets()
+        self.checkpoint()
+
+    def checkpoint(self):
+        self.contents.pop('line_lengths', None)
+        self.contents['lines'] = len(self.offsets)
+        self.contents['length'] = self.total_length()
+        self.contents['mtime_ns'] = self._catalog_mtime()
+        self._update()
+
+    def _catalog_mtime(self):
+        try:
+            return os.stat(self.catalog_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def is_current(self):
+        """
+        Returns `True` when the header was checkpointed after the last change to the catalog,
+        i.e. the recorded line count, size and modification time match. Only needs a `stat()`.
+        """
+        try:
+            stat = os.stat(self.catalog_path)
+        except FileNotFoundError:
+            return False
+        return self.contents.get('lines') == len(self.offsets) \
+            and self.contents.get('length') == self.total_length() == stat.st_size \
+            and self.contents.get('mtime_ns') == stat.st_mtime_ns
+
+    def remap(self):
+        """
+        Returns how the records of a catalog linked from another datastore are renumbered
+        (see `merge_manifests` and `remap_record`), or `None` for the catalogs of this datastore.
+        """
+        return self.contents.get('remap')
+
+    def update_contents(self, key, value):
+        self.contents[key] = value
+        self._update()
+
+    def lines(self):
+        return len(self.offsets)
+
+    def total_length(self):
+        return self.offsets[-1] if len(self.offsets) > 0 else 0
+
+    def start_index(self):
+        return self.contents['start_index']
+
+    def _update(self):
+        contents = json.dumps(self.contents, allow_nan=False, sort_keys=True)
+        self.seekable.truncate_until_end(0)
+        self.seekable.write_line(contents)
+
+    def commit(self):
+        if self.group_commit is not None:
+            self.group_commit.commit()
+
+    def close(self):
+        if self.offsets_file is not None:
+            self.commit()
+            if self.contents.get('lines') != len(self.offsets) \
+                    or self.contents.get('mtime_ns') != self._catalog_mtime():
+                self.checkpoint()
+            self.offsets_file.close()
+        self.seekable.close()
+
+
+def link_or_copy(src, dst):
+    """
+    Hard links `src` to `dst`, or copies it when it cannot be linked (e.g. on another file system). \n
+    Datastores share linked files (see `merge_manifests` and `merge_tubs`), so only files that do not
+    change anymore are linked: finished catalogs and image files, and files that are only ever
+    replaced as a whole (with `os.replace`, e.g. catalog indexes). Writers never change them in place:
+    updates of json catalogs go to a patch log, and compacting writes a new catalog, while a binary
+    catalog copies its shared files before its first update. Files that are still written to (the
+    last catalog of a datastore, index sidecars, open chunk and raw frame files) are copied instead.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def remap_record(record, remap):
+    """
+    Returns a record read from a catalog merged into another datastore (see `merge_manifests`)
+    with its record index and image names as seen from that datastore.
+    """
+    if '_index' in record:
+        record['_index'] += remap['index_offset']
+    for key in remap['image_keys']:
+        if record.get(key) is not None:
+            record[key] = remap['images_prefix'] + record[key]
+    return record
+
+
+def unmap_record(record, remap):
+    """
+    Reverts `remap_record`, for a record written back to a merged catalog.
+    """
+    record = dict(record)
+    if '_index' in record:
+        record['_index'] -= remap['index_offset']
+    prefix = remap['images_prefix']
+    for key in remap['image_keys']:
+        value = record.get(key)
+        if value is not None and value.startswith(prefix):
+            record[key] = value[len(prefix):]
+    return record
+
+
+def remap_columns(columns, remap):
+    """
+    Like `remap_record`, for the columns of a merged catalog (see `Catalog.columns`).
+    """
+    index = columns.get('_index')
+    if index is not None and index.dtype.kind in 'iuf':
+        columns['_index'] = index + remap['index_offset']
+    for key in remap['image_keys']:
+        if key in columns:
+            column = np.empty(len(columns[key]), dtype=object)
+            column[:] = [remap['images_prefix'] + value if value is not None else None
+                         for value in columns[key]]
+            columns[key] = column
+    return columns
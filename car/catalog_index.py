@@ -0,0 +1,210 @@
+import json
+import os
+from array import array
+
+import numpy as np
+
+
+class CatalogIndex(object):
+    """
+    A secondary index for the records of a catalog. \n
+    Keeps the timestamp of every line, and a bitmap of lines for each value of the
+    indexed `keys` (e.g. `user/mode`). The count, sum, min and max of each of the
+    `numeric_keys` are kept too, see `summary()`. The index is maintained as records
+    are written and updated, and saved to a `.catalog_index` file next to the catalog
+    when the catalog is finished.
+    """
+
+    def __init__(self, keys, numeric_keys=()):
+        self.keys = list(keys)
+        self.numeric_keys = list(numeric_keys)
+        self.timestamps = array('q')
+        # For each key, the lines holding each value
+        self.lines = {key: dict() for key in self.keys}
+        # For each numeric key, [count, sum, min, max]
+        self.numeric = {key: [0, 0.0, None, None] for key in self.numeric_keys}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def add(self, record):
+        line = len(self.timestamps)
+        self.timestamps.append(record.get('_timestamp_ms') or 0)
+        for key in self.keys:
+            value = record.get(key)
+            if value is not None:
+                self.lines[key].setdefault(value, array('I')).append(line)
+        for key in self.numeric_keys:
+            value = _number(record.get(key))
+            if value is not None:
+                self._add_numeric(key, 1, value, value, value)
+
+    def update(self, line, old, new):
+        """
+        Replaces the values of the record `old` in `line` with the values of the record `new`. \n
+        Counts and means stay exact, but the `min` and `max` of numeric keys are not narrowed when
+        an extreme value is replaced: they are bounds until the index is rebuilt from the catalog.
+        """
+        self.timestamps[line] = new.get('_timestamp_ms') or 0
+        for key in self.keys:
+            old_value = old.get(key)
+            value = new.get(key)
+            if old_value == value:
+                continue
+            if old_value is not None:
+                lines = self.lines[key][old_value]
+                lines.remove(line)
+                if len(lines) == 0:
+                    del self.lines[key][old_value]
+            if value is not None:
+                self.lines[key].setdefault(value, array('I')).append(line)
+        for key in self.numeric_keys:
+            old_value = _number(old.get(key))
+            if old_value is not None:
+                numeric = self.numeric[key]
+                numeric[0] -= 1
+                numeric[1] -= old_value
+                if numeric[0] == 0:
+                    self.numeric[key] = [0, 0.0, None, None]
+            value = _number(new.get(key))
+            if value is not None:
+                self._add_numeric(key, 1, value, value, value)
+
+    def _add_numeric(self, key, count, total, minimum, maximum):
+        numeric = self.numeric[key]
+        numeric[0] += count
+        numeric[1] += total
+        numeric[2] = minimum if numeric[2] is None else min(numeric[2], minimum)
+        numeric[3] = maximum if numeric[3] is None else max(numeric[3], maximum)
+
+    def summary(self):
+        """
+        Returns the statistics of the catalog as a json serializable dictionary: the number of
+        records, the timestamp span, count, min, max and mean of numeric inputs, and the
+        number of records for each value of the indexed keys.
+        """
+        inputs = dict()
+        for key, (count, total, minimum, maximum) in self.numeric.items():
+            inputs[key] = {
+                'count': count,
+                'min': minimum,
+                'max': maximum,
+                'mean': total / count if count > 0 else None,
+            }
+        return {
+            'records': len(self.timestamps),
+            'timestamps': list(self.time_range()) if len(self.timestamps) > 0 else None,
+            'inputs': inputs,
+            'values': {key: {value: len(lines) for value, lines in self.lines[key].items()} for key in self.keys},
+        }
+
+    def time_range(self):
+        """
+        Returns the smallest and largest timestamp, or `None` for an empty catalog.
+        """
+        if len(self.timestamps) == 0:
+            return None
+        timestamps = np.frombuffer(self.timestamps, dtype=np.int64)
+        return int(timestamps.min()), int(timestamps.max())
+
+    def values(self, key):
+        return list(self.lines[key].keys())
+
+    def select(self, t0=None, t1=None, values=None):
+        """
+        Returns a boolean array of the lines whose timestamp is in `[t0, t1)`, and whose
+        indexed keys hold the given values (`values` maps a key to a value, or a list of values).
+        """
+        lines = len(self.timestamps)
+        mask = np.ones(lines, dtype=bool)
+        if t0 is not None or t1 is not None:
+            timestamps = np.frombuffer(self.timestamps, dtype=np.int64)
+            if t0 is not None:
+                mask &= timestamps >= t0
+            if t1 is not None:
+                mask &= timestamps < t1
+        for key, wanted in (values or dict()).items():
+            if key not in self.lines:
+                raise ValueError('%s is not indexed' % key)
+            if not isinstance(wanted, (list, tuple, set)):
+                wanted = [wanted]
+            matches = np.zeros(lines, dtype=bool)
+            for value in wanted:
+                value_lines = self.lines[key].get(value)
+                if value_lines is not None:
+                    matches[np.frombuffer(value_lines, dtype=np.uint32)] = True
+            mask &= matches
+        return mask
+
+    def save(self, path):
+        values = [self.values(key) for key in self.keys]
+        arrays = {
+            'header': np.array(json.dumps({'keys': self.keys, 'values': values,
+                                           'numeric': self.numeric}, allow_nan=False)),
+            'timestamps': np.frombuffer(self.timestamps, dtype=np.int64),
+        }
+        for position, key in enumerate(self.keys):
+            bitmaps = np.zeros((len(values[position]), len(self.timestamps)), dtype=bool)
+            for row, value in enumerate(values[position]):
+                bitmaps[row, np.frombuffer(self.lines[key][value], dtype=np.uint32)] = True
+            arrays['bitmaps_%d' % position] = np.packbits(bitmaps, axis=1)
+        # Replaced, not changed in place, see `link_or_copy`
+        temp_path = '%s.tmp' % path
+        with open(temp_path, 'wb') as index_file:
+            np.savez(index_file, **arrays)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, keys, numeric_keys=()):
+        """
+        Loads an index saved by `save()`, returns `None` when there is no index for these keys.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as contents:
+                header = json.loads(str(contents['header']))
+                if header['keys'] != list(keys) or list(header.get('numeric', dict())) != list(numeric_keys):
+                    return None
+                index = cls(keys, numeric_keys)
+                index.numeric = header['numeric']
+                timestamps = contents['timestamps']
+                index.timestamps.frombytes(timestamps.astype(np.int64).tobytes())
+                for position, key in enumerate(index.keys):
+                    bitmaps = np.unpackbits(contents['bitmaps_%d' % position], axis=1, count=len(timestamps))
+                    for row, value in enumerate(header['values'][position]):
+                        index.lines[key][value] = array('I', np.flatnonzero(bitmaps[row]).astype(np.uint32).tobytes())
+        except (OSError, ValueError, KeyError):
+            print('Ignoring unreadable catalog index %s' % path)
+            return None
+        return index
+
+    @classmethod
+    def from_columns(cls, keys, columns, numeric_keys=()):
+        """
+        Builds the index of a catalog from its columns (see `Catalog.columns`).
+        """
+        index = cls(keys, numeric_keys)
+        timestamps = np.asarray(columns['_timestamp_ms'], dtype=np.float64)
+        timestamps = np.nan_to_num(timestamps, nan=0).astype(np.int64)
+        index.timestamps.frombytes(timestamps.tobytes())
+        for key in keys:
+            for line, value in enumerate(columns[key]):
+                if value is not None:
+                    index.lines[key].setdefault(value, array('I')).append(line)
+        for key in numeric_keys:
+            column = columns[key]
+            if column.dtype.kind not in 'iuf':
+                column = np.array([value for value in column if isinstance(value, (int, float))
+                                   and not isinstance(value, bool)], dtype=np.float64)
+            column = column[~np.isnan(column)] if column.dtype.kind == 'f' else column
+            if len(column) > 0:
+                index._add_numeric(key, len(column), float(column.sum()), column.min().item(), column.max().item())
+        return index
+
+
+def _number(value):
+    # Numeric values that count in the statistics, NaN is the only value that is not equal to itself
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value == value:
+        return value
+    return None
@@ -0,0 +1,170 @@
+import json
+import os
+import struct
+import zlib
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+
+from car.catalog_base import NEWLINE_STRIP, Seekable
+
+COMPRESSED_EXTENSION = '.catalogz'
+COMPRESSIONS = ('zlib', 'zstd')
+# Lines per compressed block, a read decompresses one block
+BLOCK_LEN = 100
+# The compressed file ends with the length of its json footer
+TRAILER = struct.Struct('<Q')
+
+
+_CODECS = dict()
+
+
+def _codec(compression):
+    """
+    Returns `(name, compress, decompress)` for a compression. `zstd` needs the `zstandard`
+    package, and falls back to `zlib` (in the standard library) when it is not installed.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown catalog compression %s' % compression)
+    codec = _CODECS.get(compression)
+    if codec is None:
+        codec = ('zlib', lambda contents: zlib.compress(contents, 6), zlib.decompress)
+        if compression == 'zstd':
+            try:
+                import zstandard
+                codec = ('zstd', lambda contents: zstandard.ZstdCompressor().compress(contents),
+                         lambda contents: zstandard.ZstdDecompressor().decompress(contents))
+            except ImportError:
+                print('zstandard is not installed, using zlib')
+        _CODECS[compression] = codec
+    return codec
+
+
+def compressed_path(catalog_path):
+    return Path(catalog_path).with_suffix(COMPRESSED_EXTENSION)
+
+
+class CompressedSeekable(Seekable):
+    """
+    A read only `Seekable` over a compressed catalog. \n
+
+    The catalog is stored as independently compressed blocks of `block_len` lines, followed by
+    a json footer with the offset of each block and the (compressed) cumulative line offsets of
+    the plain catalog. A line is found in block `line // block_len`, at its plain offset minus
+    the offset of the first line of the block, so seeking only decompresses one block. The
+    last `cache_blocks` decompressed blocks are kept.
+    """
+
+    def __init__(self, file, cache_blocks=4):
+        self.path = Path(file)
+        self.method = 'r'
+        self.file = open(self.path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        footer_length, = TRAILER.unpack(os.pread(self.file.fileno(), TRAILER.size, size - TRAILER.size))
+        footer_offset = size - TRAILER.size - footer_length
+        self.footer = json.loads(os.pread(self.file.fileno(), footer_length, footer_offset).decode('utf-8'))
+        self.compression, _, self.decompress = _codec(self.footer['codec'])
+        if self.compression != self.footer['codec']:
+            raise RuntimeError('Cannot read %s, it is compressed with %s' % (self.path, self.footer['codec']))
+        self.block_len = self.footer['block_len']
+        self.blocks = self.footer['blocks']
+        offset, length = self.footer['offsets']
+        self.offsets = array('Q')
+        self.offsets.frombytes(self.decompress(os.pread(self.file.fileno(), length, offset)))
+        self.total_length = self.offsets[-1] if len(self.offsets) > 0 else 0
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()
+        self.line = 0
+
+    def _block(self, block_number):
+        contents = self.cache.get(block_number)
+        if contents is not None:
+            self.cache.move_to_end(block_number)
+            return contents
+        offset, length = self.blocks[block_number]
+        contents = self.decompress(os.pread(self.file.fileno(), length, offset))
+        self.cache[block_number] = contents
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return contents
+
+    def write_line(self, contents):
+        raise RuntimeError(f'Seekable {self.path} is read-only.')
+
+    def truncate_until_end(self, line_number):
+        raise RuntimeError(f'Seekable {self.path} is read-only.')
+
+    def commit(self):
+        pass
+
+    def read_line(self):
+        if self.line >= len(self.offsets):
+            return ''
+        block_number = self.line // self.block_len
+        block_start = self._offset_until(block_number * self.block_len)
+        start = self._offset_until(self.line) - block_start
+        end = self.offsets[self.line] - block_start
+        self.line += 1
+        return self._block(block_number)[start:end].decode(encoding='utf-8').rstrip(NEWLINE_STRIP)
+
+    def seek_line_start(self, line_number):
+        self.line = max(line_number - 1, 0)
+
+    def seek_end_of_file(self):
+        self.line = len(self.offsets)
+
+    def read_all(self):
+        contents = b''.join(self.decompress(os.pread(self.file.fileno(), length, offset))
+                            for offset, length in self.blocks)
+        return contents.decode(encoding='utf-8')
+
+    def close(self):
+        self.cache.clear()
+        self.file.close()
+
+
+def compress_catalog(catalog_path, compression='zlib', block_len=BLOCK_LEN):
+    """
+    Compresses a finished json catalog into a `.catalogz` file (see `CompressedSeekable`),
+    then removes the plain catalog and its offsets. Returns the size of the compressed file.
+    """
+    catalog_path = Path(catalog_path)
+    target_path = compressed_path(catalog_path)
+    codec, compress, _ = _codec(compression)
+    seekable = Seekable(catalog_path.as_posix(), read_only=True)
+    temp_path = target_path.with_suffix(COMPRESSED_EXTENSION + '_tmp')
+    try:
+        with open(temp_path, 'wb') as target:
+            blocks = list()
+            position = 0
+            for start_line in range(0, seekable.lines(), block_len):
+                end_line = min(start_line + block_len, seekable.lines())
+                start = seekable._offset_until(start_line)
+                end = seekable._offset_until(end_line)
+                seekable.file.seek(start)
+                contents = compress(seekable.file.read(end - start))
+                target.write(contents)
+                blocks.append([position, len(contents)])
+                position += len(contents)
+            offsets = compress(seekable.offsets.tobytes())
+            target.write(offsets)
+            footer = {
+                'codec': codec,
+                'block_len': block_len,
+                'blocks': blocks,
+                'offsets': [position, len(offsets)],
+            }
+            footer = json.dumps(footer).encode('utf-8')
+            target.write(footer)
+            target.write(TRAILER.pack(len(footer)))
+            target.flush()
+            os.fsync(target.fileno())
+    finally:
+        seekable.close()
+    # The plain catalog is read until the compressed one is complete
+    os.replace(temp_path, target_path)
+    os.remove(catalog_path)
+    offsets_path = catalog_path.with_suffix('.catalog_offsets')
+    if offsets_path.exists():
+        os.remove(offsets_path)
+    return os.path.getsize(target_path)
@@ -1,132 +1,24 @@
+import bisect
 import json
-import mmap
 import os
+import shutil
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-NEWLINE = '\n'
-NEWLINE_STRIP = '\r\n'
+import numpy as np
 
+from car.binary_catalog import BinaryCatalog
+from car.catalog_base import NEWLINE, NEWLINE_STRIP, CatalogMetadata, CommitPolicy, Seekable, link_or_copy, \
+    remap_columns, remap_record, unmap_record
+from car.catalog_index import CatalogIndex
+from car.compressed_catalog import CompressedSeekable, compress_catalog
 
-class Seekable(object):
-    """
-    A seekable file reader, writer which deals with newline delimited records. \n
-    This reader maintains an index of line lengths, so seeking a line is a O(1) operation.
-    """
-
-    def __init__(self, file, read_only=False, line_lengths=list()):
-        self.line_lengths = list()
-        self.cumulative_lengths = list()
-        self.method = 'r' if read_only else 'a+'
-        self.file = open(file, self.method, newline=NEWLINE)
-        if self.method == 'r':
-            # If file is read only improve performance by memory mapping the file.
-            self.file = mmap.mmap(self.file.fileno(), length=0, access=mmap.ACCESS_READ)
-        self.total_length = 0
-        if len(line_lengths) <= 0:
-            self._read_contents()
-        else:
-            self.line_lengths.extend(line_lengths)
-            for line_length in self.line_lengths:
-                self.total_length += line_length
-                self.cumulative_lengths.append(self.total_length)
-
-    def _read_contents(self):
-        self.line_lengths.clear()
-        self.cumulative_lengths.clear()
-        self.total_length = 0
-        self.file.seek(0)
-        contents = self.file.readline()
-        while len(contents) > 0:
-            line_length = len(contents)
-            self.line_lengths.append(line_length)
-            self.total_length += line_length
-            self.cumulative_lengths.append(self.total_length)
-            contents = self.file.readline()
-        self.seek_end_of_file()
-
-    def __enter__(self):
-        return self
-
-    def write_line(self, contents):
-        if self.method == 'r':
-            raise RuntimeError(f'Seekable {self.file} is read-only.')
-
-        has_newline = contents[-1] == NEWLINE
-        if has_newline:
-            line = contents
-        else:
-            line = f'{contents}{NEWLINE}'
-
-        offset = len(line)
-        self.total_length += offset
-        self.line_lengths.append(offset)
-        self.cumulative_lengths.append(self.total_length)
-        self.file.write(line)
-        self.file.flush()
-
-    def _line_start_offset(self, line_number):
-        return self._offset_until(line_number - 1)
-
-    def _line_end_offset(self, line_number):
-        return self._offset_until(line_number)
-
-    def _offset_until(self, line_index):
-        end_index = line_index - 1
-        return self.cumulative_lengths[end_index] if 0 <= end_index < len(self.cumulative_lengths) else 0
-
-    def read_line(self):
-        contents = self.file.readline()
-        # When Seekable is a memory mapped file, read_line() returns a `bytes`
-        if isinstance(contents, bytes):
-            contents = contents.decode(encoding='utf-8')
-        return contents.rstrip(NEWLINE_STRIP)
-
-    def seek_line_start(self, line_number):
-        self.file.seek(self._line_start_offset(line_number))
-
-    def seek_end_of_file(self):
-        self.file.seek(self.total_length)
-
-    def truncate_until_end(self, line_number):
-        self.line_lengths = self.line_lengths[:line_number]
-        self.cumulative_lengths = self.cumulative_lengths[:line_number]
-        self.total_length = self.cumulative_lengths[-1] if len(self.cumulative_lengths) > 0 else 0
-        self.seek_end_of_file()
-        self.file.truncate()
-
-    def read_from(self, line_number):
-        current_offset = self.file.tell()
-        self.seek_line_start(line_number)
-        lines = list()
-        contents = self.read_line()
-        while len(contents) > 0:
-            lines.append(contents)
-            contents = self.read_line()
-
-        self.file.seek(current_offset)
-        return lines
-
-    def update_line(self, line_number, contents):
-        lines = self.read_from(line_number)
-        length = len(lines)
-        self.truncate_until_end(line_number - 1)
-        self.write_line(contents)
-        if length > 1:
-            for line in lines[1:]:
-                self.write_line(line)
-
-    def lines(self):
-        return len(self.line_lengths)
-
-    def has_content(self):
-        return self.lines() > 0
-
-    def close(self):
-        self.file.close()
-
-    def __exit__(self, type, value, traceback):
-        self.close()
+CATALOG_EXTENSIONS = {
+    'json': '.catalog',
+    'binary': '.bincatalog',
+}
 
 
 class Catalog(object):
@@ -138,10 +30,52 @@ class Catalog(object):
     ...
     """
 
-    def __init__(self, path, read_only=False, start_index=0):
+    def __init__(self, path, read_only=False, start_index=0, commit_policy=None):
         self.path = Path(os.path.expanduser(path))
-        self.manifest = CatalogMetadata(self.path, read_only=read_only, start_index=start_index)
-        self.seekable = Seekable(self.path.as_posix(), line_lengths=self.manifest.line_lengths(), read_only=read_only)
+        self.manifest = CatalogMetadata(self.path, read_only=read_only, start_index=start_index,
+                                        commit_policy=commit_policy)
+        # Finished catalogs can be compressed, see `compress_catalog`
+        self.compression = None
+        compressed_path = self.path.with_suffix('.catalogz')
+        self.seekable = None
+        if self.path.exists() or not compressed_path.exists():
+            # Only trust the offsets when the catalog has not changed since they were checkpointed,
+            # otherwise the line index is rebuilt from the catalog.
+            is_current = self.manifest.is_current()
+            line_offsets = self.manifest.offsets if is_current else None
+            try:
+                self.seekable = Seekable(self.path.as_posix(), line_offsets=line_offsets,
+                                         read_only=read_only, commit_policy=commit_policy)
+            except FileNotFoundError:
+                # Compressed since it was checked
+                if not compressed_path.exists():
+                    raise
+            if self.seekable is not None and not read_only \
+                    and (not is_current or self.seekable.total_length != self.manifest.total_length()):
+                self.manifest.update_offsets(self.seekable.offsets)
+        if self.seekable is None:
+            self.seekable = CompressedSeekable(compressed_path)
+            self.compression = self.seekable.compression
+        self.read_only = read_only
+        self.commit_policy = commit_policy
+        self.remap = self.manifest.remap()
+        self.cursor = 0
+        self.patches_path = self.path.with_suffix('.catalog_patches')
+        self.patches = dict()
+        self.patch_seekable = None
+        if os.path.exists(self.patches_path):
+            self._read_patches()
+
+    def _read_patches(self):
+        self.patch_seekable = Seekable(self.patches_path.as_posix(), read_only=self.read_only,
+                                       commit_policy=self.commit_policy)
+        for contents in self.patch_seekable.read_all().splitlines():
+            try:
+                patch = json.loads(contents)
+            except ValueError:
+                # A torn patch at the end of a read only log
+                continue
+            self.patches[patch['line']] = patch['record']
 
     def _exit_handler(self):
         self.close()
@@ -149,60 +83,258 @@ class Catalog(object):
     def write_record(self, record):
         # Add record and update manifest
         contents = json.dumps(record, allow_nan=False, sort_keys=True)
-        self.seekable.write_line(contents)
-        line_lengths = self.seekable.line_lengths
-        self.manifest.update_line_lengths(line_lengths)
+        line_length = self.seekable.write_line(contents)
+        self.manifest.append_line_length(line_length)
+
+    def update_record(self, line, record):
+        """
+        Replaces the record stored in the given (0 based) line. \n
+        The catalog is not rewritten, the new version is appended to a `.catalog_patches` log
+        which overrides the line when reading. Patches are applied by `compact()`.
+        """
+        if self.read_only:
+            raise RuntimeError('Catalog %s is read-only.' % self.path)
+        if not 0 <= line < self.lines():
+            raise IndexError('Line %s out of range' % line)
+        if self.patch_seekable is None:
+            self.patch_seekable = Seekable(self.patches_path.as_posix(), commit_policy=self.commit_policy)
+        if self.remap is not None:
+            record = unmap_record(record, self.remap)
+        contents = json.dumps({'line': line, 'record': record}, allow_nan=False, sort_keys=True)
+        self.patch_seekable.write_line(contents)
+        self.patches[line] = record
+
+    def compact(self):
+        """
+        Applies the patches, by rewriting the catalog once.
+        """
+        if self.read_only:
+            raise RuntimeError('Catalog %s is read-only.' % self.path)
+        if self.patch_seekable is None:
+            return
+        self.seekable.commit()
+        compact_path = self.path.with_suffix('.catalog_compact')
+        with open(compact_path, 'w', newline=NEWLINE) as target:
+            self.seekable.seek_line_start(1)
+            for line in range(self.lines()):
+                contents = self.seekable.read_line()
+                record = self.patches.get(line)
+                if record is not None:
+                    contents = json.dumps(record, allow_nan=False, sort_keys=True)
+                target.write(contents + NEWLINE)
+            target.flush()
+            os.fsync(target.fileno())
+        self.seekable.close()
+        os.replace(compact_path, self.path)
+        if self.compression is not None:
+            compress_catalog(self.path, self.compression)
+            self.seekable = CompressedSeekable(self.path.with_suffix('.catalogz'))
+        else:
+            self.seekable = Seekable(self.path.as_posix(), commit_policy=self.commit_policy)
+            self.manifest.update_offsets(self.seekable.offsets)
+        # Patches are only dropped once the catalog holds them, applying them twice is harmless.
+        self.patch_seekable.close()
+        os.remove(self.patches_path)
+        self.patch_seekable = None
+        self.patches.clear()
+
+    def seek_record(self, line):
+        self.seekable.seek_line_start(line + 1)
+        self.cursor = line
+
+    def read_record(self):
+        """
+        Reads the record under the cursor, returns `None` at the end of the catalog.
+        Raises a `ValueError` when the record cannot be parsed.
+        """
+        contents = self.seekable.read_line()
+        if contents is None or len(contents) <= 0:
+            return None
+        line = self.cursor
+        self.cursor += 1
+        if line in self.patches:
+            record = dict(self.patches[line])
+        else:
+            record = json.loads(contents)
+        if self.remap is not None:
+            record = remap_record(record, self.remap)
+        return record
+
+    def read_record_at(self, line):
+        """
+        Returns the record stored in the given (0 based) line.
+        """
+        self.seek_record(line)
+        return self.read_record()
+
+    def lines(self):
+        return self.seekable.lines()
+
+    def columns(self, keys):
+        """
+        Returns a dictionary of NumPy arrays, one per key, with a value for each line. \n
+        The whole catalog is parsed at once. `_valid` is False for lines that could not be parsed.
+        """
+        contents = self.seekable.read_all()
+        records = None
+        if len(contents) > 0:
+            try:
+                # Records are single line json objects, so the catalog is one json array away.
+                records = json.loads('[%s]' % contents.rstrip(NEWLINE_STRIP).replace(NEWLINE, ','))
+            except ValueError:
+                pass
+        else:
+            records = list()
+
+        valid = [True] * len(records) if records is not None else None
+        if records is None or len(records) != self.lines():
+            # Parse line by line, to find the lines that are broken
+            records = list()
+            valid = list()
+            for line in contents.splitlines():
+                try:
+                    records.append(json.loads(line))
+                    valid.append(True)
+                except ValueError:
+                    records.append(dict())
+                    valid.append(False)
+        for line, record in self.patches.items():
+            if line < len(records):
+                records[line] = record
+                valid[line] = True
+
+        columns = dict()
+        for key in keys:
+            columns[key] = _column([record.get(key) for record in records])
+        columns['_valid'] = np.array(valid, dtype=bool)
+        if self.remap is not None:
+            remap_columns(columns, self.remap)
+        return columns
+
+    def commit(self):
+        self.seekable.commit()
+        if self.patch_seekable is not None:
+            self.patch_seekable.commit()
+        self.manifest.commit()
 
     def close(self):
-        self.manifest.close()
+        if not self.read_only and self.patch_seekable is not None \
+                and self.patch_seekable.lines() * 4 >= self.lines():
+            # Keeps the patch log small compared to the catalog, so each patch costs O(1) amortized
+            self.compact()
+        if self.patch_seekable is not None:
+            self.patch_seekable.close()
+        # Commit the catalog before its index
         self.seekable.close()
+        self.manifest.close()
+
 
 
-class CatalogMetadata(object):
+class IndexRanges(object):
     """
-    Manifest for a Catalog
+    A set of record indexes, stored as sorted, disjoint `[start, end)` ranges. \n
+    Membership is a binary search, adding a range merges it with its neighbours, and the set
+    is written as a short list of `[start, end]` pairs, so deleting records a range at a time
+    stays cheap however many records are deleted.
     """
 
-    def __init__(self, catalog_path, read_only=False, start_index=0):
-        path = Path(catalog_path)
-        manifest_name = '%s.catalog_manifest' % path.stem
-        self.manifest_path = Path(os.path.join(path.parent.as_posix(), manifest_name))
-        self.seekable = Seekable(self.manifest_path, read_only=read_only)
-        has_contents = False
-        if os.path.exists(self.manifest_path) and self.seekable.has_content():
-            self.seekable.seek_line_start(1)
-            contents = self.seekable.read_line()
-            if contents:
-                self.contents = json.loads(contents)
-                has_contents = True
-
-        if not has_contents:
-            # New catalog metadata entry
-            self.contents = dict()
-            self.contents['path'] = self.manifest_path.name
-            created_at = time.time()
-            self.contents['created_at'] = created_at
-            self.contents['start_index'] = start_index
-            self.contents['line_lengths'] = list()
-            self._update()
-
-    def update_line_lengths(self, new_lengths):
-        self.contents['line_lengths'] = new_lengths
-        self._update()
-
-    def line_lengths(self):
-        return self.contents['line_lengths']
+    def __init__(self, ranges=()):
+        self.starts = list()
+        self.ends = list()
+        self.count = 0
+        self._positions = None
+        for start, end in ranges:
+            self.add_range(start, end)
+
+    @classmethod
+    def from_indexes(cls, indexes):
+        ranges = cls()
+        for index in sorted(indexes):
+            ranges.add(index)
+        return ranges
+
+    def add(self, index):
+        self.add_range(index, index + 1)
+
+    def add_mask(self, start, mask):
+        """
+        Adds `start + i` for every `i` where `mask[i]` is `True`.
+        """
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0]))))
+        for range_start, range_end in zip(edges[0::2], edges[1::2]):
+            self.add_range(start + int(range_start), start + int(range_end))
+
+    def add_range(self, start, end):
+        """
+        Adds the indexes in `[start, end)`.
+        """
+        if start >= end:
+            return
+        # Ranges that overlap or touch [start, end) are merged into it
+        first = bisect.bisect_left(self.ends, start)
+        last = bisect.bisect_right(self.starts, end)
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        merged = sum(self.ends[i] - self.starts[i] for i in range(first, last))
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+        self.count += end - start - merged
+        self._positions = None
+
+    def update(self, indexes):
+        if isinstance(indexes, range) and indexes.step == 1:
+            self.add_range(indexes.start, indexes.stop)
+        else:
+            for index in indexes:
+                self.add(index)
 
-    def start_index(self):
-        return self.contents['start_index']
+    def __contains__(self, index):
+        i = bisect.bisect_right(self.starts, index) - 1
+        return i >= 0 and index < self.ends[i]
 
-    def _update(self):
-        contents = json.dumps(self.contents, allow_nan=False, sort_keys=True)
-        self.seekable.truncate_until_end(0)
-        self.seekable.write_line(contents)
+    def __len__(self):
+        return self.count
 
-    def close(self):
-        self.seekable.close()
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end)
+
+    def ranges(self):
+        return [[start, end] for start, end in zip(self.starts, self.ends)]
+
+    def __repr__(self):
+        return 'IndexRanges(%s)' % self.ranges()
+
+    def skip(self, position):
+        """
+        Returns the `position`-th (0 based) index that is not in the set.
+        """
+        if self._positions is None:
+            # For each range, how many indexes before it are not in the set
+            positions = list()
+            counts = list()
+            count = 0
+            for start, end in zip(self.starts, self.ends):
+                positions.append(start - count)
+                count += end - start
+                counts.append(count)
+            self._positions = (positions, counts)
+        positions, counts = self._positions
+        i = bisect.bisect_right(positions, position)
+        return position + (counts[i - 1] if i > 0 else 0)
+
+    def mask(self, start, end):
+        """
+        Returns a boolean NumPy array, `True` for the indexes in `[start, end)` that are in the set.
+        """
+        mask = np.zeros(max(end - start, 0), dtype=bool)
+        first = bisect.bisect_right(self.ends, start)
+        for i in range(first, len(self.starts)):
+            if self.starts[i] >= end:
+                break
+            mask[max(self.starts[i], start) - start:min(self.ends[i], end) - start] = True
+        return mask
 
 
 class Manifest(object):
@@ -214,10 +346,33 @@ class Manifest(object):
     [ json object with user metadata ]\n
     [ json object with manifest metadata ]\n
     [ json object with catalog metadata ]\n
+    [ json object with a journal event ]\n
+    ...
+
+    The catalog metadata is a snapshot, changes made after it are appended as
+    journal events (`append`, `delete` and `catalog`) instead of rewriting it.
+    The journal is compacted into a new snapshot every `journal_limit` events,
+    and when the manifest is closed.
+
+    Catalogs are stored as JSON lines by default, `catalog_format='binary'`
+    stores them as fixed width binary rows instead (see `BinaryCatalog`).
+    The format of an existing datastore is read from its manifest.
+
+    With `compression` (`zlib` or `zstd`), finished JSON catalogs are compressed on a
+    background thread when a new catalog is started (see `CompressedSeekable`). The
+    compression of an existing datastore is read from its manifest, unless it is given.
     """
 
     def __init__(self, base_path, inputs=[], types=[], metadata=[],
-                 max_len=1000, read_only=False):
+                 max_len=1000, read_only=False, catalog_format='json', journal_limit=1000,
+                 commit_policy=None, compression=None):
+        if catalog_format not in CATALOG_EXTENSIONS:
+            raise ValueError('Unknown catalog format %s' % catalog_format)
+        if compression is not None and compression not in ('zlib', 'zstd'):
+            raise ValueError('Unknown catalog compression %s' % compression)
+        if compression is not None and catalog_format != 'json':
+            raise ValueError('Only json catalogs can be compressed')
+
         self.base_path = Path(os.path.expanduser(base_path)).absolute()
         self.manifest_path = Path(os.path.join(self.base_path, 'manifest.json'))
         self.inputs = inputs
@@ -226,60 +381,208 @@ class Manifest(object):
         self.manifest_metadata = dict()
         self.max_len = max_len
         self.read_only = read_only
+        self.catalog_format = catalog_format
         self.current_catalog = None
         self.current_index = 0
         self.catalog_paths = list()
+        self.catalog_start_indexes = list()
         self.catalog_metadata = dict()
-        self.deleted_indexes = set()
+        self.deleted_indexes = IndexRanges()
+        self.journal_limit = journal_limit
+        self.journal_length = 0
+        self.commit_policy = commit_policy
+        self.catalog_cache = CatalogCache(self)
+        self.catalog_indexes = dict()
+        self.catalog_stats_cache = dict()
+        self.compression = compression
+        self.compressor = None
+        self.compressions = list()
         has_catalogs = False
 
         if self.manifest_path.exists():
-            self.seekable = Seekable(self.manifest_path, read_only=self.read_only)
+            self.seekable = Seekable(self.manifest_path, read_only=self.read_only, commit_policy=commit_policy)
             if self.seekable.has_content():
                 self._read_contents()
+                if compression is not None:
+                    self.compression = compression
             has_catalogs = len(self.catalog_paths) > 0
+            if has_catalogs and self.journal_length > 0 and not self.read_only:
+                # Start from a clean snapshot, this also drops a torn journal event.
+                self._update_catalog_metadata(update=True)
         else:
             created_at = time.time()
             self.manifest_metadata['created_at'] = created_at
             if not self.base_path.exists():
                 self.base_path.mkdir(parents=True, exist_ok=True)
                 print('Created a new datastore at %s' % (self.base_path.as_posix()))
-            self.seekable = Seekable(self.manifest_path, read_only=self.read_only)
+            self.seekable = Seekable(self.manifest_path, read_only=self.read_only, commit_policy=commit_policy)
 
+        # String inputs (e.g. `user/mode`) get a secondary index, see `select()`
+        self.indexed_keys = [key for key, input_type in zip(self.inputs, self.types) if input_type == 'str']
+        # Numeric inputs get min, max and mean statistics, see `catalog_stats()`
+        self.numeric_keys = [key for key, input_type in zip(self.inputs, self.types) if input_type in ('float', 'int')]
         if not has_catalogs:
             self._write_contents()
             self._add_catalog()
         else:
             last_known_catalog = os.path.join(self.base_path, self.catalog_paths[-1])
             print('Using catalog %s' % last_known_catalog)
-            self.current_catalog = Catalog(last_known_catalog, read_only=self.read_only, start_index=self.current_index)
+            self.current_catalog = self._open_catalog(last_known_catalog, read_only=self.read_only,
+                                                      start_index=self.current_index)
+            last_index = self.current_catalog.manifest.start_index() + self.current_catalog.lines()
+            if not self.read_only and last_index != self.current_index:
+                # The journal and the catalog were not committed together before a crash.
+                print('Recovered current index %s from catalog (was %s)' % (last_index, self.current_index))
+                self.current_index = last_index
+                self._update_catalog_metadata(update=True)
+            if not self.read_only:
+                # Loaded now, so it is maintained as records are written
+                self.catalog_index(len(self.catalog_paths) - 1)
+                # Catalogs finished before a crash, or before compression was enabled
+                for catalog_number in range(len(self.catalog_paths) - 1):
+                    self._compress_catalog(catalog_number)
 
     def write_record(self, record):
-        new_catalog = self.current_index > 0 and (self.current_index % self.max_len) == 0
+        new_catalog = self.current_catalog.lines() >= self.max_len
         if new_catalog:
             self._add_catalog()
 
         self.current_catalog.write_record(record)
+        index = self.catalog_indexes.get(len(self.catalog_paths) - 1)
+        if index is not None:
+            index.add(record)
         self.current_index += 1
         # Update metadata to keep track of the last index
-        self._update_catalog_metadata(update=True)
+        self._append_event({'event': 'append', 'index': self.current_index - 1})
+
+    def catalog_number(self, pending=0):
+        """
+        Returns the number of the catalog the next record is written to, when `pending`
+        records are written before it.
+        """
+        free = max(self.max_len - self.current_catalog.lines(), 0)
+        if pending < free:
+            return len(self.catalog_paths) - 1
+        return len(self.catalog_paths) + (pending - free) // self.max_len
 
     def delete_record(self, record_index):
-        # Does not actually delete the record, but marks it as deleted.
-        self.deleted_indexes.add(record_index)
-        self._update_catalog_metadata(update=True)
+        self.delete_records(record_index, record_index + 1)
+
+    def delete_records(self, start_index, end_index):
+        """
+        Marks the records in [start_index, end_index) as deleted.
+        """
+        # Does not actually delete the records, but marks them as deleted.
+        self.deleted_indexes.add_range(start_index, end_index)
+        self._append_event({'event': 'delete', 'start': start_index, 'end': end_index})
+        if not self.read_only and start_index < end_index and len(self.catalog_paths) > 0:
+            # Keep the deleted count of finished catalogs current
+            first, _ = self.catalog_line(max(start_index, 0))
+            last, _ = self.catalog_line(max(min(end_index, self.current_index) - 1, 0))
+            for catalog_number in range(first, min(last + 1, len(self.catalog_paths) - 1)):
+                self._save_catalog_stats(catalog_number)
+
+    def update_records(self, updates):
+        """
+        Updates records in place, `updates` maps record indexes to a dictionary of new values
+        (e.g. `{12: {'user/angle': 0.1}}`). Other values of the records are kept. \n
+        Catalogs are not rewritten for each update, see `Catalog.update_record`, and their
+        secondary indexes and statistics are updated for the changed values only, see
+        `CatalogIndex.update`.
+        """
+        if self.read_only:
+            raise RuntimeError('Manifest %s is read-only.' % self.base_path)
+        # Finished catalogs are not changed while they are compressed
+        self._wait_for_compression()
+        by_catalog = dict()
+        for record_index, values in updates.items():
+            if not 0 <= record_index < self.current_index or record_index in self.deleted_indexes:
+                raise IndexError('No record at index %s' % record_index)
+            catalog_number, line = self.catalog_line(record_index)
+            by_catalog.setdefault(catalog_number, list()).append((line, values))
+
+        current_number = len(self.catalog_paths) - 1
+        for catalog_number, lines in sorted(by_catalog.items()):
+            # Loaded before the catalog changes, so it can be updated with the old and new records
+            index = self.catalog_index(catalog_number)
+            if catalog_number == current_number:
+                catalog = self.current_catalog
+            else:
+                catalog_path = os.path.join(self.base_path, self.catalog_paths[catalog_number])
+                catalog = self._open_catalog(catalog_path, start_index=self.catalog_start_indexes[catalog_number])
+            try:
+                for line, values in lines:
+                    record = catalog.read_record_at(line)
+                    updated = dict(record)
+                    updated.update(values)
+                    catalog.update_record(line, updated)
+                    index.update(line, record, updated)
+            finally:
+                if catalog is not self.current_catalog:
+                    catalog.close()
+                else:
+                    catalog.commit()
+        for catalog_number in by_catalog:
+            # Cached readers do not see the updates
+            self.catalog_cache.evict(catalog_number)
+            if catalog_number != current_number:
+                self._save_catalog_index(catalog_number)
+                self._save_catalog_stats(catalog_number)
 
     def _add_catalog(self):
         current_length = len(self.catalog_paths)
-        catalog_name = 'catalog_%s.catalog' % current_length
+        catalog_name = 'catalog_%s%s' % (current_length, CATALOG_EXTENSIONS[self.catalog_format])
         catalog_path = os.path.join(self.base_path, catalog_name)
         current_catalog = self.current_catalog
-        self.current_catalog = Catalog(catalog_path, start_index=self.current_index, read_only=self.read_only)
+        self.current_catalog = self._open_catalog(catalog_path, start_index=self.current_index,
+                                                  read_only=self.read_only)
         # Store relative paths
         self.catalog_paths.append(catalog_name)
-        self._update_catalog_metadata(update=True)
+        self.catalog_start_indexes.append(self.current_index)
         if current_catalog:
+            self._append_event({'event': 'catalog', 'path': catalog_name, 'start_index': self.current_index})
+        else:
+            self._update_catalog_metadata(update=True)
+        if not self.read_only:
+            self.catalog_indexes[len(self.catalog_paths) - 1] = CatalogIndex(self.indexed_keys, self.numeric_keys)
+        if current_catalog:
+            finished_number = len(self.catalog_paths) - 2
+            if not self.read_only and finished_number in self.catalog_indexes:
+                # Written with the header, so the catalog can be skipped without reading it
+                current_catalog.manifest.update_contents('stats', self._catalog_summary(finished_number))
             current_catalog.close()
+            self._save_catalog_index(finished_number)
+            self.seekable.commit()
+            self._compress_catalog(finished_number)
+
+    def _compress_catalog(self, catalog_number):
+        catalog_path = os.path.join(self.base_path, self.catalog_paths[catalog_number])
+        if self.compression is None or self.read_only or not os.path.exists(catalog_path):
+            return
+        if self.compressor is None:
+            self.compressor = ThreadPoolExecutor(max_workers=1)
+        self._wait_for_compression(wait=False)
+        self.compressions.append(self.compressor.submit(compress_catalog, catalog_path, self.compression))
+
+    def _wait_for_compression(self, wait=True):
+        pending = list()
+        for compression in self.compressions:
+            if not wait and not compression.done():
+                pending.append(compression)
+                continue
+            try:
+                compression.result()
+            except Exception as exception:
+                # The catalog stays uncompressed, it is compressed again when the datastore is opened
+                print('Could not compress a catalog: %s' % exception)
+        self.compressions = pending
+
+    def _open_catalog(self, catalog_path, read_only=False, start_index=0):
+        if self.catalog_format == 'binary':
+            return BinaryCatalog(catalog_path, self.inputs, self.types, read_only=read_only,
+                                 start_index=start_index, commit_policy=self.commit_policy)
+        return Catalog(catalog_path, read_only=read_only, start_index=start_index,
+                       commit_policy=self.commit_policy)
 
     def _read_metadata(self, metadata=[]):
         self.metadata = dict()
@@ -295,9 +598,59 @@ class Manifest(object):
         # Catalog metadata
         catalog_metadata = json.loads(self.seekable.read_line())
         self.catalog_paths = catalog_metadata['paths']
+        self.catalog_start_indexes = catalog_metadata.get('start_indexes')
         self.current_index = catalog_metadata['current_index']
         self.max_len = catalog_metadata['max_len']
-        self.deleted_indexes = set(catalog_metadata['deleted_indexes'])
+        if 'deleted_ranges' in catalog_metadata:
+            self.deleted_indexes = IndexRanges(catalog_metadata['deleted_ranges'])
+        else:
+            # Manifests written before deletions were stored as ranges
+            self.deleted_indexes = IndexRanges.from_indexes(catalog_metadata['deleted_indexes'])
+        self.catalog_format = catalog_metadata.get('catalog_format', 'json')
+        self.compression = catalog_metadata.get('compression')
+        # Journal events
+        contents = self.seekable.read_line()
+        while len(contents) > 0:
+            try:
+                event = json.loads(contents)
+            except ValueError:
+                print('Ignoring torn manifest journal entry')
+                self.journal_length += 1
+                break
+            self._apply_event(event)
+            self.journal_length += 1
+            contents = self.seekable.read_line()
+        if self.catalog_start_indexes is None:
+            self.catalog_start_indexes = self._read_start_indexes()
+
+    def _read_start_indexes(self):
+        # Manifests written before start indexes were tracked
+        start_indexes = list()
+        for catalog_path in self.catalog_paths:
+            metadata = CatalogMetadata(os.path.join(self.base_path, catalog_path), read_only=True)
+            start_indexes.append(metadata.start_index())
+            metadata.close()
+        return start_indexes
+
+    def _apply_event(self, event):
+        name = event['event']
+        if name == 'append':
+            self.current_index = max(self.current_index, event['index'] + 1)
+        elif name == 'delete':
+            self.deleted_indexes.add_range(event['start'], event['end'])
+        elif name == 'catalog':
+            self.catalog_paths.append(event['path'])
+            if self.catalog_start_indexes is not None:
+                self.catalog_start_indexes.append(event['start_index'])
+        else:
+            print('Ignoring unknown manifest journal event %s' % name)
+
+    def _append_event(self, event):
+        if self.journal_length >= self.journal_limit:
+            self._update_catalog_metadata(update=True)
+        else:
+            self.seekable.write_line(json.dumps(event))
+            self.journal_length += 1
 
     def _write_contents(self):
         self.seekable.truncate_until_end(0)
@@ -313,14 +666,236 @@ class Manifest(object):
         # Catalog metadata
         catalog_metadata = dict()
         catalog_metadata['paths'] = self.catalog_paths
+        catalog_metadata['start_indexes'] = self.catalog_start_indexes
         catalog_metadata['current_index'] = self.current_index
         catalog_metadata['max_len'] = self.max_len
-        catalog_metadata['deleted_indexes'] = list(self.deleted_indexes)
+        catalog_metadata['deleted_ranges'] = self.deleted_indexes.ranges()
+        catalog_metadata['catalog_format'] = self.catalog_format
+        catalog_metadata['compression'] = self.compression
         self.catalog_metadata = catalog_metadata
         self.seekable.write_line(json.dumps(catalog_metadata))
+        self.seekable.commit()
+        self.journal_length = 0
+
+    def record_index(self, position):
+        """
+        Returns the index of the record at `position`, counting only records that are not deleted.
+        """
+        return self.deleted_indexes.skip(position)
+
+    def catalog_line(self, record_index):
+        """
+        Returns the (catalog number, line) that holds the record at `record_index`.
+        """
+        catalog_number = bisect.bisect_right(self.catalog_start_indexes, record_index) - 1
+        return catalog_number, record_index - self.catalog_start_indexes[catalog_number]
+
+    def get_batch(self, positions):
+        """
+        Returns the records at the given positions, counting only records that are not deleted.
+        """
+        length = len(self)
+        record_indexes = list()
+        for position in positions:
+            if position < 0:
+                position += length
+            if not 0 <= position < length:
+                raise IndexError('Record position %s out of range' % position)
+            record_indexes.append(self.record_index(position))
+        return self.get_records(record_indexes)
+
+    def get_records(self, record_indexes):
+        """
+        Returns the records with the given indexes, e.g. the indexes returned by `select()`.
+        """
+        locations = list()
+        for record_index in record_indexes:
+            if not 0 <= record_index < self.current_index:
+                raise IndexError('No record at index %s' % record_index)
+            locations.append(self.catalog_line(int(record_index)))
+
+        records = [None] * len(locations)
+        # Read in catalog order, so each catalog is only opened once
+        for order in sorted(range(len(locations)), key=locations.__getitem__):
+            catalog_number, line = locations[order]
+            records[order] = self.catalog_cache.read_record(catalog_number, line)
+        return records
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.get_batch(range(*key.indices(len(self))))
+        return self.get_batch([key])[0]
+
+    def _index_path(self, catalog_number):
+        stem = Path(self.catalog_paths[catalog_number]).stem
+        return os.path.join(self.base_path, '%s.catalog_index' % stem)
+
+    def _build_catalog_index(self, catalog_number):
+        keys = ['_timestamp_ms'] + self.indexed_keys + self.numeric_keys
+        if catalog_number == len(self.catalog_paths) - 1 and not self.read_only:
+            columns = self.current_catalog.columns(keys)
+        else:
+            catalog_path = os.path.join(self.base_path, self.catalog_paths[catalog_number])
+            catalog = self._open_catalog(catalog_path, read_only=True,
+                                         start_index=self.catalog_start_indexes[catalog_number])
+            try:
+                columns = catalog.columns(keys)
+            finally:
+                catalog.close()
+        return CatalogIndex.from_columns(self.indexed_keys, columns, self.numeric_keys)
+
+    def _save_catalog_index(self, catalog_number):
+        index = self.catalog_indexes.get(catalog_number)
+        if index is not None and not self.read_only:
+            index.save(self._index_path(catalog_number))
+
+    def catalog_index(self, catalog_number):
+        """
+        Returns the secondary index of a catalog (see `CatalogIndex`). It is read from the
+        `.catalog_index` file of the catalog, or rebuilt from the catalog when the file
+        is missing or does not cover the catalog being written.
+        """
+        index = self.catalog_indexes.get(catalog_number)
+        if index is not None:
+            return index
+        index = CatalogIndex.load(self._index_path(catalog_number), self.indexed_keys, self.numeric_keys)
+        if catalog_number == len(self.catalog_paths) - 1:
+            if self.read_only:
+                lines = self.current_index - self.catalog_start_indexes[catalog_number]
+            else:
+                lines = self.current_catalog.lines()
+            if index is not None and len(index) < lines:
+                index = None
+        if index is None:
+            index = self._build_catalog_index(catalog_number)
+            if catalog_number < len(self.catalog_paths) - 1 and not self.read_only:
+                index.save(self._index_path(catalog_number))
+        self.catalog_indexes[catalog_number] = index
+        return index
+
+    def _catalog_summary(self, catalog_number):
+        stats = self.catalog_index(catalog_number).summary()
+        start_index = self.catalog_start_indexes[catalog_number]
+        stats['deleted'] = int(self.deleted_indexes.mask(start_index, start_index + stats['records']).sum())
+        return stats
+
+    def _save_catalog_stats(self, catalog_number):
+        self.catalog_stats_cache.pop(catalog_number, None)
+        metadata = CatalogMetadata(os.path.join(self.base_path, self.catalog_paths[catalog_number]))
+        try:
+            metadata.update_contents('stats', self._catalog_summary(catalog_number))
+        finally:
+            metadata.close()
+
+    def catalog_stats(self, catalog_number):
+        """
+        Returns the statistics of a catalog: the number of `records` and of `deleted` records,
+        the `timestamps` span, the `count`, `min`, `max` and `mean` of numeric `inputs` and the
+        number of records for each of the `values` of string inputs. \n
+        The statistics of finished catalogs are read from their header, so dashboards and
+        readers can skip catalogs without opening them. They cover every line of the catalog,
+        deleted or not. After `update_records()` the `min` and `max` are bounds rather than
+        exact values (see `CatalogIndex.update`), which is enough to skip catalogs.
+        """
+        if catalog_number == len(self.catalog_paths) - 1:
+            return self._catalog_summary(catalog_number)
+        stats = self.catalog_stats_cache.get(catalog_number)
+        if stats is None:
+            metadata = CatalogMetadata(os.path.join(self.base_path, self.catalog_paths[catalog_number]),
+                                       read_only=True)
+            stats = metadata.contents.get('stats')
+            metadata.close()
+            if stats is None or set(stats['inputs']) != set(self.numeric_keys):
+                # Catalogs finished before statistics were kept
+                stats = self._catalog_summary(catalog_number)
+                if not self.read_only:
+                    self._save_catalog_stats(catalog_number)
+            self.catalog_stats_cache[catalog_number] = stats
+        return stats
+
+    def select(self, t0=None, t1=None, values=None):
+        """
+        Returns the indexes of the records whose `_timestamp_ms` is in `[t0, t1)`, and whose
+        indexed keys hold the given `values`, e.g. `{'user/mode': 'user'}` (a list of values
+        matches any of them). Deleted records are left out. \n
+        Catalogs are skipped using their statistics, only the secondary indexes of the
+        other catalogs are read.
+        """
+        for key in values or dict():
+            if key not in self.indexed_keys:
+                raise ValueError('%s is not indexed, indexed keys are %s' % (key, self.indexed_keys))
+        selected = list()
+        for catalog_number, start_index in enumerate(self.catalog_start_indexes):
+            stats = self.catalog_stats(catalog_number)
+            time_range = stats['timestamps']
+            if time_range is None or (t0 is not None and time_range[1] < t0) \
+                    or (t1 is not None and time_range[0] >= t1):
+                continue
+            if not all(_has_value(stats['values'][key], wanted) for key, wanted in (values or dict()).items()):
+                continue
+            mask = self.catalog_index(catalog_number).select(t0, t1, values)
+            mask &= ~self.deleted_indexes.mask(start_index, start_index + len(mask))
+            selected.append(start_index + np.flatnonzero(mask))
+        record_indexes = np.concatenate(selected) if len(selected) > 0 else np.zeros(0, dtype=np.int64)
+        return record_indexes[record_indexes < self.current_index]
+
+    def to_arrays(self, keys=None, where=None):
+        """
+        Reads all catalogs in one pass, and returns a dictionary of NumPy arrays, one per key,
+        with a value for each record that is not deleted. \n
+        `keys` defaults to the inputs and the private `_index` and `_timestamp_ms` properties.
+        Catalogs for which `where(stats)` is False are skipped (see `catalog_stats()`).
+        """
+        if keys is None:
+            keys = self.inputs + ['_index', '_timestamp_ms']
+        if not self.read_only:
+            self.current_catalog.commit()
+
+        parts = {key: list() for key in keys}
+        masks = list()
+        for catalog_number, (catalog_path, start_index) in enumerate(zip(self.catalog_paths,
+                                                                          self.catalog_start_indexes)):
+            if where is not None and not where(self.catalog_stats(catalog_number)):
+                continue
+            catalog = self._open_catalog(os.path.join(self.base_path, catalog_path), read_only=True)
+            try:
+                columns = catalog.columns(keys)
+                lines = catalog.lines()
+            finally:
+                catalog.close()
+            mask = ~self.deleted_indexes.mask(start_index, start_index + lines)
+            if '_valid' in columns:
+                mask &= columns['_valid']
+            masks.append(mask)
+            for key in keys:
+                parts[key].append(columns[key])
+
+        arrays = dict()
+        mask = np.concatenate(masks) if len(masks) > 0 else np.zeros(0, dtype=bool)
+        for key in keys:
+            arrays[key] = np.concatenate(parts[key])[mask] if len(parts[key]) > 0 else np.zeros(0)
+        return arrays
+
+    def commit(self):
+        """
+        Commits the writes buffered by the commit policy, e.g. when no record was written
+        for `batch_interval_ms`.
+        """
+        if not self.read_only:
+            # The catalog before the manifest which refers to its records
+            self.current_catalog.commit()
+            self.seekable.commit()
 
     def close(self):
+        self._wait_for_compression()
+        if self.compressor is not None:
+            self.compressor.shutdown()
+        self.catalog_cache.close()
+        # Commit the catalog before the manifest refers to its records
         self.current_catalog.close()
+        self._save_catalog_index(len(self.catalog_paths) - 1)
+        if self.journal_length > 0 and not self.read_only:
+            self._update_catalog_metadata(update=True)
         self.seekable.close()
 
     def __iter__(self):
@@ -331,6 +906,74 @@ class Manifest(object):
         return self.current_index - len(self.deleted_indexes)
 
 
+def _has_value(counts, wanted):
+    # Values are json object keys in the statistics of a catalog
+    if not isinstance(wanted, (list, tuple, set)):
+        wanted = [wanted]
+    return any(counts.get(str(value), 0) > 0 for value in wanted)
+
+
+def _column(values):
+    """
+    Builds a NumPy array for a list of json values, numbers become numeric arrays
+    (with NaN for missing values), everything else an object array.
+    """
+    is_number = all(isinstance(value, (int, float)) or value is None for value in values)
+    if is_number and any(isinstance(value, float) for value in values):
+        return np.array([value if value is not None else np.nan for value in values], dtype=np.float64)
+    if is_number and all(value is not None for value in values):
+        dtype = bool if all(isinstance(value, bool) for value in values) else np.int64
+        return np.array(values, dtype=dtype)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+
+class CatalogCache(object):
+    """
+    Keeps up to `capacity` catalogs of a Manifest open for reading, evicting the least recently used.
+    """
+
+    def __init__(self, manifest, capacity=8):
+        self.manifest = manifest
+        self.capacity = capacity
+        self.catalogs = OrderedDict()
+
+    def read_record(self, catalog_number, line):
+        manifest = self.manifest
+        is_current = catalog_number == len(manifest.catalog_paths) - 1
+        if is_current and not manifest.read_only:
+            # Lines of the catalog being written may not be committed yet
+            manifest.current_catalog.commit()
+
+        catalog = self.catalogs.get(catalog_number)
+        if catalog is not None and line >= catalog.lines():
+            # The catalog grew since it was opened, it may have been finished since
+            self.catalogs.pop(catalog_number).close()
+            catalog = None
+        if catalog is None:
+            catalog_path = os.path.join(manifest.base_path, manifest.catalog_paths[catalog_number])
+            catalog = manifest._open_catalog(catalog_path, read_only=True)
+            self.catalogs[catalog_number] = catalog
+            if len(self.catalogs) > self.capacity:
+                _, evicted = self.catalogs.popitem(last=False)
+                evicted.close()
+        else:
+            self.catalogs.move_to_end(catalog_number)
+        return catalog.read_record_at(line)
+
+    def evict(self, catalog_number):
+        catalog = self.catalogs.pop(catalog_number, None)
+        if catalog is not None:
+            catalog.close()
+
+    def close(self):
+        for catalog in self.catalogs.values():
+            catalog.close()
+        self.catalogs.clear()
+
+
 class ManifestIterator(object):
     """
     An iterator for the Manifest type. \n
@@ -355,26 +998,31 @@ class ManifestIterator(object):
         if self.current_catalog is None:
             current_catalog_path = os.path.join(self.manifest.base_path,
                                                 self.manifest.catalog_paths[self.current_catalog_index])
-            self.current_catalog = Catalog(current_catalog_path, read_only=self.manifest.read_only)
-            self.current_catalog.seekable.seek_line_start(1)
-
-        contents = self.current_catalog.seekable.read_line()
-
-        if contents is not None and len(contents) > 0:
+            # Read only, finished catalogs can be compressed while they are read
+            self.current_catalog = self.manifest._open_catalog(current_catalog_path, read_only=True)
+            self.current_catalog.seek_record(0)
+
+        try:
+            record = self.current_catalog.read_record()
+            valid = True
+        except Exception:
+            record = dict()
+            valid = False
+
+        if record is not None:
             # Check for current_index when we are ready to advance the underlying iterator.
             current_index = self.current_index
             self.current_index += 1
             if current_index in self.manifest.deleted_indexes:
                 # Skip over index, because it has been marked deleted
                 return self.__next__()
+            elif not valid:
+                print('Ignoring record at index %s' % current_index)
+                return self.__next__()
             else:
-                try:
-                    record = json.loads(contents)
-                    return record
-                except Exception:
-                    print('Ignoring record at index %s' % current_index)
-                    return self.__next__()
+                return record
         else:
+            self.current_catalog.close()
             self.current_catalog = None
             self.current_catalog_index += 1
             return self.__next__()
@@ -383,3 +1031,173 @@ class ManifestIterator(object):
 
     def __len__(self):
         return self.manifest.__len__()
+
+
+def convert_manifest(src_path, dst_path, catalog_format=None, transform=None, drop_deleted=False):
+    """
+    Copies all records of the datastore in `src_path` into a new datastore in
+    `dst_path` that uses the given catalog format (by default the format of the source). \n
+    Record indexes and deleted indexes are preserved. With `drop_deleted`, deleted records
+    (and records that cannot be read) are left out instead, and the others are renumbered.
+    `transform(index, record)` can return a modified record to write instead, `index` is the
+    index of the record in the new datastore.
+    """
+    src = Manifest(src_path, read_only=True)
+    dst = Manifest(dst_path, inputs=src.inputs, types=src.types,
+                   metadata=list(src.metadata.items()), max_len=src.max_len,
+                   catalog_format=catalog_format or src.catalog_format,
+                   compression=src.compression if (catalog_format or src.catalog_format) == 'json' else None)
+    deleted_indexes = IndexRanges() if drop_deleted else IndexRanges(src.deleted_indexes.ranges())
+    try:
+        for catalog_path, start_index in zip(src.catalog_paths, src.catalog_start_indexes):
+            catalog = src._open_catalog(os.path.join(src.base_path, catalog_path), read_only=True)
+            try:
+                catalog.seek_record(0)
+                src_index = start_index
+                while True:
+                    index = dst.current_index
+                    try:
+                        record = catalog.read_record()
+                    except ValueError:
+                        if drop_deleted:
+                            src_index += 1
+                            continue
+                        # Keep indexes aligned, and hide the record that could not be read.
+                        record = {'_index': index}
+                        deleted_indexes.add(index)
+                    if record is None:
+                        break
+                    src_index += 1
+                    if drop_deleted:
+                        if src_index - 1 in src.deleted_indexes:
+                            continue
+                        record['_index'] = index
+                    if transform is not None:
+                        record = transform(index, record)
+                    dst.write_record(record)
+            finally:
+                catalog.close()
+        dst.deleted_indexes = deleted_indexes
+        dst._update_catalog_metadata(update=True)
+    finally:
+        src.close()
+        dst.close()
+
+
+def _link_catalog(src_path, dst_path, start_index, remap, deleted=None, copy=False):
+    """
+    Links a catalog into another datastore, see `link_or_copy`. With `copy` (for the last catalog
+    of a datastore) the whole catalog is copied. The header is written with the new start index and
+    remap, and the number of `deleted` records in the new datastore.
+    """
+    src_path = Path(src_path)
+    dst_path = Path(dst_path)
+    link = shutil.copyfile if copy else link_or_copy
+    if src_path.exists():
+        link(src_path, dst_path)
+    else:
+        link(src_path.with_suffix('.catalogz'), dst_path.with_suffix('.catalogz'))
+    heap_path = src_path.with_suffix('.binheap')
+    if heap_path.exists():
+        link(heap_path, dst_path.with_suffix('.binheap'))
+    index_path = src_path.with_suffix('.catalog_index')
+    if index_path.exists():
+        link_or_copy(index_path, dst_path.with_suffix('.catalog_index'))
+    for suffix in ('.catalog_offsets', '.catalog_patches'):
+        sidecar_path = src_path.with_suffix(suffix)
+        if sidecar_path.exists():
+            shutil.copyfile(sidecar_path, dst_path.with_suffix(suffix))
+
+    metadata = CatalogMetadata(src_path, read_only=True)
+    contents = dict(metadata.contents)
+    metadata.close()
+    contents['path'] = '%s.catalog_manifest' % dst_path.stem
+    contents['start_index'] = start_index
+    contents['remap'] = remap
+    if 'stats' in contents and deleted is not None:
+        contents['stats'] = dict(contents['stats'], deleted=deleted)
+    with open(dst_path.with_suffix('.catalog_manifest'), 'w', newline=NEWLINE) as header:
+        header.write(json.dumps(contents, allow_nan=False, sort_keys=True) + NEWLINE)
+
+
+def _remove_catalog(base_path, catalog_name):
+    stem = Path(catalog_name).stem
+    for name in os.listdir(base_path):
+        if name.startswith(stem + '.'):
+            os.remove(os.path.join(base_path, name))
+
+
+def merge_manifests(src_paths, dst_path, images_prefixes=None, select=None):
+    """
+    Creates a new datastore in `dst_path` with the records of the datastores in `src_paths`, in order. \n
+    Catalog files are hard linked (or copied), records are not parsed or rewritten. Instead the
+    header of each catalog records the offset of its record indexes and the prefix of its image
+    names (`images_prefixes`, one per datastore), which are applied when records are read.
+    The last catalog of each datastore is copied, so records written to a datastore after the
+    merge do not show up in the merged one.
+    `select(src_number, catalog)` can return a boolean array of the lines of a catalog to keep,
+    the other lines are marked as deleted, and catalogs without any line to keep are left out.
+    New records are written to a new catalog. Returns the number of records.
+    """
+    if os.path.exists(os.path.join(os.path.expanduser(dst_path), 'manifest.json')):
+        raise ValueError('A datastore already exists at %s' % dst_path)
+    srcs = [Manifest(src_path, read_only=True) for src_path in src_paths]
+    dst = None
+    try:
+        first = srcs[0]
+        for src in srcs[1:]:
+            if src.inputs != first.inputs or src.types != first.types or src.catalog_format != first.catalog_format:
+                raise ValueError('Cannot merge %s, its inputs, types or catalog format differ from %s' % (
+                    src.base_path, first.base_path))
+        image_keys = [key for key, input_type in zip(first.inputs, first.types) if input_type == 'image_array']
+        dst = Manifest(dst_path, inputs=first.inputs, types=first.types,
+                       metadata=list(first.metadata.items()), max_len=first.max_len,
+                       catalog_format=first.catalog_format, compression=first.compression)
+        # Drop the empty catalog of the new datastore, linked catalogs come first
+        dst.current_catalog.close()
+        _remove_catalog(dst.base_path, dst.catalog_paths[0])
+        dst.current_catalog = None
+        dst.catalog_paths = list()
+        dst.catalog_start_indexes = list()
+        dst.catalog_indexes = dict()
+
+        start_index = 0
+        for src_number, src in enumerate(srcs):
+            images_prefix = images_prefixes[src_number] if images_prefixes is not None else ''
+            for catalog_number, (catalog_path, src_start_index) in enumerate(zip(src.catalog_paths,
+                                                                                 src.catalog_start_indexes)):
+                src_catalog_path = os.path.join(src.base_path, catalog_path)
+                catalog = src._open_catalog(src_catalog_path, read_only=True, start_index=src_start_index)
+                try:
+                    lines = catalog.lines()
+                    keep = select(src_number, catalog) if select is not None and lines > 0 else None
+                    remap = catalog.manifest.contents.get('remap') or {'index_offset': 0, 'images_prefix': ''}
+                finally:
+                    catalog.close()
+                if lines == 0 or (keep is not None and not keep.any()):
+                    continue
+
+                remap = {
+                    'index_offset': remap['index_offset'] + start_index - src_start_index,
+                    'images_prefix': images_prefix + remap['images_prefix'],
+                    'image_keys': image_keys,
+                }
+                catalog_name = 'catalog_%s%s' % (len(dst.catalog_paths), CATALOG_EXTENSIONS[dst.catalog_format])
+                deleted = src.deleted_indexes.mask(src_start_index, src_start_index + lines)
+                if keep is not None:
+                    deleted |= ~keep
+                _link_catalog(src_catalog_path, os.path.join(dst.base_path, catalog_name), start_index, remap,
+                              deleted=int(deleted.sum()), copy=catalog_number == len(src.catalog_paths) - 1)
+                dst.catalog_paths.append(catalog_name)
+                dst.catalog_start_indexes.append(start_index)
+                dst.deleted_indexes.add_mask(start_index, deleted)
+                start_index += lines
+
+        dst.current_index = start_index
+        dst._add_catalog()
+        return len(dst)
+    finally:
+        for src in srcs:
+            src.close()
+        if dst is not None:
+            dst.close()
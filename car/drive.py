@@ -5,10 +5,11 @@ from car.vehicle import Vehicle
 from car.controller import get_js_controller
 from car.tub import TubWriter, TubHandler
 from car.controller import JoystickController
+from car.datastore import CommitPolicy
 
 
 def drive(cfg):
-    car = Vehicle()
+    car = Vehicle(profile=cfg.PROFILE_PARTS, workers=cfg.DRIVE_LOOP_WORKERS)
 
     inputs = []
 
@@ -53,19 +54,37 @@ def drive(cfg):
     # add tub to save data
     inputs = ['cam/image_array', 'user/angle', 'user/throttle', 'user/mode']
     types = ['image_array', 'float', 'float', 'str']
+    if cfg.AUTO_CREATE_NEW_TUB and cfg.TUB_COMPACT_ON_START:
+        # the tubs of previous sessions are not written to anymore
+        TubHandler(path=cfg.DATA_PATH).compact_tubs()
     # do we want to store new records into own dir or append to existing
     tub_path = TubHandler(path=cfg.DATA_PATH).create_tub_path() if cfg.AUTO_CREATE_NEW_TUB else cfg.DATA_PATH
     print('tub_path: ', cfg.DATA_PATH)
 
-    tub_writer = TubWriter(base_path=tub_path, inputs=inputs, types=types)
+    tub_writer = TubWriter(base_path=tub_path, inputs=inputs, types=types,
+                           catalog_format=cfg.TUB_CATALOG_FORMAT,
+                           queue_size=cfg.TUB_QUEUE_SIZE,
+                           queue_policy=cfg.TUB_QUEUE_POLICY,
+                           commit_policy=CommitPolicy(durability=cfg.TUB_DURABILITY,
+                                                      batch_size=cfg.TUB_COMMIT_BATCH_SIZE,
+                                                      batch_interval_ms=cfg.TUB_COMMIT_INTERVAL_MS),
+                           image_format=cfg.TUB_IMAGE_FORMAT,
+                           image_options=cfg.TUB_IMAGE_OPTIONS,
+                           image_workers=cfg.TUB_IMAGE_WORKERS,
+                           image_store=cfg.TUB_IMAGE_STORE,
+                           image_shape=(cfg.IMAGE_H, cfg.IMAGE_W, cfg.IMAGE_DEPTH),
+                           raw_frames_per_file=cfg.TUB_RAW_FRAMES_PER_FILE,
+                           catalog_compression=cfg.TUB_CATALOG_COMPRESSION)
     car.add(tub_writer, inputs=inputs, outputs=["tub/num_records"],
-            run_condition='recording')
+            run_condition='recording',
+            on_change=['cam/image_array'] if cfg.RECORD_NEW_FRAMES_ONLY else None)
 
     if isinstance(ctrl, JoystickController):
         print("You can now move your joystick to drive your car.")
-        ctrl.set_tub(tub_writer.tub)
+        ctrl.set_tub(tub_writer)
 
-    car.start(rate_hz=cfg.DRIVE_LOOP_HZ)
+    car.start(rate_hz=cfg.DRIVE_LOOP_HZ, overrun_policy=cfg.DRIVE_LOOP_OVERRUN_POLICY, spin_ms=cfg.DRIVE_LOOP_SPIN_MS,
+              max_catch_up=cfg.DRIVE_LOOP_MAX_CATCH_UP)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,478 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+# Supported image formats: (file extension, PIL format name)
+IMAGE_FORMATS = {
+    'jpg': ('.jpg', 'JPEG'),
+    'png': ('.png', 'PNG'),
+    # Raw uint8 arrays, no encoding at all
+    'npy': ('.npy', None),
+}
+NPY_MAGIC = b'\x93NUMPY'
+PNG_MAGIC = b'\x89PNG'
+CHUNK_EXTENSION = '.frames'
+RAW_EXTENSION = '.raw'
+# One byte per slot of a raw frame file, set once the frame is written
+WRITTEN_EXTENSION = '.written'
+# Frames per raw frame file, 100 frames of 160x120x3 are about 5.8 MB
+RAW_FRAMES_PER_FILE = 100
+
+
+def image_file_name(index, key, extension='.jpg'):
+    key_prefix = key.replace('/', '_')
+    name = '_'.join([str(index), key_prefix, extension])
+    # Return relative paths to maintain portability
+    return name
+
+
+def encode_image(image, image_format='jpg', image_options=None):
+    """
+    Encodes a uint8 image array, returns the encoded bytes.
+    """
+    _, pil_format = IMAGE_FORMATS[image_format]
+    contents = io.BytesIO()
+    if pil_format is None:
+        np.save(contents, image)
+    else:
+        Image.fromarray(image).save(contents, format=pil_format, **(image_options or dict()))
+    return contents.getvalue()
+
+
+def decode_image(data):
+    """
+    Decodes bytes produced by `encode_image` into a uint8 image array.
+    """
+    if data.startswith(NPY_MAGIC):
+        return np.load(io.BytesIO(data))
+    return np.asarray(Image.open(io.BytesIO(data)))
+
+
+def image_extension(data):
+    if data.startswith(NPY_MAGIC):
+        return '.npy'
+    if data.startswith(PNG_MAGIC):
+        return '.png'
+    return '.jpg'
+
+
+def raw_file_name(key, chunk_number):
+    return '%s_%s%s' % (key.replace('/', '_'), chunk_number, RAW_EXTENSION)
+
+
+def raw_written_file_name(file_name):
+    return file_name + WRITTEN_EXTENSION
+
+
+def is_chunk_reference(name):
+    return CHUNK_EXTENSION + ':' in name
+
+
+def is_raw_reference(name):
+    return RAW_EXTENSION + ':' in name
+
+
+def open_raw_frames(images_path, file_name):
+    """
+    Memory maps a raw frame file, read-only.
+    """
+    return np.load(os.path.join(images_path, file_name), mmap_mode='r')
+
+
+def writable_image_files(images_path, catalog_number, next_index):
+    """
+    Returns the names of the chunk and raw frame files in `images_path` that a store can still
+    write to, when the next record has index `next_index` and goes to catalog `catalog_number`
+    (or a later one). Image files and the other chunk and raw frame files do not change anymore.
+    """
+    names = list()
+    for name in sorted(os.listdir(images_path)):
+        stem, extension = os.path.splitext(name)
+        number = stem.rsplit('_', 1)[-1]
+        if not number.isdigit():
+            continue
+        if extension == CHUNK_EXTENSION and int(number) >= catalog_number:
+            names.append(name)
+        elif extension == RAW_EXTENSION and (int(number) + 1) * len(open_raw_frames(images_path, name)) > next_index:
+            names.append(name)
+            if os.path.exists(os.path.join(images_path, raw_written_file_name(name))):
+                names.append(raw_written_file_name(name))
+    return names
+
+
+def read_image_data(images_path, name):
+    """
+    Reads the encoded bytes of an image, `name` is an image file name, a chunk reference
+    or a raw frame reference (returned as `npy` bytes).
+    """
+    if is_raw_reference(name):
+        return encode_image(load_image(images_path, name), 'npy')
+    if is_chunk_reference(name):
+        chunk_name, offset, length = name.split(':')
+        with open(os.path.join(images_path, chunk_name), 'rb') as chunk:
+            return os.pread(chunk.fileno(), int(length), int(offset))
+    with open(os.path.join(images_path, name), 'rb') as image_file:
+        return image_file.read()
+
+
+def load_image(images_path, name):
+    """
+    Returns the image array for an image file name, a chunk reference or a raw frame reference.
+    Raw frames are returned as read-only views of the memory mapped frame file.
+    """
+    if is_raw_reference(name):
+        file_name, slot = name.split(':')
+        return open_raw_frames(images_path, file_name)[int(slot)]
+    if not is_chunk_reference(name) and name.endswith('.npy'):
+        return np.load(os.path.join(images_path, name))
+    return decode_image(read_image_data(images_path, name))
+
+
+class ImageStore(object):
+    """
+    Base class for the stores which write the image arrays of a Tub. \n
+
+    `image_format` is one of `IMAGE_FORMATS`, `image_options` are passed to
+    `PIL.Image.save` (e.g. quality, optimize, subsampling for JPEG).
+    With `workers > 0` images are encoded on a thread pool, PIL releases the GIL
+    while encoding so this uses the other cores.
+    """
+
+    def __init__(self, images_path, image_format='jpg', image_options=None, workers=0):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError('Unknown image format %s' % image_format)
+        self.images_path = images_path
+        self.image_format = image_format
+        self.extension, self.pil_format = IMAGE_FORMATS[image_format]
+        self.image_options = image_options if image_options is not None else dict()
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+
+    def put(self, index, key, value, catalog_number=0):
+        """
+        Stores the image for the record at `index`, written to catalog `catalog_number`. \n
+        Returns a `Future` with the name the catalog should refer to.
+        """
+        # Copy the frame now, the producer may reuse its buffer.
+        image = np.uint8(value)
+        if self.executor is not None:
+            return self.executor.submit(self._write, index, key, image, catalog_number)
+
+        future = Future()
+        future.set_result(self._write(index, key, image, catalog_number))
+        return future
+
+    def put_encoded(self, index, key, data, catalog_number=0):
+        """
+        Stores an already encoded image, returns the name the catalog should refer to.
+        """
+        raise NotImplementedError()
+
+    def _write(self, index, key, image, catalog_number=0):
+        return self.put_encoded(index, key, encode_image(image, self.image_format, self.image_options),
+                                catalog_number)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+class FileImageStore(ImageStore):
+    """
+    Stores each image array in its own file in the images folder.
+    """
+
+    def put_encoded(self, index, key, data, catalog_number=0):
+        name = image_file_name(index, key, image_extension(data))
+        with open(os.path.join(self.images_path, name), 'wb') as image_file:
+            image_file.write(data)
+        return name
+
+    def _write(self, index, key, image, catalog_number=0):
+        name = image_file_name(index, key, self.extension)
+        path = os.path.join(self.images_path, name)
+        if self.pil_format is None:
+            np.save(path, image)
+        else:
+            Image.fromarray(image).save(path, format=self.pil_format, **self.image_options)
+        return name
+
+
+class ChunkImageStore(ImageStore):
+    """
+    Appends encoded images to chunk files in the images folder, instead of
+    creating one file per image. \n
+
+    Images of the records of catalog N go to `chunk_N.frames`, so chunks line up with
+    the catalogs whatever their start index and length. The catalog refers to an image
+    as `chunk_N.frames:offset:length`, so reading it back is a single `pread` of the chunk.
+    """
+
+    def __init__(self, images_path, image_format='jpg', image_options=None, workers=0):
+        super(ChunkImageStore, self).__init__(images_path, image_format=image_format,
+                                              image_options=image_options, workers=workers)
+        self.chunks = dict()
+        self.lock = threading.Lock()
+
+    def put_encoded(self, index, key, data, catalog_number=0):
+        chunk_number = catalog_number
+        chunk_name = 'chunk_%s%s' % (chunk_number, CHUNK_EXTENSION)
+        with self.lock:
+            chunk = self.chunks.get(chunk_number)
+            if chunk is None:
+                chunk = open(os.path.join(self.images_path, chunk_name), 'ab')
+                self.chunks[chunk_number] = chunk
+                # Images are added in order, so older chunks are usually complete.
+                for number in list(self.chunks):
+                    if number < chunk_number:
+                        self.chunks.pop(number).close()
+            offset = chunk.tell()
+            chunk.write(data)
+            chunk.flush()
+        return '%s:%s:%s' % (chunk_name, offset, len(data))
+
+    def close(self):
+        super(ChunkImageStore, self).close()
+        with self.lock:
+            for chunk in self.chunks.values():
+                chunk.close()
+            self.chunks.clear()
+
+
+class RawImageStore(ImageStore):
+    """
+    Writes image arrays uncompressed into preallocated frame files, so training can
+    read the exact frames the car saw without decoding them. \n
+
+    Frames of `key` for the record at `index` go to slot `index % frames_per_file` of
+    `{key}_{index // frames_per_file}.raw`. Frame files use the `npy` layout with room
+    for `frames_per_file` frames of `image_shape` (taken from the first frame when not
+    given), so they can be memory mapped with `np.load(path, mmap_mode='r')`. The catalog
+    refers to a frame as `{key}_{file}.raw:slot`. \n
+    The slots that hold a frame are marked in a `.raw.written` file next to each frame
+    file, see `RawFrameReader.read`.
+    """
+
+    def __init__(self, images_path, frames_per_file=RAW_FRAMES_PER_FILE, image_shape=None):
+        # Copying a frame is cheap, there is nothing to encode on a pool.
+        super(RawImageStore, self).__init__(images_path, image_format='npy')
+        self.frames_per_file = frames_per_file
+        self.image_shape = tuple(image_shape) if image_shape is not None else None
+        self.frames = dict()
+        self.written = dict()
+        self.lock = threading.Lock()
+
+    def _frames(self, key, chunk_number):
+        frames = self.frames.get((key, chunk_number))
+        if frames is not None:
+            return frames, self.written[(key, chunk_number)]
+
+        path = os.path.join(self.images_path, raw_file_name(key, chunk_number))
+        written_path = raw_written_file_name(path)
+        if os.path.exists(path):
+            frames = np.lib.format.open_memmap(path, mode='r+')
+            if not os.path.exists(written_path):
+                # Frame files written before slots were marked, every slot counts as written
+                _create_written(written_path, len(frames), 1)
+        else:
+            # Created first, so a frame file is never without its marks
+            _create_written(written_path, self.frames_per_file, 0)
+            frames = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                               shape=(self.frames_per_file,) + self.image_shape)
+        if frames.shape[1:] != self.image_shape:
+            raise ValueError('Frame file %s holds frames of shape %s, not %s'
+                             % (path, frames.shape[1:], self.image_shape))
+        written = np.memmap(written_path, dtype=np.uint8, mode='r+')
+        # Frames are added in order, older frame files of this key are complete.
+        for frames_key, number in list(self.frames):
+            if frames_key == key and number < chunk_number:
+                self.frames.pop((frames_key, number)).flush()
+                self.written.pop((frames_key, number)).flush()
+        self.frames[(key, chunk_number)] = frames
+        self.written[(key, chunk_number)] = written
+        return frames, written
+
+    def put(self, index, key, value, catalog_number=0):
+        future = Future()
+        future.set_result(self._write(index, key, np.asarray(value)))
+        return future
+
+    def put_encoded(self, index, key, data, catalog_number=0):
+        return self._write(index, key, decode_image(data))
+
+    def _write(self, index, key, image, catalog_number=0):
+        with self.lock:
+            if self.image_shape is None:
+                self.image_shape = image.shape
+            chunk_number, slot = divmod(index, self.frames_per_file)
+            frames, written = self._frames(key, chunk_number)
+            # Mono frames may come without their depth axis
+            frames[slot] = image.reshape(self.image_shape)
+            written[slot] = 1
+        return '%s:%s' % (raw_file_name(key, chunk_number), slot)
+
+    def close(self):
+        super(RawImageStore, self).close()
+        with self.lock:
+            for frames in self.frames.values():
+                frames.flush()
+            for written in self.written.values():
+                written.flush()
+            self.frames.clear()
+            self.written.clear()
+
+
+def _create_written(written_path, frames_per_file, value):
+    with open(written_path, 'wb') as written_file:
+        written_file.write(bytes([value]) * frames_per_file)
+
+
+class RawFrameReader(object):
+    """
+    Reads frames written by a `RawImageStore`, keeping the last `max_open_files` frame
+    files memory mapped. A contiguous range of slots within a frame file is returned as
+    a zero-copy view, other batches are gathered with a single copy and no decoding.
+    """
+
+    def __init__(self, images_path, max_open_files=16):
+        self.images_path = images_path
+        self.max_open_files = max_open_files
+        self.files = OrderedDict()
+        self.written = dict()
+        self.frames_per_file = dict()
+
+    def frames(self, file_name):
+        frames = self.files.get(file_name)
+        if frames is None:
+            frames = open_raw_frames(self.images_path, file_name)
+            self.files[file_name] = frames
+            if len(self.files) > self.max_open_files:
+                # Views returned earlier keep their own reference to the map
+                evicted, _ = self.files.popitem(last=False)
+                self.written.pop(evicted, None)
+        else:
+            self.files.move_to_end(file_name)
+        return frames
+
+    def _written(self, file_name):
+        # The marks of the slots written so far, `None` for frame files written before slots were marked
+        if file_name not in self.written:
+            written_path = os.path.join(self.images_path, raw_written_file_name(file_name))
+            self.written[file_name] = np.memmap(written_path, dtype=np.uint8, mode='r') \
+                if os.path.exists(written_path) else None
+        return self.written[file_name]
+
+    def _frames_per_file(self, key):
+        # Every frame file of a key has room for the same number of frames
+        frames_per_file = self.frames_per_file.get(key)
+        if frames_per_file is None:
+            prefix = raw_file_name(key, '')[:-len(RAW_EXTENSION)]
+            for file_name in sorted(os.listdir(self.images_path)):
+                if file_name.startswith(prefix) and file_name.endswith(RAW_EXTENSION) \
+                        and file_name[len(prefix):-len(RAW_EXTENSION)].isdigit():
+                    frames_per_file = len(self.frames(file_name))
+                    break
+            if frames_per_file is None:
+                raise ValueError('No raw frames of %s in %s' % (key, self.images_path))
+            self.frames_per_file[key] = frames_per_file
+        return frames_per_file
+
+    def read(self, key, indexes):
+        """
+        Returns the frames of `key` for the given record indexes. Raises an `IndexError`
+        for a record whose frame was never written.
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        chunk_numbers, slots = np.divmod(indexes, self._frames_per_file(key))
+        file_names = np.array([raw_file_name(key, chunk_number) for chunk_number in chunk_numbers])
+        for file_name in np.unique(file_names):
+            mask = file_names == file_name
+            if not os.path.exists(os.path.join(self.images_path, file_name)):
+                raise IndexError('No frame of %s for record %s' % (key, indexes[mask][0]))
+            written = self._written(file_name)
+            if written is not None and not written[slots[mask]].all():
+                missing = indexes[mask][written[slots[mask]] == 0]
+                raise IndexError('No frame of %s for record %s' % (key, missing[0]))
+        return self._gather(file_names, slots)
+
+    def read_references(self, names):
+        """
+        Returns the frames for a list of raw frame references.
+        """
+        references = [name.split(':') for name in names]
+        file_names = np.array([file_name for file_name, _ in references])
+        slots = np.array([int(slot) for _, slot in references], dtype=np.int64)
+        return self._gather(file_names, slots)
+
+    def _gather(self, file_names, slots):
+        if len(slots) == 0:
+            return np.zeros((0,), dtype=np.uint8)
+        first_file = file_names[0]
+        if np.all(file_names == first_file) and np.all(np.diff(slots) == 1):
+            return self.frames(first_file)[slots[0]:slots[-1] + 1]
+
+        batch = None
+        for file_name in np.unique(file_names):
+            frames = self.frames(file_name)
+            if batch is None:
+                batch = np.empty((len(slots),) + frames.shape[1:], dtype=frames.dtype)
+            mask = file_names == file_name
+            batch[mask] = frames[slots[mask]]
+        return batch
+
+    def close(self):
+        self.files.clear()
+        self.written.clear()
+
+
+def load_images(images_path, names, raw_reader=None):
+    """
+    Returns a batch of image arrays for a list of image names. \n
+    Raw frame references are read through `raw_reader` without decoding,
+    other images are decoded one by one. Missing images (`None` names, e.g. when
+    writing the image failed) are zero frames.
+    """
+    present = [position for position, name in enumerate(names) if name is not None]
+    if len(present) < len(names):
+        if len(present) == 0:
+            return np.zeros((len(names), 0), dtype=np.uint8)
+        images = load_images(images_path, [names[position] for position in present], raw_reader=raw_reader)
+        batch = np.zeros((len(names),) + images.shape[1:], dtype=images.dtype)
+        batch[present] = images
+        return batch
+    if len(names) > 0 and all(is_raw_reference(name) for name in names):
+        if raw_reader is None:
+            raw_reader = RawFrameReader(images_path)
+        return raw_reader.read_references(names)
+    return np.stack([load_image(images_path, name) for name in names])
+
+
+class LazyImageArray(object):
+    """
+    An array like view over the images of a tub, images are only read when indexed. \n
+    Supports `len()`, integer indexes, slices and index arrays. Missing images are `None`
+    when indexed one at a time, and zero frames in batches.
+    """
+
+    def __init__(self, images_path, names, raw_reader=None):
+        self.images_path = images_path
+        self.names = names
+        self.raw_reader = raw_reader if raw_reader is not None else RawFrameReader(images_path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            name = self.names[key]
+            return load_image(self.images_path, name) if name is not None else None
+        return load_images(self.images_path, list(self.names[key]), raw_reader=self.raw_reader)
+
+    def __array__(self, dtype=None, copy=None):
+        images = self[np.arange(len(self))]
+        return images.astype(dtype) if dtype is not None else images
@@ -0,0 +1,276 @@
+import multiprocessing
+import os
+import queue
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from car.images import load_image
+from car.tub import Tub
+
+
+class TubLoader(object):
+    """
+    Streams shuffled training batches from one or more tubs. \n
+    Records are split into blocks of consecutive records, blocks are shuffled every epoch
+    and dealt to `workers` processes. Each worker reads its blocks, decodes the images,
+    shuffles records through a buffer of `shuffle_buffer` records and ships batches back
+    through shared memory. Every worker keeps up to `prefetch` batches ready. \n
+    Batches are dictionaries of NumPy arrays, one per key. For a given `seed` and epoch the
+    batches are the same, whatever the timing of the workers. With `workers=0` (the default)
+    batches are read in the calling process, worker processes only pay off when decoding
+    images keeps more than one core busy. Records without an image (e.g. when writing the
+    image failed) are skipped.
+    """
+
+    def __init__(self, tub_paths, keys=None, batch_size=64, workers=0, shuffle_buffer=1000,
+                 block_len=100, prefetch=2, seed=0, drop_last=False):
+        assert batch_size > 0, 'batch_size must be positive'
+        assert workers >= 0, 'workers must not be negative'
+        assert prefetch > 0, 'prefetch must be positive'
+        self.tub_paths = list(tub_paths)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.shuffle_buffer = max(shuffle_buffer, 1)
+        self.block_len = max(block_len, 1)
+        self.prefetch = prefetch
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        self.lengths = list()
+        types = dict()
+        for tub_path in self.tub_paths:
+            tub = Tub(tub_path, read_only=True)
+            self.lengths.append(len(tub))
+            types.update(zip(tub.manifest.inputs, tub.manifest.types))
+            tub.close()
+        self.keys = list(keys) if keys is not None else list(types.keys())
+        self.image_keys = [key for key in self.keys if types.get(key) == 'image_array']
+
+    def __len__(self):
+        # An estimate with several workers, every worker ends its shard with a partial batch
+        records = sum(self.lengths)
+        if self.drop_last:
+            return records // self.batch_size
+        return (records + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        self.epoch += 1
+        return batches
+
+    def blocks(self, epoch):
+        """
+        Returns the shuffled `(tub_number, start, end)` blocks of record positions for an epoch.
+        """
+        blocks = list()
+        for tub_number, length in enumerate(self.lengths):
+            for start in range(0, length, self.block_len):
+                blocks.append((tub_number, start, min(start + self.block_len, length)))
+        random = np.random.default_rng((self.seed, epoch))
+        return [blocks[i] for i in random.permutation(len(blocks))]
+
+    def batches(self, epoch):
+        """
+        Yields the batches of an epoch.
+        """
+        blocks = self.blocks(epoch)
+        if self.workers == 0:
+            settings = self._settings(blocks, epoch, 0)
+            for batch in _read_batches(settings):
+                yield batch
+            return
+
+        context = multiprocessing.get_context()
+        stop = context.Event()
+        queues = [context.Queue(maxsize=self.prefetch) for _ in range(self.workers)]
+        processes = list()
+        for worker in range(self.workers):
+            settings = self._settings(blocks[worker::self.workers], epoch, worker)
+            process = context.Process(target=_worker, args=(settings, queues[worker], stop), daemon=True)
+            process.start()
+            processes.append(process)
+
+        try:
+            # Round robin over the workers, so the order of batches does not depend on timing
+            running = list(range(self.workers))
+            while len(running) > 0:
+                for worker in list(running):
+                    message = queues[worker].get()
+                    if message is None:
+                        running.remove(worker)
+                    elif isinstance(message, BaseException):
+                        raise message
+                    else:
+                        yield _from_shared_memory(message)
+        finally:
+            stop.set()
+            for process, worker_queue in zip(processes, queues):
+                _discard(process, worker_queue)
+
+    def _settings(self, blocks, epoch, worker):
+        return {
+            'tub_paths': self.tub_paths,
+            'blocks': blocks,
+            'keys': self.keys,
+            'image_keys': self.image_keys,
+            'batch_size': self.batch_size,
+            'shuffle_buffer': self.shuffle_buffer,
+            'drop_last': self.drop_last,
+            'seed': (self.seed, epoch, worker),
+        }
+
+
+def _read_batches(settings):
+    """
+    Reads the blocks of a worker, and yields shuffled batches.
+    """
+    tubs = dict()
+    random = np.random.default_rng(settings['seed'])
+    batch_size = settings['batch_size']
+    buffer = list()
+    batch = list()
+
+    def _records():
+        for tub_number, start, end in settings['blocks']:
+            tub = tubs.get(tub_number)
+            if tub is None:
+                tub = Tub(settings['tub_paths'][tub_number], read_only=True)
+                tubs[tub_number] = tub
+            for record in tub.get_batch(range(start, end)):
+                if any(record.get(key) is None for key in settings['image_keys']):
+                    continue
+                for key in settings['image_keys']:
+                    record[key] = load_image(tub.images_base_path, record[key])
+                yield record
+
+    try:
+        for record in _records():
+            if len(buffer) < settings['shuffle_buffer']:
+                buffer.append(record)
+                continue
+            # Swap a random buffered record out for the new one
+            position = random.integers(len(buffer))
+            batch.append(buffer[position])
+            buffer[position] = record
+            if len(batch) == batch_size:
+                yield _to_batch(batch, settings['keys'])
+                batch = list()
+
+        random.shuffle(buffer)
+        for record in buffer:
+            batch.append(record)
+            if len(batch) == batch_size:
+                yield _to_batch(batch, settings['keys'])
+                batch = list()
+        if len(batch) > 0 and not settings['drop_last']:
+            yield _to_batch(batch, settings['keys'])
+    finally:
+        for tub in tubs.values():
+            tub.close()
+
+
+def _to_batch(records, keys):
+    batch = dict()
+    for key in keys:
+        values = [record.get(key) for record in records]
+        if all(isinstance(value, np.ndarray) for value in values):
+            batch[key] = np.stack(values)
+        elif all(isinstance(value, (int, float)) for value in values):
+            batch[key] = np.array(values)
+        else:
+            column = np.empty(len(values), dtype=object)
+            column[:] = values
+            batch[key] = column
+    return batch
+
+
+def _worker(settings, worker_queue, stop):
+    try:
+        for batch in _read_batches(settings):
+            message = _to_shared_memory(batch)
+            if not _put(worker_queue, message, stop):
+                _unlink(message[0])
+                return
+        _put(worker_queue, None, stop)
+    except BaseException as exception:
+        _put(worker_queue, exception, stop)
+
+
+def _put(worker_queue, message, stop):
+    # Waits for room in the queue, unless the reader has stopped
+    while not stop.is_set():
+        try:
+            worker_queue.put(message, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _to_shared_memory(batch):
+    """
+    Copies the numeric arrays of a batch into a shared memory block, and returns a
+    small picklable description of the batch. Object arrays are sent as they are.
+    """
+    layout = list()
+    others = dict()
+    size = 0
+    for key, values in batch.items():
+        if values.dtype == object:
+            others[key] = values
+            continue
+        layout.append((key, values.dtype.str, values.shape, size))
+        size += values.nbytes
+
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    # The reader owns the block from now on, it must outlive this process. The resource
+    # tracker only tracks POSIX blocks, by their name with a leading slash.
+    if os.name == 'posix':
+        resource_tracker.unregister('/' + block.name, 'shared_memory')
+    for key, dtype, shape, offset in layout:
+        target = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+        target[...] = batch[key]
+        del target
+    name = block.name
+    block.close()
+    return name, layout, others
+
+
+def _from_shared_memory(message):
+    name, layout, others = message
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        batch = dict()
+        for key, dtype, shape, offset in layout:
+            batch[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset).copy()
+        batch.update(others)
+        return batch
+    finally:
+        block.close()
+        block.unlink()
+
+
+def _unlink(name):
+    try:
+        block = shared_memory.SharedMemory(name=name)
+        block.close()
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _discard(process, worker_queue):
+    # Releases the shared memory of batches that were never read, until the worker is done
+    while True:
+        try:
+            message = worker_queue.get(timeout=0.1)
+        except queue.Empty:
+            if not process.is_alive():
+                break
+            continue
+        if isinstance(message, tuple):
+            _unlink(message[0])
+    process.join()
+    worker_queue.close()
@@ -1,9 +1,19 @@
 class Memory:
     """
-    A convenience class to save key/value pairs.
+    A convenience class to save key/value pairs. \n
+    Every key has a version, which goes up when a new value is written (a different object,
+    or a different number or string), so parts can tell whether their inputs changed.
     """
     def __init__(self, *args, **kw):
         self.d = {}
+        self.versions = {}
+        self.writes = {}
+
+    def _set(self, key, value):
+        self.writes[key] = self.writes.get(key, 0) + 1
+        if key not in self.d or _changed(self.d[key], value):
+            self.versions[key] = self.versions.get(key, 0) + 1
+        self.d[key] = value
 
     def __setitem__(self, key, value):
         if type(key) is not tuple:
@@ -12,7 +22,7 @@ class Memory:
             value = (value,)
 
         for i, k in enumerate(key):
-            self.d[k] = value[i]
+            self._set(k, value[i])
 
     def __getitem__(self, key):
         if type(key) is tuple:
@@ -21,24 +31,34 @@ class Memory:
             return self.d[key]
 
     def update(self, new_d):
-        self.d.update(new_d)
+        for key, value in new_d.items():
+            self._set(key, value)
 
     def put(self, keys, inputs):
         if len(keys) > 1:
             for i, key in enumerate(keys):
                 try:
-                    self.d[key] = inputs[i]
+                    self._set(key, inputs[i])
                 except IndexError as e:
                     error = str(e) + ' issue with keys: ' + str(key)
                     raise IndexError(error)
 
         else:
-            self.d[keys[0]] = inputs
+            self._set(keys[0], inputs)
 
     def get(self, keys):
         result = [self.d.get(k) for k in keys]
         return result
 
+    def get_versions(self, keys):
+        return [self.versions.get(k, 0) for k in keys]
+
+    def stats(self):
+        """
+        Returns the version (the number of changes) and the number of writes of every key.
+        """
+        return {key: {'version': self.versions.get(key, 0), 'writes': writes} for key, writes in self.writes.items()}
+
     def keys(self):
         return self.d.keys()
 
@@ -47,3 +67,13 @@ class Memory:
 
     def items(self):
         return self.d.items()
+
+
+def _changed(old, new):
+    if new is old:
+        return False
+    # Numbers and strings are compared by value, anything else (e.g. frames) by identity
+    if type(new) is type(old) and type(new) in (int, float, str, bool):
+        # NaN != NaN, a part that keeps writing NaN has not changed its output
+        return not (new == old or (new != new and old != old))
+    return True
@@ -23,6 +23,11 @@ THROTTLE_REVERSE_PWM = 330
 # VEHICLE
 DRIVE_LOOP_HZ = 30
 MAX_LOOPS = 220
+DRIVE_LOOP_OVERRUN_POLICY = 'skip'  # (skip|catch_up|degrade) what the drive loop does after a loop took longer than its period
+DRIVE_LOOP_MAX_CATCH_UP = 10        # with the catch_up policy, at most this many missed loops run back to back, older ones are skipped
+DRIVE_LOOP_SPIN_MS = 0              # when > 0, busy wait this many milliseconds before each loop for lower jitter, at the cost of CPU time
+DRIVE_LOOP_WORKERS = 0              # when > 0, parts that do not share inputs and outputs run concurrently on this many threads
+PROFILE_PARTS = False               # record how long each part takes to get its inputs, run and put its outputs, reported when the vehicle stops
 
 # JOYSTICK
 USE_JOYSTICK_AS_DEFAULT = True  # when starting the manage.py, when True, will not require a --js option to use the joystick
@@ -48,4 +53,18 @@ CAMERA_HFLIP = False
 
 # RECORD OPTIONS
 RECORD_DURING_AI = False
+RECORD_NEW_FRAMES_ONLY = False  # only write a record when the camera has a new frame, instead of once per drive loop
 AUTO_CREATE_NEW_TUB = False     # create a new tub (tub_YY_MM_DD) directory when recording or append records to data directory directly
+TUB_CATALOG_FORMAT = 'json'     # (json|binary) binary stores records as fixed width rows which are much cheaper to write and read back
+TUB_CATALOG_COMPRESSION = None  # (None|zlib|zstd) compress json catalogs on a background thread once they are full, zstd needs the zstandard package
+TUB_QUEUE_SIZE = 0              # when > 0 records are written by a background thread, through a queue of this size
+TUB_QUEUE_POLICY = 'block'      # (block|drop_oldest|drop_newest) what to do when the tub writer queue is full
+TUB_DURABILITY = 'flush'        # (none|flush|fsync) how tub writes are committed to disk, once per batch
+TUB_COMMIT_BATCH_SIZE = 1       # number of records per commit, a crash can lose up to one batch of records
+TUB_COMMIT_INTERVAL_MS = None   # also commit when a batch is older than this many milliseconds
+TUB_IMAGE_FORMAT = 'jpg'        # (jpg|png|npy) how camera images are stored, npy keeps the raw uint8 array
+TUB_IMAGE_OPTIONS = {}          # passed to PIL Image.save, e.g. {'quality': 90, 'optimize': True, 'subsampling': 0}
+TUB_IMAGE_WORKERS = 0           # when > 0 images are encoded on this many threads, off the drive loop thread
+TUB_IMAGE_STORE = 'files'       # (files|chunks|raw) chunks appends images to one file per catalog instead of one file per image, raw keeps uncompressed frames of IMAGE_H x IMAGE_W x IMAGE_DEPTH in memory mappable files
+TUB_RAW_FRAMES_PER_FILE = 100   # frames per memory mapped file with TUB_IMAGE_STORE = 'raw', each file is preallocated
+TUB_COMPACT_ON_START = False    # remove deleted records and their images from the tubs in DATA_PATH before driving, when AUTO_CREATE_NEW_TUB
@@ -0,0 +1,241 @@
+from array import array
+
+import numpy as np
+
+# Values below 2 ** SUB_BITS nanoseconds have their own bucket, larger values share
+# 2 ** SUB_BITS buckets per power of two, i.e. they are recorded within 1 / 2 ** SUB_BITS.
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+# Up to 2 ** 40 ns (about 18 minutes), larger values are clamped
+MAX_SHIFT = 40 - SUB_BITS
+BUCKETS = (MAX_SHIFT + 2) * SUB_BUCKETS
+# Durations are buffered, and added to the histograms every this many loops
+FLUSH_LOOPS = 2048
+
+
+def _buckets(values):
+    """
+    Returns the bucket of each value of an array of non negative durations.
+    """
+    # frexp returns the bit length of integers below 2 ** 53
+    _, bit_lengths = np.frexp(values.astype(np.float64))
+    shifts = np.maximum(bit_lengths.astype(np.int64) - SUB_BITS - 1, 0)
+    buckets = np.where(values < SUB_BUCKETS, values, (shifts << SUB_BITS) + (values >> shifts))
+    return np.where(shifts > MAX_SHIFT, BUCKETS - 1, buckets)
+
+
+class LatencyHistogram:
+    """
+    A fixed size histogram of durations in nanoseconds, with HDR style log-linear buckets.
+    Recording a value is a few integer operations (`record_many()` records an array of
+    values at once), memory does not grow with the number of values, and percentiles are
+    computed from the buckets when asked for.
+    """
+
+    def __init__(self):
+        self.counts = array('Q', [0] * BUCKETS)
+        self.total = 0
+
+    def record(self, value):
+        self.total += value
+        if value < SUB_BUCKETS:
+            self.counts[value] += 1
+            return
+        shift = value.bit_length() - SUB_BITS - 1
+        if shift > MAX_SHIFT:
+            self.counts[-1] += 1
+        else:
+            self.counts[(shift << SUB_BITS) + (value >> shift)] += 1
+
+    def record_many(self, values):
+        values = np.maximum(np.asarray(values, dtype=np.int64), 0)
+        if len(values) == 0:
+            return
+        self.add(np.bincount(_buckets(values), minlength=BUCKETS), int(values.sum()))
+
+    def add(self, counts, total):
+        """
+        Adds the bucket counts and the total of other durations.
+        """
+        self.total += total
+        buckets = np.frombuffer(self.counts, dtype=np.uint64)
+        buckets += np.asarray(counts).astype(np.uint64)
+
+    @staticmethod
+    def _bucket_value(bucket):
+        # The middle of the range of values recorded in a bucket
+        if bucket < SUB_BUCKETS:
+            return bucket
+        shift = (bucket >> SUB_BITS) - 1
+        low = (bucket - (shift << SUB_BITS)) << shift
+        return low + ((1 << shift) >> 1)
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentiles(self, percentiles):
+        """
+        Returns the value of each percentile, in nanoseconds (0 when nothing was recorded).
+        """
+        count = self.count()
+        values = dict()
+        bucket = 0
+        seen = self.counts[0]
+        for percentile in sorted(percentiles):
+            rank = min(count, max(1, int(count * percentile / 100.0 + 0.5)))
+            while seen < rank and bucket < len(self.counts) - 1:
+                bucket += 1
+                seen += self.counts[bucket]
+            values[percentile] = self._bucket_value(bucket) if count > 0 else 0
+        return [values[percentile] for percentile in percentiles]
+
+    def snapshot(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        Returns the count, mean, max and percentiles, in microseconds.
+        """
+        count = self.count()
+        maximum = 0
+        for bucket in range(len(self.counts) - 1, -1, -1):
+            if self.counts[bucket] > 0:
+                maximum = self._bucket_value(bucket)
+                break
+        snapshot = {
+            'count': count,
+            'mean_us': self.total / count / 1e3 if count > 0 else 0.0,
+            'max_us': maximum / 1e3,
+        }
+        for percentile, value in zip(percentiles, self.percentiles(percentiles)):
+            snapshot['p%s_us' % percentile] = value / 1e3
+        return snapshot
+
+    def reset(self):
+        for bucket in range(len(self.counts)):
+            self.counts[bucket] = 0
+        self.total = 0
+
+
+class PartStats:
+    """
+    The time a part takes (`part`, every run), and of the sampled runs the time it spends
+    reading its inputs from memory (`get`), running (`run`) and writing its outputs to
+    memory (`put`). \n
+    The vehicle appends durations to the `durations` and `phases` lists, they are added
+    to the histograms by `flush()`, which empties the lists in place.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.part = LatencyHistogram()
+        self.get = LatencyHistogram()
+        self.run = LatencyHistogram()
+        self.put = LatencyHistogram()
+        self.durations = []
+        self.phases = []
+
+    def record(self, start, got, ran, put):
+        """
+        Records the phases of a sampled run, from `perf_counter_ns()` timestamps taken before
+        reading its inputs, after reading them, after running the part, and after writing its outputs.
+        """
+        self.phases.extend((got - start, ran - got, put - ran))
+
+    def flush(self):
+        durations = np.array(self.durations, dtype=np.int64)
+        del self.durations[:len(durations)]
+        phases = np.array(self.phases[:len(self.phases) // 3 * 3], dtype=np.int64)
+        del self.phases[:len(phases)]
+        if len(durations) + len(phases) == 0:
+            return
+        # The buckets of the four histograms are counted in one pass
+        values = np.maximum(np.concatenate((durations, phases)), 0)
+        histograms = np.concatenate((np.zeros(len(durations), dtype=np.int64),
+                                     np.tile(np.array([1, 2, 3]), len(phases) // 3)))
+        counts = np.bincount(histograms * BUCKETS + _buckets(values), minlength=4 * BUCKETS)
+        totals = [int(values[:len(durations)].sum())] + \
+            [int(total) for total in values[len(durations):].reshape(-1, 3).sum(axis=0)]
+        for number, histogram in enumerate((self.part, self.get, self.run, self.put)):
+            histogram.add(counts[number * BUCKETS:(number + 1) * BUCKETS], totals[number])
+
+    def snapshot(self):
+        self.flush()
+        return {
+            'part': self.part.snapshot(),
+            'get': self.get.snapshot(),
+            'run': self.run.snapshot(),
+            'put': self.put.snapshot(),
+        }
+
+    def reset(self):
+        del self.durations[:]
+        del self.phases[:]
+        self.part.reset()
+        self.get.reset()
+        self.run.reset()
+        self.put.reset()
+
+
+class PartProfiler:
+    """
+    Keeps a `PartStats` for every part of a vehicle, and the duration of whole loops.
+    `snapshot()` and `report()` can be called while the vehicle runs. \n
+    Parts are timed with one timestamp per part, the end of a part is the start of the next
+    one. Reading the clock four times per part to split the `get`, `run` and `put` phases
+    is only done once every `sample_every` loops.
+    """
+
+    def __init__(self, sample_every=32):
+        assert sample_every > 0, 'sample_every must be > 0: %r' % sample_every
+        self.parts = []
+        self.loop = LatencyHistogram()
+        self.overruns = 0
+        self.sample_every = sample_every
+        self.loops = 0
+
+    def add_part(self, name):
+        stats = PartStats(name)
+        self.parts.append(stats)
+        return stats
+
+    def next_loop(self):
+        """
+        Called at the start of every loop, returns whether the phases of the parts are sampled.
+        """
+        self.loops += 1
+        if self.loops % FLUSH_LOOPS == 0:
+            for stats in self.parts:
+                stats.flush()
+        return self.loops % self.sample_every == 0
+
+    def on_loop(self, duration_ns, period_ns):
+        self.loop.record(duration_ns)
+        if duration_ns > period_ns:
+            self.overruns += 1
+
+    def snapshot(self):
+        return {
+            'parts': {stats.name: stats.snapshot() for stats in self.parts},
+            'loop': self.loop.snapshot(),
+            'overruns': self.overruns,
+        }
+
+    def reset(self):
+        for stats in self.parts:
+            stats.reset()
+        self.loop.reset()
+        self.overruns = 0
+        self.loops = 0
+
+    def report(self):
+        print('Part Profile Summary: (times in us)')
+        print('%-24s %-5s %8s %9s %9s %9s %9s %9s %9s' % (
+            'part', '', 'count', 'mean', '50%', '90%', '99%', '99.9%', 'max'))
+        rows = [(stats.name, stats.snapshot()) for stats in self.parts]
+        rows.append(('loop', {'': self.loop.snapshot()}))
+        for name, phases in rows:
+            for phase, snapshot in phases.items():
+                if snapshot['count'] == 0:
+                    continue
+                print('%-24s %-5s %8d %9.1f %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+                    name, phase, snapshot['count'], snapshot['mean_us'], snapshot['p50_us'],
+                    snapshot['p90_us'], snapshot['p99_us'], snapshot['p99.9_us'], snapshot['max_us']))
+        print('loop overruns: %d' % self.overruns)
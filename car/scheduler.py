@@ -0,0 +1,104 @@
+import time
+from array import array
+
+
+class LoopScheduler:
+    """
+    Paces a loop at `rate_hz` against absolute deadlines on the monotonic clock, so the
+    loop does not drift and is not affected by wall clock changes (e.g. NTP). \n
+
+    `overrun_policy` decides what happens when a loop ends after the next deadline:
+    `skip`: the deadlines that were missed are skipped, the loop stays on its grid.
+    `catch_up`: the missed loops run back to back, until the loop is back on time. When
+    more than `max_catch_up` loops are missed (e.g. after a stall), the older ones are
+    skipped, so at most `max_catch_up` loops run back to back.
+    `degrade`: the next deadline is one period from now, the rate drops while loops overrun.
+
+    With `spin_ms > 0`, `wait()` sleeps until `spin_ms` before the deadline and busy waits
+    for the rest, which trades CPU time for sub millisecond jitter. The lateness of the last
+    `history` loops is kept for `stats()`.
+    """
+
+    POLICIES = ('skip', 'catch_up', 'degrade')
+
+    def __init__(self, rate_hz, overrun_policy='skip', spin_ms=0, history=1000, max_catch_up=10):
+        if overrun_policy not in LoopScheduler.POLICIES:
+            raise ValueError('Unknown overrun policy %s' % overrun_policy)
+        assert rate_hz > 0, 'rate_hz must be > 0: %r' % rate_hz
+        assert max_catch_up >= 0, 'max_catch_up must be >= 0: %r' % max_catch_up
+        self.period_ns = int(1e9 / rate_hz)
+        self.overrun_policy = overrun_policy
+        self.max_catch_up = max_catch_up
+        self.spin_ns = int(spin_ms * 1e6)
+        self.jitter_ns = array('q', [0] * history)
+        self.start_ns = None
+        self.deadline_ns = None
+        self.loops = 0
+        self.overruns = 0
+        self.skipped = 0
+
+    def start(self):
+        self.start_ns = time.perf_counter_ns()
+        self.deadline_ns = self.start_ns
+        self.loops = 0
+        self.overruns = 0
+        self.skipped = 0
+
+    def wait(self):
+        """
+        Waits for the start of the next loop, call it at the end of every loop.
+        """
+        if self.start_ns is None:
+            self.start()
+        self.deadline_ns += self.period_ns
+        now = time.perf_counter_ns()
+        if now > self.deadline_ns:
+            self.overruns += 1
+            # Every deadline up to now is missed
+            missed = (now - self.deadline_ns) // self.period_ns + 1
+            if self.overrun_policy == 'catch_up':
+                # The loops of the last `max_catch_up` missed deadlines still run
+                missed = max(0, missed - self.max_catch_up)
+            if self.overrun_policy in ('skip', 'catch_up'):
+                # The next loop starts on the deadline after the skipped ones
+                self.skipped += missed
+                self.deadline_ns += missed * self.period_ns
+            elif self.overrun_policy == 'degrade':
+                self.deadline_ns = now
+        self._sleep_until(self.deadline_ns, now)
+        now = time.perf_counter_ns()
+        self.jitter_ns[self.loops % len(self.jitter_ns)] = now - self.deadline_ns
+        self.loops += 1
+
+    def _sleep_until(self, deadline_ns, now):
+        sleep_ns = deadline_ns - now - self.spin_ns
+        if sleep_ns > 0:
+            time.sleep(sleep_ns / 1e9)
+        if self.spin_ns > 0:
+            while time.perf_counter_ns() < deadline_ns:
+                pass
+
+    def stats(self):
+        """
+        Returns the number of loops, overruns and skipped loops, the achieved rate, and
+        percentiles of how late loops started (in microseconds), over the last loops.
+        """
+        count = min(self.loops, len(self.jitter_ns))
+        jitter = sorted(self.jitter_ns[:count])
+        elapsed_s = (time.perf_counter_ns() - self.start_ns) / 1e9 if self.start_ns is not None else 0
+
+        def percentile(value):
+            if count == 0:
+                return 0.0
+            return jitter[min(count - 1, int(count * value / 100.0))] / 1e3
+
+        return {
+            'loops': self.loops,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'rate_hz': self.loops / elapsed_s if elapsed_s > 0 else 0.0,
+            'jitter_p50_us': percentile(50),
+            'jitter_p90_us': percentile(90),
+            'jitter_p99_us': percentile(99),
+            'jitter_max_us': jitter[-1] / 1e3 if count > 0 else 0.0,
+        }
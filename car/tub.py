@@ -1,39 +1,78 @@
 import atexit
 import os
+import shutil
+import threading
 import time
 import datetime
+import traceback
+from collections import deque
 import numpy as np
-from PIL import Image
 
-from car.datastore import Manifest, ManifestIterator
+from car.catalog_base import link_or_copy
+from car.datastore import Manifest, ManifestIterator, convert_manifest, merge_manifests
+from car.images import RAW_FRAMES_PER_FILE, ChunkImageStore, FileImageStore, LazyImageArray, RawFrameReader, \
+    RawImageStore, image_file_name, is_chunk_reference, is_raw_reference, open_raw_frames, read_image_data, \
+    writable_image_files
 
 
 class Tub(object):
     """
     A datastore to store sensor data in a key, value format. \n
     Accepts str, int, float, image_array, image, and array data types.
+
+    Image arrays are encoded using `image_format` and `image_options`, and stored
+    one file per image (`image_store='files'`) or appended to chunk files that line
+    up with the catalogs (`image_store='chunks'`). With `image_workers > 0` they are
+    encoded on a thread pool, and records are added to the catalog in order once
+    their images are written. `image_store='raw'` keeps the uint8 frames of
+    `image_shape` uncompressed in memory mapped files of `raw_frames_per_file` frames,
+    see `load_frames()`.
+    Finished json catalogs are compressed with `catalog_compression` (`zlib` or `zstd`).
     """
 
     def __init__(self, base_path, inputs=[], types=[], metadata=[],
-                 max_catalog_len=1000, read_only=False):
+                 max_catalog_len=1000, read_only=False, catalog_format='json',
+                 commit_policy=None, image_format='jpg', image_options=None, image_workers=0,
+                 image_store='files', image_shape=None, catalog_compression=None,
+                 raw_frames_per_file=RAW_FRAMES_PER_FILE):
         self.base_path = base_path
+        recover_compaction(os.path.normpath(os.path.expanduser(base_path)))
         self.images_base_path = os.path.join(self.base_path, Tub.images())
         self.inputs = inputs
         self.types = types
         self.metadata = metadata
         self.manifest = Manifest(base_path, inputs=inputs, types=types,
                                  metadata=metadata, max_len=max_catalog_len,
-                                 read_only=read_only)
+                                 read_only=read_only, catalog_format=catalog_format,
+                                 commit_policy=commit_policy, compression=catalog_compression)
         self.input_types = dict(zip(self.inputs, self.types))
+        # Records can be written from a background writer, while records are deleted
+        # from a controller thread.
+        self.lock = threading.RLock()
         # Create images folder if necessary
         if not os.path.exists(self.images_base_path):
             os.makedirs(self.images_base_path, exist_ok=True)
+        self.image_store = Tub._image_store(image_store, self.images_base_path,
+                                            image_format=image_format, image_options=image_options,
+                                            workers=image_workers, image_shape=image_shape,
+                                            frames_per_file=raw_frames_per_file)
+        self.frame_reader = None
+        # Records waiting for their images to be written: (contents, {key: future})
+        self.pending = deque()
+        self.max_pending = 2 * image_workers
 
-    def write_record(self, record=None):
+    def write_record(self, record=None, timestamp_ms=None):
         """
-        Can handle various data types including images.
+        Can handle various data types including images. \n
+        `timestamp_ms` defaults to the current time.
         """
+        with self.lock:
+            self._write_record(record, timestamp_ms)
+
+    def _write_record(self, record, timestamp_ms):
+        index = self.manifest.current_index + len(self.pending)
         contents = dict()
+        images = dict()
         for key, value in record.items():
             if value is None:
                 continue
@@ -54,38 +93,163 @@ class Tub(object):
                     contents[key] = list(value)
                 elif input_type == 'image_array':
                     # Handle image array
-                    image = Image.fromarray(np.uint8(value))
-                    name = Tub._image_file_name(self.manifest.current_index, key)
-                    image_path = os.path.join(self.images_base_path, name)
-                    image.save(image_path)
-                    contents[key] = name
+                    images[key] = self.image_store.put(index, key, value,
+                                                       self.manifest.catalog_number(len(self.pending)))
 
         # Private properties
-        contents['_timestamp_ms'] = int(round(time.time() * 1000))
-        contents['_index'] = self.manifest.current_index
+        if timestamp_ms is None:
+            timestamp_ms = int(round(time.time() * 1000))
+        contents['_timestamp_ms'] = timestamp_ms
+        contents['_index'] = index
+
+        self.pending.append((contents, images))
+        self._write_pending(self.max_pending)
+
+    def _write_pending(self, max_pending=0):
+        """
+        Adds pending records to the catalog in order, waiting for images only
+        while more than `max_pending` records are pending.
+        """
+        while len(self.pending) > 0:
+            contents, images = self.pending[0]
+            done = all(future.done() for future in images.values())
+            if not done and len(self.pending) <= max_pending:
+                break
+            for key, future in images.items():
+                try:
+                    contents[key] = future.result()
+                except Exception:
+                    print('Failed to write %s for record %s' % (key, contents['_index']))
+                    traceback.print_exc()
+            self.pending.popleft()
+            self.manifest.write_record(contents)
 
-        self.manifest.write_record(contents)
+    def flush(self):
+        """
+        Waits for pending images and writes their records.
+        """
+        with self.lock:
+            self._write_pending()
+
+    def commit(self):
+        """
+        Writes the pending records and commits them, see `CommitPolicy`.
+        """
+        with self.lock:
+            self._write_pending()
+            self.manifest.commit()
+
+    def update_records(self, updates):
+        """
+        Updates values of existing records, `updates` maps record indexes to a dictionary of
+        new values, e.g. `{12: {'user/angle': 0.1, 'user/throttle': 0.3}}`.
+        """
+        with self.lock:
+            self._write_pending()
+            self.manifest.update_records(updates)
 
     def delete_record(self, record_index):
-        self.manifest.delete_record(record_index)
+        with self.lock:
+            self._write_pending()
+            self.manifest.delete_record(record_index)
 
     def delete_last_n_records(self, n):
-        last_index = self.manifest.current_index
-        first_index = last_index - n
-        for index in range(first_index, last_index):
-            if index < 0:
-                continue
-            else:
-                self.manifest.delete_record(index)
+        with self.lock:
+            self._write_pending()
+            last_index = self.manifest.current_index
+            first_index = max(last_index - n, 0)
+            self.manifest.delete_records(first_index, last_index)
+
+    def to_arrays(self, keys=None, include_images=False, where=None):
+        """
+        Reads the whole tub in one pass, returns a dictionary of NumPy arrays, one per key,
+        for the records that are not deleted. \n
+        `keys` defaults to the inputs, `_index` and `_timestamp_ms`. Image inputs are arrays
+        of image names, or `LazyImageArray`s that read images on access with `include_images`.
+        Catalogs for which `where(stats)` is False are skipped, see `stats()`.
+        """
+        with self.lock:
+            self._write_pending()
+            arrays = self.manifest.to_arrays(keys, where=where)
+        if include_images:
+            for key, input_type in zip(self.manifest.inputs, self.manifest.types):
+                if input_type == 'image_array' and key in arrays:
+                    arrays[key] = LazyImageArray(self.images_base_path, arrays[key],
+                                                 raw_reader=self._frame_reader())
+        return arrays
+
+    def _frame_reader(self):
+        if self.frame_reader is None:
+            self.frame_reader = RawFrameReader(self.images_base_path)
+        return self.frame_reader
+
+    def load_frames(self, key, indexes):
+        """
+        Returns the raw frames of `key` for the given record indexes, as a single array.
+        A contiguous range of indexes within a frame file is a zero-copy view.
+        Only available for tubs recorded with `image_store='raw'`.
+        """
+        return self._frame_reader().read(key, indexes)
 
     def close(self):
-        self.manifest.close()
+        with self.lock:
+            self._write_pending()
+            self.image_store.close()
+            if self.frame_reader is not None:
+                self.frame_reader.close()
+            self.manifest.close()
 
     def __iter__(self):
         return ManifestIterator(self.manifest)
 
     def __len__(self):
-        return self.manifest.__len__()
+        with self.lock:
+            return self.manifest.__len__()
+
+    def __getitem__(self, key):
+        """
+        Random access to records by position, `tub[i]` or `tub[i:j]`. Deleted records are skipped. \n
+        Reads hold the lock of the tub, so they see the catalogs and deleted records of the
+        same moment while a writer thread adds records.
+        """
+        with self.lock:
+            return self.manifest[key]
+
+    def get_batch(self, positions):
+        """
+        Returns the records at the given positions, deleted records are skipped.
+        """
+        with self.lock:
+            return self.manifest.get_batch(positions)
+
+    def select(self, mode=None, t0=None, t1=None, values=None):
+        """
+        Returns the indexes of the records recorded in `[t0, t1)` (`_timestamp_ms`), with the given
+        `user/mode` (or one of a list of modes). `values` can match other string inputs, e.g.
+        `tub.select(mode='local_angle', t0=start, t1=start + 60000)`. See `Manifest.select`.
+        """
+        values = dict(values or dict())
+        if mode is not None:
+            values['user/mode'] = mode
+        with self.lock:
+            self._write_pending()
+            return self.manifest.select(t0=t0, t1=t1, values=values)
+
+    def stats(self):
+        """
+        Returns the statistics of every catalog, see `Manifest.catalog_stats`. The catalogs
+        themselves are not read, e.g. `sum(s['values']['user/mode'].get('user', 0) for s in tub.stats())`.
+        """
+        with self.lock:
+            self._write_pending()
+            return [self.manifest.catalog_stats(n) for n in range(len(self.manifest.catalog_paths))]
+
+    def get_records(self, record_indexes):
+        """
+        Returns the records with the given indexes, e.g. the indexes returned by `select()`.
+        """
+        with self.lock:
+            return self.manifest.get_records(record_indexes)
 
     @classmethod
     def images(cls):
@@ -93,19 +257,244 @@ class Tub(object):
 
     @classmethod
     def _image_file_name(cls, index, key, extension='.jpg'):
-        key_prefix = key.replace('/', '_')
-        name = '_'.join([str(index), key_prefix, extension])
-        # Return relative paths to maintain portability
-        return name
+        return image_file_name(index, key, extension)
+
+    @classmethod
+    def _image_store(cls, image_store, images_path, image_format='jpg',
+                     image_options=None, workers=0, image_shape=None, frames_per_file=RAW_FRAMES_PER_FILE):
+        if image_store == 'files':
+            return FileImageStore(images_path, image_format=image_format,
+                                  image_options=image_options, workers=workers)
+        elif image_store == 'chunks':
+            return ChunkImageStore(images_path, image_format=image_format,
+                                   image_options=image_options, workers=workers)
+        elif image_store == 'raw':
+            return RawImageStore(images_path, frames_per_file=frames_per_file, image_shape=image_shape)
+        raise ValueError('Unknown image store %s' % image_store)
+
+
+def _link_tree(src, dst, copy=()):
+    # Hard links (or copies) every file under `src` to the same place under `dst`, the files in `copy` are copied
+    for root, _, names in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in names:
+            path = os.path.relpath(os.path.join(root, name), src)
+            link = shutil.copyfile if path in copy else link_or_copy
+            link(os.path.join(root, name), os.path.join(target, name))
+
+
+def _link_images(src_path, dst_images):
+    """
+    Links the images of the tub in `src_path` into `dst_images`. The chunk and raw frame
+    files that the tub still writes to are copied, see `writable_image_files`.
+    """
+    manifest = Manifest(src_path, read_only=True)
+    catalog_number = len(manifest.catalog_paths) - 1
+    next_index = manifest.current_index
+    manifest.close()
+    src_images = os.path.join(src_path, Tub.images())
+    _link_tree(src_images, dst_images, copy=writable_image_files(src_images, catalog_number, next_index))
+
+
+def convert_tub(src_path, dst_path, catalog_format=None, image_store=None, compact=False,
+                raw_frames_per_file=None):
+    """
+    Creates a copy of the tub in `src_path` at `dst_path`. \n
+    `catalog_format` (`json` or `binary`) and `image_store` (`files`, `chunks` or `raw`)
+    default to the settings of the source tub. When images keep their store they are
+    hard linked when possible, otherwise their encoded bytes are moved to the new
+    store without decoding them. With `compact`, deleted records and their images are
+    left out, and the remaining records are renumbered. Raw frame files keep the number of
+    frames of the source's, unless `raw_frames_per_file` is given.
+    """
+    src_images = os.path.join(src_path, Tub.images())
+    dst_images = os.path.join(dst_path, Tub.images())
+    os.makedirs(dst_images, exist_ok=True)
+    if image_store is None and not compact:
+        convert_manifest(src_path, dst_path, catalog_format)
+        _link_images(src_path, dst_images)
+        return
+
+    src = Manifest(src_path, read_only=True)
+    image_keys = [key for key, input_type in zip(src.inputs, src.types) if input_type == 'image_array']
+    max_len = src.max_len
+    src.close()
+    stores = dict()
+
+    def move_images(index, record):
+        for key in image_keys:
+            name = record.get(key)
+            if name is None:
+                continue
+            if is_chunk_reference(name):
+                name_store = 'chunks'
+            elif is_raw_reference(name):
+                name_store = 'raw'
+            else:
+                name_store = 'files'
+            target_store = image_store or name_store
+            if target_store == 'files' and name_store == 'files':
+                # Already an image file, it only needs a new name when records are renumbered
+                dst_name = image_file_name(index, key, os.path.splitext(name)[1]) if compact else name
+                if os.path.dirname(dst_name):
+                    # Images of a merged tub
+                    os.makedirs(os.path.join(dst_images, os.path.dirname(dst_name)), exist_ok=True)
+                link_or_copy(os.path.join(src_images, name), os.path.join(dst_images, dst_name))
+                record[key] = dst_name
+            else:
+                store = stores.get(target_store)
+                if store is None:
+                    frames_per_file = raw_frames_per_file
+                    if frames_per_file is None and name_store == 'raw':
+                        frames_per_file = len(open_raw_frames(src_images, name.split(':')[0]))
+                    store = Tub._image_store(target_store, dst_images,
+                                             frames_per_file=frames_per_file or RAW_FRAMES_PER_FILE)
+                    stores[target_store] = store
+                # The new datastore fills its catalogs from index 0
+                record[key] = store.put_encoded(index, key, read_image_data(src_images, name), index // max_len)
+        return record
+
+    try:
+        convert_manifest(src_path, dst_path, catalog_format, transform=move_images, drop_deleted=compact)
+    finally:
+        for store in stores.values():
+            store.close()
+
+
+def merge_tubs(src_paths, dst_path):
+    """
+    Merges the tubs in `src_paths`, in order, into a new tub at `dst_path`, without parsing
+    records or decoding images. \n
+    Catalogs and images are hard linked when possible (copied otherwise), the images of each
+    tub go to their own folder in `images/`, named after the tub. Record indexes are renumbered
+    when records are read, see `merge_manifests`. Returns the number of records.
+    """
+    prefixes = list()
+    for src_path in src_paths:
+        name = os.path.basename(os.path.normpath(src_path))
+        prefix = name
+        while prefix in prefixes:
+            prefix = '%s_%d' % (name, len(prefixes))
+        prefixes.append(prefix)
+
+    records = merge_manifests(src_paths, dst_path, images_prefixes=[prefix + '/' for prefix in prefixes])
+    for src_path, prefix in zip(src_paths, prefixes):
+        _link_images(src_path, os.path.join(dst_path, Tub.images(), prefix))
+    return records
+
+
+def split_tub(src_path, dst_path, start_ms=None, end_ms=None):
+    """
+    Creates a tub at `dst_path` with the records of `src_path` whose `_timestamp_ms` is in
+    `[start_ms, end_ms)`. \n
+    Like `merge_tubs` catalogs and images are linked, the images go to a folder of `images/` named
+    after the source tub. Catalogs without any record in the time range are left out, and the other
+    records of the remaining catalogs are marked as deleted (`compact_tub` removes them for good).
+    Returns the number of records.
+    """
+    def select(src_number, catalog):
+        timestamps = np.asarray(catalog.columns(['_timestamp_ms'])['_timestamp_ms'], dtype=np.float64)
+        keep = np.ones(len(timestamps), dtype=bool)
+        if start_ms is not None:
+            keep &= timestamps >= start_ms
+        if end_ms is not None:
+            keep &= timestamps < end_ms
+        return keep
+
+    # In their own folder, so images written to the new tub do not replace linked ones
+    prefix = os.path.basename(os.path.normpath(src_path))
+    records = merge_manifests([src_path], dst_path, images_prefixes=[prefix + '/'], select=select)
+    _link_images(src_path, os.path.join(dst_path, Tub.images(), prefix))
+    return records
+
+
+def _directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def compact_tub(path):
+    """
+    Rewrites the tub in `path` without its deleted records, removing their images
+    and renumbering the remaining records. Catalog format and image store are kept. \n
+    The compacted tub is written next to the original (`<path>.compact`) and swapped in
+    when complete, through `<path>.old`; a swap interrupted by a crash is finished when
+    the tub is opened, see `recover_compaction()`. Returns a dictionary with the number of
+    removed records, the bytes reclaimed and the time taken.
+    """
+    path = os.path.normpath(os.path.expanduser(path))
+    recover_compaction(path)
+    start = time.time()
+    manifest = Manifest(path, read_only=True)
+    removed = len(manifest.deleted_indexes)
+    manifest.close()
+    stats = {'removed': removed, 'reclaimed_bytes': 0, 'seconds': 0.0}
+    if removed == 0:
+        return stats
+
+    compact_path = path + '.compact'
+    old_path = path + '.old'
+    shutil.rmtree(compact_path, ignore_errors=True)
+    size = _directory_size(path)
+    convert_tub(path, compact_path, compact=True)
+    os.rename(path, old_path)
+    os.rename(compact_path, path)
+    shutil.rmtree(old_path)
+
+    stats['reclaimed_bytes'] = size - _directory_size(path)
+    stats['seconds'] = time.time() - start
+    print('Compacted %s, removed %d records, reclaimed %.1f KB in %.2f seconds' % (
+        path, removed, stats['reclaimed_bytes'] / 1024.0, stats['seconds']))
+    return stats
+
+
+def recover_compaction(path):
+    """
+    Finishes the swap of a `compact_tub()` interrupted by a crash. Once the tub has been
+    renamed to `<path>.old`, `<path>.compact` is complete and replaces it, a leftover
+    `<path>.old` is removed once the tub is in place. A partial `<path>.compact` written
+    before the swap is left for the next `compact_tub()`.
+    """
+    compact_path = path + '.compact'
+    old_path = path + '.old'
+    if not os.path.exists(path) and os.path.exists(old_path):
+        if os.path.exists(compact_path):
+            print('Finishing the compaction of %s' % path)
+            os.rename(compact_path, path)
+        else:
+            os.rename(old_path, path)
+    if os.path.exists(path) and os.path.exists(old_path):
+        shutil.rmtree(old_path)
 
 
 class TubHandler:
     def __init__(self, path):
         self.path = os.path.expanduser(path)
 
+    # Folders of a compaction in progress, see `compact_tub`
+    COMPACTION_SUFFIXES = ('.compact', '.old')
+
     def get_tub_list(self, path):
         folders = next(os.walk(path))[1]
-        return folders
+        for folder in folders:
+            if folder.endswith('.old'):
+                recover_compaction(os.path.join(path, folder[:-len('.old')]))
+        folders = next(os.walk(path))[1]
+        return [folder for folder in folders if not folder.endswith(TubHandler.COMPACTION_SUFFIXES)]
+
+    def get_tub_paths(self):
+        return [os.path.join(self.path, folder) for folder in sorted(self.get_tub_list(self.path))]
+
+    def compact_tubs(self):
+        """
+        Compacts every tub with deleted records, e.g. between driving sessions.
+        """
+        return [compact_tub(tub_path) for tub_path in self.get_tub_paths()
+                if os.path.exists(os.path.join(tub_path, 'manifest.json'))]
 
     def next_tub_number(self, path):
         def get_tub_num(tub_name):
@@ -133,13 +522,127 @@ class TubHandler:
         return tw
 
 
+class RecordQueue(object):
+    """
+    A bounded FIFO of records shared by the drive loop and a writer thread. \n
+    When the queue is full, `policy` decides what happens to a new record:
+    `block` waits for the writer, `drop_oldest` discards the oldest queued record
+    and `drop_newest` discards the new record. Records put once the queue is closed
+    are dropped. The writer calls `done()` for every record it handled, see `join()`.
+    """
+
+    POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, max_size, policy='block'):
+        if policy not in RecordQueue.POLICIES:
+            raise ValueError('Unknown queue policy %s' % policy)
+        assert max_size > 0, 'max_size must be > 0: %r' % max_size
+        self.records = deque()
+        self.max_size = max_size
+        self.policy = policy
+        self.condition = threading.Condition()
+        self.closed = False
+        self.queued = 0
+        self.dropped = 0
+        # Queued records which were written (or dropped from the queue)
+        self.handled = 0
+
+    def put(self, record):
+        with self.condition:
+            if len(self.records) >= self.max_size and not self.closed:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                elif self.policy == 'drop_oldest':
+                    self.records.popleft()
+                    self.dropped += 1
+                    self.handled += 1
+                else:
+                    while len(self.records) >= self.max_size and not self.closed:
+                        self.condition.wait()
+            if self.closed:
+                self.dropped += 1
+                return False
+            self.records.append(record)
+            self.queued += 1
+            self.condition.notify_all()
+            return True
+
+    def get(self):
+        """
+        Blocks until a record is available. Returns `None` once the queue is closed and empty.
+        """
+        with self.condition:
+            while len(self.records) == 0 and not self.closed:
+                self.condition.wait()
+            if len(self.records) == 0:
+                return None
+            record = self.records.popleft()
+            self.condition.notify_all()
+            return record
+
+    def done(self):
+        """
+        Called by the writer once it handled a record returned by `get()`.
+        """
+        with self.condition:
+            self.handled += 1
+            self.condition.notify_all()
+
+    def join(self):
+        """
+        Blocks until every record queued before this call was handled by the writer.
+        """
+        with self.condition:
+            queued = self.queued
+            while self.handled < queued:
+                self.condition.wait()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.records)
+
+
 class TubWriter(object):
     """
-    A Donkey part, which can write records to the datastore.
+    A Donkey part, which can write records to the datastore. \n
+    With `queue_size > 0`, `run()` only queues the record and a background thread
+    writes it, so image encoding and disk I/O do not stall the drive loop.
+    `queue_policy` is one of `RecordQueue.POLICIES`. With a `batch_interval_ms` in the
+    `commit_policy`, written records are committed every `batch_interval_ms`, also when
+    recording stops.
     """
     def __init__(self, base_path, inputs=[], types=[], metadata=[],
-                 max_catalog_len=10000):
-        self.tub = Tub(base_path, inputs, types, metadata, max_catalog_len)
+                 max_catalog_len=10000, catalog_format='json',
+                 queue_size=0, queue_policy='block', commit_policy=None,
+                 image_format='jpg', image_options=None, image_workers=0, image_store='files',
+                 image_shape=None, catalog_compression=None, raw_frames_per_file=RAW_FRAMES_PER_FILE):
+        self.tub = Tub(base_path, inputs, types, metadata, max_catalog_len,
+                       catalog_format=catalog_format, commit_policy=commit_policy,
+                       image_format=image_format, image_options=image_options,
+                       image_workers=image_workers, image_store=image_store,
+                       image_shape=image_shape, catalog_compression=catalog_compression,
+                       raw_frames_per_file=raw_frames_per_file)
+        self.queue = None
+        self.thread = None
+        self.written = 0
+        self.closed = False
+        if queue_size > 0:
+            self.queue = RecordQueue(queue_size, policy=queue_policy)
+            self.thread = threading.Thread(target=self._write_queued_records, args=())
+            self.thread.daemon = True
+            self.thread.start()
+        self.stopped = threading.Event()
+        self.commit_thread = None
+        if commit_policy is not None and commit_policy.batch_interval_ms is not None:
+            self.commit_thread = threading.Thread(target=self._commit_periodically,
+                                                  args=(commit_policy.batch_interval_ms / 1000.0,))
+            self.commit_thread.daemon = True
+            self.commit_thread.start()
 
         def shutdown_hook():
             self.close()
@@ -150,11 +653,68 @@ class TubWriter(object):
     def run(self, *args):
         assert len(self.tub.inputs) == len(args)
         record = dict(zip(self.tub.inputs, args))
-        self.tub.write_record(record)
-        return self.tub.manifest.current_index
+        if self.queue is None:
+            self.tub.write_record(record)
+            self.written += 1
+            return self.tub.manifest.current_index + len(self.tub.pending)
+
+        timestamp_ms = int(round(time.time() * 1000))
+        self.queue.put((record, timestamp_ms))
+        return self.tub.manifest.current_index + len(self.tub.pending) + len(self.queue)
+
+    def _write_queued_records(self):
+        while True:
+            queued = self.queue.get()
+            if queued is None:
+                break
+            record, timestamp_ms = queued
+            try:
+                self.tub.write_record(record, timestamp_ms=timestamp_ms)
+                self.written += 1
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.done()
+
+    def _commit_periodically(self, interval_s):
+        while not self.stopped.wait(interval_s):
+            try:
+                self.tub.commit()
+            except Exception:
+                traceback.print_exc()
+
+    def delete_last_n_records(self, n):
+        """
+        Marks the last `n` records as deleted, including the records still queued when it is
+        called: they are written first, so later records are not deleted in their place.
+        """
+        if self.queue is not None:
+            self.queue.join()
+        self.tub.delete_last_n_records(n)
+
+    def stats(self):
+        """
+        Returns counters for the records handled by this writer.
+        """
+        stats = {'written': self.written, 'queued': self.written, 'dropped': 0, 'pending': 0}
+        if self.queue is not None:
+            stats['queued'] = self.queue.queued
+            stats['dropped'] = self.queue.dropped
+            stats['pending'] = len(self.queue)
+        return stats
 
     def __iter__(self):
         return self.tub.__iter__()
 
     def close(self):
-        self.tub.manifest.close()
+        if self.closed:
+            return
+        self.closed = True
+        self.stopped.set()
+        if self.commit_thread is not None:
+            self.commit_thread.join()
+        if self.queue is not None:
+            # Let the writer drain the queue before closing the tub.
+            self.queue.close()
+            self.thread.join()
+        self.tub.close()
@@ -1,11 +1,21 @@
+import math
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
 from threading import Thread
 from car.memory import Memory
+from car.profiler import PartProfiler
+from car.scheduler import LoopScheduler
 
 
 class Vehicle:
-    def __init__(self, mem=None):
+    def __init__(self, mem=None, profile=False, workers=0):
+        """
+        With `profile`, the time spent by each part and by each loop is recorded,
+        see `self.profiler.snapshot()` and `self.profiler.report()`. With `workers > 0`,
+        parts that do not depend on each other run concurrently on a pool of `workers`
+        threads, see `update_parts()`.
+        """
         self.on = True
 
         if not mem:
@@ -13,14 +23,26 @@ class Vehicle:
 
         self.parts = []
         self.mem = mem
+        self.scheduler = None
+        self.tick_hz = None
+        self.profiler = PartProfiler() if profile else None
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.stages = None
 
-    def add(self, part, inputs=None, outputs=None, threaded=False, run_condition=None):
+    def add(self, part, inputs=None, outputs=None, threaded=False, run_condition=None, rate_hz=None, phase=None,
+            on_change=None, max_staleness_s=None):
         """
 
         :param part:
         :param inputs:
         :param outputs:
         :param run_condition:
+        :param rate_hz: run the part at this rate instead of the rate of the drive loop
+        :param phase: the tick, out of the ticks between two runs, the part runs on. By default
+            parts are spread over the ticks, see `plan_rates()`
+        :param on_change: only run the part when one of its inputs (`True`), or of the given
+            keys, has a newer version in memory than when it last ran
+        :param max_staleness_s: with `on_change`, also run the part when it has not run for this long
         :return:
         """
         if inputs is None:
@@ -30,14 +52,30 @@ class Vehicle:
         assert type(inputs) is list, "inputs is not a list: %r" % inputs
         assert type(outputs) is list, "outputs is not a list: %r" % outputs
         assert type(threaded) is bool, "threaded is not a boolean: %r" % threaded
+        assert rate_hz is None or rate_hz > 0, "rate_hz must be > 0: %r" % rate_hz
+        assert phase is None or (type(phase) is int and phase >= 0), "phase is not a positive int: %r" % phase
+        assert on_change in (None, False, True) or type(on_change) is list, "on_change is not a list: %r" % on_change
 
         p = part
         print('Adding part {}.'.format(p.__class__.__name__))
+        name = p.__class__.__name__
+        if name in [entry['name'] for entry in self.parts]:
+            name = '%s:%d' % (name, len(self.parts))
         entry = {
             'part': p,
+            'name': name,
             'inputs': inputs,
             'outputs': outputs,
             'run_condition': run_condition,
+            'rate_hz': rate_hz,
+            'phase': phase,
+            'runs': 0,
+            # Keys whose versions trigger the part, and the versions it last ran with
+            'trigger_keys': list(inputs) if on_change is True else (on_change or None),
+            'max_staleness_ns': int(max_staleness_s * 1e9) if max_staleness_s is not None else None,
+            'seen_versions': None,
+            'last_run_ns': 0,
+            'unchanged': 0,
         }
 
         if threaded:
@@ -45,40 +83,194 @@ class Vehicle:
             t.daemon = True
             entry['thread'] = t
 
+        if self.profiler:
+            entry['stats'] = self.profiler.add_part(name)
+            entry['record'] = entry['stats'].durations.append
+
         self.parts.append(entry)
+        self.stages = None
 
-    def update_parts(self):
+    def plan_rates(self, rate_hz):
         """
-        loop over all parts
+        Returns the rate of the drive loop ticks: `rate_hz`, or the rate of the fastest part
+        when it is faster. Every part runs once every `divisor` ticks (parts without a
+        `rate_hz` at `rate_hz`), on the ticks where `tick % divisor == phase`. Parts without
+        a `phase` get the phase whose ticks have the fewest parts, to even out the ticks.
         """
+        tick_hz = max([rate_hz] + [entry['rate_hz'] for entry in self.parts if entry['rate_hz']])
         for entry in self.parts:
+            part_hz = entry['rate_hz'] or rate_hz
+            entry['requested_hz'] = part_hz
+            entry['divisor'] = max(1, int(round(tick_hz / part_hz)))
+            if abs(tick_hz / entry['divisor'] - part_hz) > 1e-6 * part_hz:
+                print('{} runs at {:.2f} Hz instead of {} Hz, a divisor of the {} Hz drive loop.'.format(
+                    entry['name'], tick_hz / entry['divisor'], part_hz, tick_hz))
 
-            run = True
-            # check run condition, if it exists
-            if entry.get('run_condition'):
-                run_condition = entry.get('run_condition')
-                run = self.mem.get([run_condition])[0]
-
-            if run:
-                # get part
-                p = entry['part']
-                # start timing part run
-                # self.profiler.on_part_start(p)
-                # get inputs from memory
-                inputs = self.mem.get(entry['inputs'])
-                # run the part
-                if entry.get('thread'):
-                    outputs = p.run_threaded(*inputs)
-                else:
-                    outputs = p.run(*inputs)
+        # Number of parts run on each tick, over a cycle of all divisors
+        cycle = 1
+        for entry in self.parts:
+            cycle = min(math.lcm(cycle, entry['divisor']), 3600)
+        load = [0] * cycle
+        for entry in sorted(self.parts, key=lambda entry: entry['phase'] is None):
+            divisor = entry['divisor']
+            if entry['phase'] is not None:
+                entry['tick_phase'] = entry['phase'] % divisor
+            else:
+                entry['tick_phase'] = min(range(divisor), key=lambda phase: (max(load[phase::divisor]), phase))
+            for tick in range(entry['tick_phase'], cycle, divisor):
+                load[tick] += 1
+        return tick_hz
 
-                # save the output to memory
-                if outputs is not None:
-                    self.mem.put(entry['outputs'], outputs)
-                # finish timing part run
-                # self.profiler.on_part_finished(p)
+    def part_rates(self):
+        """
+        Returns the requested, the planned and the achieved rate of each part, since the
+        vehicle started. The planned rate is a divisor of the drive loop rate, so it can differ
+        from the requested one, e.g. 33.3 Hz for a 30 Hz part in a 100 Hz drive loop.
+        """
+        elapsed = (time.perf_counter_ns() - self.scheduler.start_ns) / 1e9 if self.scheduler else 0
+        rates = dict()
+        for entry in self.parts:
+            rates[entry['name']] = {
+                'requested_hz': entry.get('requested_hz'),
+                'rate_hz': self.tick_hz / entry['divisor'] if self.tick_hz else None,
+                'achieved_hz': entry['runs'] / elapsed if elapsed > 0 else 0.0,
+                'unchanged': entry['unchanged'],
+            }
+        return rates
 
-    def start(self, rate_hz=10, max_loop_count=None):
+    def key_rates(self):
+        """
+        Returns how often each memory key was written, and how often its value changed,
+        since the vehicle started.
+        """
+        elapsed = (time.perf_counter_ns() - self.scheduler.start_ns) / 1e9 if self.scheduler else 0
+        rates = dict()
+        for key, stats in self.mem.stats().items():
+            rates[key] = {
+                'writes_hz': stats['writes'] / elapsed if elapsed > 0 else 0.0,
+                'changes_hz': stats['version'] / elapsed if elapsed > 0 else 0.0,
+            }
+        return rates
+
+    def update_parts(self, tick=None):
+        """
+        loop over all parts, with `workers > 0` parts that do not depend on each other
+        (see `part_stages`) run concurrently. With a `tick`, only the parts due on that
+        tick run, see `plan_rates()`.
+        """
+        sample = self.profiler.next_loop() if self.profiler else False
+        if self.executor is None:
+            if self.profiler:
+                self._update_parts_timed(tick, sample)
+                return
+            for entry in self.parts:
+                if tick is None or tick % entry['divisor'] == entry['tick_phase']:
+                    self._update_part(entry)
+            return
+
+        update_part = self._update_part_timed if self.profiler else self._update_part
+        if self.stages is None:
+            self.stages = part_stages(self.parts)
+        for stage in self.stages:
+            if tick is not None:
+                stage = [entry for entry in stage if tick % entry['divisor'] == entry['tick_phase']]
+                if not stage:
+                    continue
+            futures = [self.executor.submit(update_part, entry, sample) for entry in stage[1:]]
+            try:
+                # the first part of a stage runs on the drive loop thread
+                update_part(stage[0], sample)
+            finally:
+                # the other parts are done before an error stops the vehicle
+                wait(futures)
+            for future in futures:
+                future.result()
+
+    def _update_parts_timed(self, tick, sample):
+        # One timestamp per part, the end of a part is the start of the next one. The
+        # checks of parts that do not run count towards the next part that runs.
+        clock = time.perf_counter_ns
+        update_part = self._update_part
+        last = clock()
+        for entry in self.parts:
+            if (tick is None or tick % entry['divisor'] == entry['tick_phase']) and update_part(entry, sample):
+                now = clock()
+                entry['record'](now - last)
+                last = now
+
+    def _update_part_timed(self, entry, sample):
+        start = time.perf_counter_ns()
+        if self._update_part(entry, sample):
+            entry['record'](time.perf_counter_ns() - start)
+
+    def _update_part(self, entry, sample=False):
+        """
+        Runs a part when its run condition and inputs allow it, returns whether it ran.
+        With `sample`, the time it spends in each phase is recorded.
+        """
+        clock = time.perf_counter_ns
+        run = True
+        # check run condition, if it exists
+        if entry.get('run_condition'):
+            run_condition = entry.get('run_condition')
+            run = self.mem.get([run_condition])[0]
+
+        if run and entry['trigger_keys'] is not None:
+            run = self._inputs_changed(entry, clock())
+
+        if run:
+            # get part
+            p = entry['part']
+            stats = entry.get('stats') if sample else None
+            # start timing part run
+            if stats:
+                start = clock()
+            # get inputs from memory
+            inputs = self.mem.get(entry['inputs'])
+            if stats:
+                got = clock()
+            # run the part
+            if entry.get('thread'):
+                outputs = p.run_threaded(*inputs)
+            else:
+                outputs = p.run(*inputs)
+            if stats:
+                ran = clock()
+
+            entry['runs'] += 1
+
+            # save the output to memory
+            if outputs is not None:
+                self.mem.put(entry['outputs'], outputs)
+            # finish timing part run
+            if stats:
+                stats.record(start, got, ran, clock())
+        return run
+
+    def _inputs_changed(self, entry, now):
+        versions = self.mem.get_versions(entry['trigger_keys'])
+        stale = entry['max_staleness_ns'] is not None and now - entry['last_run_ns'] >= entry['max_staleness_ns']
+        if versions == entry['seen_versions'] and not stale:
+            entry['unchanged'] += 1
+            return False
+        entry['seen_versions'] = versions
+        entry['last_run_ns'] = now
+        return True
+
+    def start(self, rate_hz=10, max_loop_count=None, overrun_policy='skip', spin_ms=0, max_catch_up=10):
+        """
+        Runs the drive loop at `rate_hz`, see `LoopScheduler` for `overrun_policy`,
+        `spin_ms` and `max_catch_up`. Loop timing statistics are available from `self.scheduler.stats()`.
+        Parts added with their own `rate_hz` run at a divisor of the loop rate, the loop
+        runs faster than `rate_hz` when a part needs it, see `plan_rates()`. \n
+        `max_loop_count` counts loops at `rate_hz`, not ticks of a faster loop: the vehicle
+        stops after `max_loop_count` times the number of ticks in one `rate_hz` loop.
+        """
+        self.tick_hz = self.plan_rates(rate_hz)
+        if max_loop_count:
+            max_loop_count *= max(1, int(round(self.tick_hz / rate_hz)))
+        self.scheduler = LoopScheduler(self.tick_hz, overrun_policy=overrun_policy, spin_ms=spin_ms,
+                                       max_catch_up=max_catch_up)
         try:
             self.on = True
 
@@ -88,20 +280,23 @@ class Vehicle:
                     entry.get('thread').start()
 
             loop_count = 0
+            self.scheduler.start()
 
             while self.on:
-                start_time = time.time()
                 loop_count += 1
 
-                self.update_parts()
+                if self.profiler:
+                    loop_start = time.perf_counter_ns()
+                    self.update_parts(loop_count - 1)
+                    self.profiler.on_loop(time.perf_counter_ns() - loop_start, self.scheduler.period_ns)
+                else:
+                    self.update_parts(loop_count - 1)
 
-                # stop drive loop if loop_count exceeds max_loop_count
+                # stop drive loop if loop_count exceeds max_loop_count, in ticks
                 if max_loop_count and loop_count > max_loop_count:
                     self.on = False
-
-                sleep_time = 1.0 / rate_hz - (time.time() - start_time)
-                if sleep_time > 0.0:
-                    time.sleep(sleep_time)
+                else:
+                    self.scheduler.wait()
 
         except KeyboardInterrupt:
             pass
@@ -112,6 +307,20 @@ class Vehicle:
 
     def stop(self):
         print('Shutting down vehicle and its parts...')
+        if self.scheduler is not None and self.scheduler.loops > 0:
+            print('Drive loop: {loops} loops at {rate_hz:.1f} Hz, {overruns} overruns, {skipped} skipped, '
+                  'late by p50 {jitter_p50_us:.0f} us, p99 {jitter_p99_us:.0f} us'.format(**self.scheduler.stats()))
+        if self.scheduler is not None and any(entry['rate_hz'] or entry['trigger_keys'] for entry in self.parts):
+            for name, rates in self.part_rates().items():
+                print('{}: {:.1f} Hz, planned {:.1f} Hz, requested {:.1f} Hz, skipped {} times with unchanged inputs'.format(
+                    name, rates['achieved_hz'], rates['rate_hz'], rates['requested_hz'], rates['unchanged']))
+            for key, rates in self.key_rates().items():
+                print('{}: written {:.1f} Hz, changed {:.1f} Hz'.format(key, rates['writes_hz'], rates['changes_hz']))
+        if self.profiler:
+            self.profiler.report()
+        if self.executor is not None:
+            # parts are not shut down while they run
+            self.executor.shutdown(wait=True)
         for entry in self.parts:
             try:
                 entry['part'].shutdown()
@@ -120,3 +329,32 @@ class Vehicle:
                 pass
             except Exception as e:
                 print(e)
+
+
+def part_stages(entries):
+    """
+    Groups the parts of a vehicle into stages, using the keys they read (`inputs`,
+    `run_condition` and `on_change` keys) and write (`outputs`). A part depends on an earlier
+    part when it reads a key the earlier part writes, or writes a key the earlier part reads
+    or writes. Each part goes in the stage after the last part it depends on, so the parts of
+    a stage can run in any order, and dependent parts still run in the order they were added.
+    """
+    levels = []
+    keys = []
+    for entry in entries:
+        reads = set(entry['inputs'])
+        if entry.get('run_condition'):
+            reads.add(entry['run_condition'])
+        reads.update(entry.get('trigger_keys') or [])
+        writes = set(entry['outputs'])
+        level = 0
+        for other_level, (other_reads, other_writes) in zip(levels, keys):
+            if reads & other_writes or writes & (other_reads | other_writes):
+                level = max(level, other_level + 1)
+        levels.append(level)
+        keys.append((reads, writes))
+
+    stages = [[] for _ in range(max(levels) + 1 if levels else 0)]
+    for level, entry in zip(levels, entries):
+        stages[level].append(entry)
+    return stages
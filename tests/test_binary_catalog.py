@@ -0,0 +1,154 @@
+import os
+
+import numpy as np
+import pytest
+
+from car.binary_catalog import BinaryCatalog
+from car.catalog_base import link_or_copy
+from car.tub import Tub
+
+INPUTS = ['user/angle', 'user/mode', 'cam/image_array', 'imu/acl', 'count', 'flag']
+TYPES = ['float', 'str', 'image_array', 'vector', 'int', 'boolean']
+
+
+def make_record(index):
+    return {'user/angle': index / 10.0, 'user/mode': 'user' if index % 2 else 'local',
+            'cam/image_array': '%d_cam_image_array_.jpg' % index, 'imu/acl': [index, 0.5, -1.0],
+            'count': index * 1000, 'flag': index % 3 == 0, '_index': index, '_timestamp_ms': 1000 + index}
+
+
+def open_catalog(path, read_only=False, start_index=0):
+    return BinaryCatalog(path, INPUTS, TYPES, read_only=read_only, start_index=start_index)
+
+
+def write_catalog(path, count, start_index=0):
+    catalog = open_catalog(path, start_index=start_index)
+    for index in range(start_index, start_index + count):
+        catalog.write_record(make_record(index))
+    catalog.close()
+
+
+def test_records_round_trip(tmp_path):
+    path = str(tmp_path / 'catalog_0.bincatalog')
+    write_catalog(path, 10)
+    catalog = open_catalog(path, read_only=True)
+    assert catalog.lines() == 10
+    record = catalog.read_record_at(3)
+    expected = make_record(3)
+    assert record['user/angle'] == pytest.approx(0.3)
+    del record['user/angle'], expected['user/angle']
+    assert record == expected
+    assert catalog.read_record_at(10) is None
+    # Strings are dictionary encoded in the catalog manifest
+    assert catalog.dictionaries['user/mode'] == ['local', 'user']
+    catalog.close()
+
+
+def test_floats_are_stored_as_float32(tmp_path):
+    path = str(tmp_path / 'catalog_0.bincatalog')
+    catalog = open_catalog(path)
+    values = [0.1, 1.0 / 3, 123456.789, -2.5e-8, 3.4e38]
+    for index, value in enumerate(values):
+        catalog.write_record({'user/angle': value, '_index': index})
+    catalog.close()
+
+    catalog = open_catalog(path, read_only=True)
+    read = [catalog.read_record_at(line)['user/angle'] for line in range(len(values))]
+    assert read == [float(np.float32(value)) for value in values]
+    assert read == pytest.approx(values, rel=1e-7)
+    column = catalog.columns(['user/angle'])['user/angle']
+    assert list(column) == read
+    catalog.close()
+
+
+def test_missing_values(tmp_path):
+    path = str(tmp_path / 'catalog_0.bincatalog')
+    catalog = open_catalog(path)
+    catalog.write_record({'_index': 0, '_timestamp_ms': 5})
+    catalog.write_record(make_record(1))
+    catalog.close()
+
+    catalog = open_catalog(path, read_only=True)
+    assert catalog.read_record_at(0) == {'_index': 0, '_timestamp_ms': 5}
+    columns = catalog.columns()
+    assert np.isnan(columns['user/angle'][0])
+    assert columns['user/mode'][0] is None and columns['user/mode'][1] == 'user'
+    assert columns['cam/image_array'][0] is None and columns['imu/acl'][1] == [1, 0.5, -1.0]
+    assert list(columns['_index']) == [0, 1]
+    assert columns['_valid'].all()
+    catalog.close()
+
+
+def test_columns_match_records(tmp_path):
+    path = str(tmp_path / 'catalog_1.bincatalog')
+    write_catalog(path, 20, start_index=20)
+    catalog = open_catalog(path, read_only=True, start_index=20)
+    columns = catalog.columns()
+    for line in range(20):
+        record = catalog.read_record_at(line)
+        for key in INPUTS + ['_index', '_timestamp_ms']:
+            value = columns[key][line]
+            assert (value.tolist() if isinstance(value, np.generic) else value) == record[key]
+    assert catalog.rows()['_index'][0] == 20
+    catalog.close()
+
+
+def test_torn_row_is_dropped(tmp_path):
+    path = str(tmp_path / 'catalog_0.bincatalog')
+    write_catalog(path, 5)
+    with open(path, 'ab') as catalog_file:
+        catalog_file.write(b'\x01\x02\x03')
+
+    catalog = open_catalog(path)
+    assert catalog.lines() == 5
+    catalog.write_record(make_record(5))
+    catalog.close()
+    catalog = open_catalog(path, read_only=True)
+    assert [catalog.read_record_at(line)['_index'] for line in range(6)] == list(range(6))
+    catalog.close()
+
+
+def test_updates_do_not_change_a_linked_catalog(tmp_path):
+    path = str(tmp_path / 'catalog_0.bincatalog')
+    write_catalog(path, 5)
+    os.makedirs(str(tmp_path / 'linked'))
+    linked_path = str(tmp_path / 'linked' / 'catalog_0.bincatalog')
+    for suffix in ('.bincatalog', '.binheap', '.catalog_manifest'):
+        link_or_copy(path.replace('.bincatalog', suffix), linked_path.replace('.bincatalog', suffix))
+
+    catalog = open_catalog(path)
+    record = catalog.read_record_at(2)
+    record.update({'user/mode': 'auto', 'imu/acl': [9, 9, 9]})
+    catalog.update_record(2, record)
+    with pytest.raises(IndexError):
+        catalog.update_record(5, record)
+    catalog.close()
+
+    catalog = open_catalog(path, read_only=True)
+    assert catalog.read_record_at(2)['user/mode'] == 'auto'
+    assert catalog.read_record_at(2)['imu/acl'] == [9, 9, 9]
+    catalog.close()
+    catalog = open_catalog(linked_path, read_only=True)
+    assert catalog.read_record_at(2)['user/mode'] == 'local'
+    assert catalog.read_record_at(2)['imu/acl'] == [2, 0.5, -1.0]
+    catalog.close()
+
+
+def test_binary_and_json_tubs_hold_the_same_records(tmp_path):
+    arrays = dict()
+    for catalog_format in ('json', 'binary'):
+        tub = Tub(str(tmp_path / catalog_format), inputs=INPUTS, types=TYPES, max_catalog_len=7,
+                  catalog_format=catalog_format)
+        for index in range(20):
+            record = make_record(index)
+            del record['_index'], record['cam/image_array']
+            tub.write_record(record, timestamp_ms=record.pop('_timestamp_ms'))
+        tub.delete_record(4)
+        tub.close()
+        tub = Tub(str(tmp_path / catalog_format), read_only=True)
+        arrays[catalog_format] = tub.to_arrays(keys=['_index', 'user/mode', 'count', 'user/angle'])
+        assert len(tub) == 19
+        tub.close()
+    for key in ('_index', 'user/mode', 'count'):
+        assert list(arrays['json'][key]) == list(arrays['binary'][key])
+    assert np.allclose(arrays['json']['user/angle'], arrays['binary']['user/angle'])
@@ -0,0 +1,87 @@
+import json
+import os
+import struct
+
+from car.catalog_base import CatalogMetadata
+from car.datastore import Catalog
+
+
+def write_catalog(path, count):
+    catalog = Catalog(path)
+    for index in range(count):
+        catalog.write_record({'_index': index, 'user/angle': float(index)})
+    return catalog
+
+
+def read_indexes(path):
+    catalog = Catalog(path, read_only=True)
+    indexes = [catalog.read_record_at(line)['_index'] for line in range(catalog.lines())]
+    catalog.close()
+    return indexes
+
+
+def test_offsets_are_appended_to_a_sidecar(tmp_path):
+    path = str(tmp_path / 'catalog_0.catalog')
+    catalog = write_catalog(path, 25)
+    catalog.manifest.checkpoint_interval = 10
+    manifest_size = os.path.getsize(catalog.manifest.manifest_path)
+    for index in range(25, 29):
+        catalog.write_record({'_index': index, 'user/angle': float(index)})
+    catalog.commit()
+    # Each record only adds one offset, the header is left alone until a checkpoint
+    assert os.path.getsize(catalog.manifest.offsets_path) == 29 * 8
+    assert os.path.getsize(catalog.manifest.manifest_path) == manifest_size
+    catalog.write_record({'_index': 29, 'user/angle': 29.0})
+    catalog.commit()
+    assert catalog.manifest.contents['lines'] == 30
+    catalog.close()
+
+    metadata = CatalogMetadata(path, read_only=True)
+    assert metadata.is_current()
+    assert metadata.total_length() == os.path.getsize(path)
+    metadata.close()
+    assert read_indexes(path) == list(range(30))
+
+
+def test_legacy_line_lengths_are_migrated(tmp_path):
+    path = str(tmp_path / 'catalog_0.catalog')
+    catalog = write_catalog(path, 12)
+    offsets = list(catalog.manifest.offsets)
+    catalog.close()
+    # Catalogs written before the sidecar kept every line length in the header
+    manifest_path = tmp_path / 'catalog_0.catalog_manifest'
+    contents = json.loads(manifest_path.read_text())
+    for key in ('lines', 'length', 'mtime_ns'):
+        contents.pop(key)
+    contents['line_lengths'] = [end - start for start, end in zip([0] + offsets, offsets)]
+    manifest_path.write_text(json.dumps(contents) + '\n')
+    os.remove(str(tmp_path / 'catalog_0.catalog_offsets'))
+
+    metadata = CatalogMetadata(path, read_only=True)
+    assert list(metadata.offsets) == offsets
+    metadata.close()
+    assert not os.path.exists(str(tmp_path / 'catalog_0.catalog_offsets'))
+
+    catalog = Catalog(path)
+    assert 'line_lengths' not in catalog.manifest.contents
+    catalog.close()
+    assert os.path.getsize(str(tmp_path / 'catalog_0.catalog_offsets')) == 12 * 8
+    assert read_indexes(path) == list(range(12))
+
+
+def test_offsets_that_do_not_match_the_catalog_are_rebuilt(tmp_path):
+    path = str(tmp_path / 'catalog_0.catalog')
+    write_catalog(path, 10).close()
+    offsets_path = str(tmp_path / 'catalog_0.catalog_offsets')
+    # A torn trailing entry, and an offset that was never written
+    with open(offsets_path, 'r+b') as offsets_file:
+        offsets_file.truncate(9 * 8)
+        offsets_file.seek(0, os.SEEK_END)
+        offsets_file.write(struct.pack('<Q', 1 << 20)[:5])
+
+    assert read_indexes(path) == list(range(10))
+    catalog = Catalog(path)
+    assert catalog.lines() == 10
+    catalog.close()
+    assert os.path.getsize(offsets_path) == 10 * 8
+    assert read_indexes(path) == list(range(10))
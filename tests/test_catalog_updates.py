@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from car.catalog_base import Seekable
+from car.datastore import Catalog
+
+
+def write_catalog(path, count):
+    catalog = Catalog(path)
+    for index in range(count):
+        catalog.write_record({'_index': index, 'user/angle': index / 10.0})
+    catalog.close()
+
+
+def test_updates_are_read_back_through_the_patch_log(tmp_path):
+    path = str(tmp_path / 'catalog_0.catalog')
+    write_catalog(path, 10)
+    catalog = Catalog(path)
+    catalog.update_record(3, {'_index': 3, 'user/angle': -1.0})
+    catalog.update_record(3, {'_index': 3, 'user/angle': -2.0})
+    with pytest.raises(IndexError):
+        catalog.update_record(10, {'_index': 10})
+    assert catalog.read_record_at(3)['user/angle'] == -2.0
+    assert catalog.read_record_at(4)['user/angle'] == 0.4
+    assert list(catalog.columns(['user/angle'])['user/angle'][2:5]) == [0.2, -2.0, 0.4]
+    # Few patches compared to the catalog, they are kept in the log
+    catalog.close()
+    assert os.path.exists(str(tmp_path / 'catalog_0.catalog_patches'))
+
+    catalog = Catalog(path, read_only=True)
+    assert catalog.read_record_at(3)['user/angle'] == -2.0
+    with pytest.raises(RuntimeError):
+        catalog.update_record(3, {'_index': 3})
+    catalog.close()
+
+
+def test_compact_applies_the_patches(tmp_path):
+    path = str(tmp_path / 'catalog_0.catalog')
+    write_catalog(path, 10)
+    catalog = Catalog(path)
+    for line in range(5):
+        catalog.update_record(line, {'_index': line, 'user/angle': 1.0})
+    # The log is compacted on close once it holds a patch for a quarter of the lines
+    catalog.close()
+    assert not os.path.exists(str(tmp_path / 'catalog_0.catalog_patches'))
+
+    catalog = Catalog(path, read_only=True)
+    assert [catalog.read_record_at(line)['user/angle'] for line in range(10)] == [1.0] * 5 + [0.5, 0.6, 0.7, 0.8, 0.9]
+    assert catalog.lines() == 10
+    catalog.close()
+
+
+def test_torn_patch_is_ignored(tmp_path):
+    path = str(tmp_path / 'catalog_0.catalog')
+    write_catalog(path, 10)
+    catalog = Catalog(path)
+    catalog.update_record(1, {'_index': 1, 'user/angle': 5.0})
+    catalog.close()
+    with open(str(tmp_path / 'catalog_0.catalog_patches'), 'a') as patches:
+        patches.write('{"line": 2, "rec')
+
+    catalog = Catalog(path, read_only=True)
+    assert catalog.read_record_at(1)['user/angle'] == 5.0
+    assert catalog.read_record_at(2)['user/angle'] == 0.2
+    catalog.close()
+    catalog = Catalog(path)
+    catalog.update_record(2, {'_index': 2, 'user/angle': 6.0})
+    catalog.close()
+    catalog = Catalog(path, read_only=True)
+    assert catalog.read_record_at(2)['user/angle'] == 6.0
+    catalog.close()
+
+
+@pytest.mark.parametrize('count', [100, 20000])
+def test_an_update_does_not_depend_on_the_catalog_size(tmp_path, monkeypatch, count):
+    path = str(tmp_path / 'catalog_0.catalog')
+    write_catalog(path, count)
+    catalog = Catalog(path)
+    catalog.update_record(0, {'_index': 0, 'user/angle': 0.5})
+    catalog.commit()
+    before = os.stat(path)
+    patches_path = str(tmp_path / 'catalog_0.catalog_patches')
+    patches_size = os.path.getsize(patches_path)
+
+    # Neither the catalog nor the patch log are read or rewritten
+    def read(*args, **kwargs):
+        raise AssertionError('file read during an update')
+    monkeypatch.setattr(Seekable, 'read_all', read)
+    monkeypatch.setattr(Seekable, '_read_contents', read)
+    catalog.update_record(count // 2, {'_index': count // 2, 'user/angle': 1.5})
+    catalog.update_record(count // 2 + 1, {'_index': count // 2 + 1, 'user/angle': 2.5})
+    catalog.commit()
+    monkeypatch.undo()
+
+    after = os.stat(path)
+    assert (after.st_size, after.st_mtime_ns, after.st_ino) == (before.st_size, before.st_mtime_ns, before.st_ino)
+    # Only the two patches are appended
+    assert os.path.getsize(patches_path) - patches_size == 2 * len('{"line": %d, "record": {"_index": %d, "user/angle": 1.5}}\n'
+                                   % (count // 2, count // 2))
+    assert catalog.read_record_at(count // 2)['user/angle'] == 1.5
+    catalog.close()
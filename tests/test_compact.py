@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pytest
+
+from car.tub import Tub, TubHandler, compact_tub, convert_tub
+
+INPUTS = ['cam/image_array', 'user/angle']
+TYPES = ['image_array', 'float']
+SHAPE = (4, 4, 3)
+
+
+@pytest.fixture(params=['json', 'binary'])
+def catalog_format(request):
+    return request.param
+
+
+def make_tub(path, catalog_format='json', image_store='files'):
+    # 40 records, 10 to 19 and 35 to 39 deleted
+    tub = Tub(path, inputs=INPUTS, types=TYPES, max_catalog_len=15, catalog_format=catalog_format,
+              image_store=image_store, image_shape=SHAPE, raw_frames_per_file=20)
+    for index in range(40):
+        tub.write_record({'cam/image_array': np.full(SHAPE, index, dtype=np.uint8), 'user/angle': float(index)},
+                         timestamp_ms=index)
+    for index in range(10, 20):
+        tub.delete_record(index)
+    tub.delete_last_n_records(5)
+    tub.close()
+
+
+def check_compacted(path):
+    tub = Tub(path, read_only=True)
+    kept = list(range(10)) + list(range(20, 35))
+    assert len(tub) == 25
+    assert [record['_index'] for record in tub] == list(range(25))
+    arrays = tub.to_arrays(include_images=True)
+    assert list(arrays['user/angle']) == [float(index) for index in kept]
+    images = arrays['cam/image_array'][np.arange(25)]
+    assert [int(image[0, 0, 0]) for image in images] == kept
+    tub.close()
+
+
+@pytest.mark.parametrize('image_store', ['files', 'chunks', 'raw'])
+def test_compact_removes_deleted_records(tmp_path, catalog_format, image_store):
+    path = str(tmp_path / 'tub')
+    make_tub(path, catalog_format, image_store)
+    stats = compact_tub(path)
+    assert stats['removed'] == 15
+    if image_store != 'raw':
+        # Raw frame files are allocated whole, the 25 frames left still take 2 files
+        assert stats['reclaimed_bytes'] > 0
+    check_compacted(path)
+    assert sorted(os.listdir(str(tmp_path))) == ['tub']
+    # Nothing left to remove
+    assert compact_tub(path)['removed'] == 0
+
+
+def test_a_swap_interrupted_by_a_crash_is_finished_on_open(tmp_path, catalog_format):
+    path = str(tmp_path / 'tub')
+    make_tub(path, catalog_format)
+    # Crash between the two renames of the swap
+    convert_tub(path, path + '.compact', compact=True)
+    os.rename(path, path + '.old')
+
+    check_compacted(path)
+    assert sorted(os.listdir(str(tmp_path))) == ['tub']
+
+
+def test_tub_handler_skips_compactions_in_progress(tmp_path):
+    for name in ('tub_1', 'tub_2'):
+        make_tub(str(tmp_path / name))
+    # A partial compaction of tub_1, and a swap of tub_2 interrupted after its first rename
+    os.makedirs(str(tmp_path / 'tub_1.compact'))
+    tub_2 = str(tmp_path / 'tub_2')
+    convert_tub(tub_2, tub_2 + '.compact', compact=True)
+    os.rename(tub_2, tub_2 + '.old')
+
+    handler = TubHandler(str(tmp_path))
+    assert [os.path.basename(path) for path in handler.get_tub_paths()] == ['tub_1', 'tub_2']
+    stats = handler.compact_tubs()
+    assert [s['removed'] for s in stats] == [15, 0]
+    assert sorted(os.listdir(str(tmp_path))) == ['tub_1', 'tub_2']
+    check_compacted(str(tmp_path / 'tub_1'))
+    check_compacted(tub_2)
@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+from car.compressed_catalog import CompressedSeekable, compress_catalog, compressed_path
+from car.datastore import Catalog
+from car.tub import Tub
+
+INPUTS = ['user/angle', 'user/mode']
+TYPES = ['float', 'str']
+
+
+def write_catalog(path, count):
+    catalog = Catalog(path)
+    for index in range(count):
+        catalog.write_record({'_index': index, 'user/angle': index / 10.0, 'user/mode': 'user'})
+    catalog.close()
+
+
+def test_compressed_lines_are_read_by_block(tmp_path):
+    path = str(tmp_path / 'catalog_0.catalog')
+    write_catalog(path, 250)
+    with open(path) as catalog_file:
+        lines = catalog_file.read().splitlines()
+    size = compress_catalog(path, 'zlib', block_len=40)
+    assert not os.path.exists(path)
+    assert not os.path.exists(str(tmp_path / 'catalog_0.catalog_offsets'))
+    assert size == os.path.getsize(str(compressed_path(path)))
+
+    seekable = CompressedSeekable(compressed_path(path), cache_blocks=2)
+    assert seekable.lines() == 250
+    assert seekable.read_all().splitlines() == lines
+    for line in (0, 39, 40, 249, 120, 3):
+        seekable.seek_line_start(line + 1)
+        assert seekable.read_line() == lines[line]
+        # Only the block of the line was decompressed
+        assert line // 40 in seekable.cache
+    assert len(seekable.cache) == 2
+    seekable.seek_line_start(250)
+    assert seekable.read_line() == lines[249]
+    assert seekable.read_line() == ''
+    with pytest.raises(RuntimeError):
+        seekable.write_line('{}')
+    seekable.close()
+
+
+def test_catalogs_read_the_compressed_file(tmp_path):
+    path = str(tmp_path / 'catalog_0.catalog')
+    write_catalog(path, 150)
+    compress_catalog(path, 'zlib')
+    catalog = Catalog(path, read_only=True)
+    assert catalog.compression == 'zlib'
+    assert catalog.lines() == 150
+    assert catalog.read_record_at(123)['user/angle'] == 12.3
+    assert list(catalog.columns(['_index'])['_index']) == list(range(150))
+    catalog.close()
+
+
+def test_updates_of_a_compressed_catalog(tmp_path):
+    path = str(tmp_path / 'catalog_0.catalog')
+    write_catalog(path, 40)
+    compress_catalog(path, 'zlib')
+    catalog = Catalog(path)
+    catalog.update_record(5, {'_index': 5, 'user/angle': -1.0, 'user/mode': 'local'})
+    assert catalog.read_record_at(5)['user/mode'] == 'local'
+    catalog.compact()
+    catalog.close()
+    # Compacting writes the catalog compressed again
+    assert not os.path.exists(path)
+    catalog = Catalog(path, read_only=True)
+    assert catalog.compression == 'zlib'
+    assert [catalog.read_record_at(line)['user/angle'] for line in (4, 5, 6)] == [0.4, -1.0, 0.6]
+    catalog.close()
+
+
+def test_tubs_compress_finished_catalogs(tmp_path):
+    path = str(tmp_path / 'tub')
+    tub = Tub(path, inputs=INPUTS, types=TYPES, max_catalog_len=30, catalog_compression='zlib')
+    for index in range(100):
+        tub.write_record({'user/angle': float(index), 'user/mode': 'user'}, timestamp_ms=index)
+    tub.update_records({10: {'user/mode': 'local'}})
+    tub.close()
+    names = sorted(os.listdir(path))
+    assert [name for name in names if name.endswith('.catalogz')] == \
+        ['catalog_0.catalogz', 'catalog_1.catalogz', 'catalog_2.catalogz']
+    assert 'catalog_3.catalog' in names and 'catalog_0.catalog' not in names
+
+    tub = Tub(path, read_only=True)
+    assert [record['_index'] for record in tub] == list(range(100))
+    assert tub[45]['user/angle'] == 45.0
+    assert list(tub.select(mode='local')) == [10]
+    assert list(tub.to_arrays()['user/angle']) == [float(index) for index in range(100)]
+    tub.close()
+
+    with pytest.raises(ValueError):
+        Tub(str(tmp_path / 'binary'), inputs=INPUTS, types=TYPES, catalog_format='binary',
+            catalog_compression='zlib')
@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+import pytest
+
+from car.images import ChunkImageStore, FileImageStore, LazyImageArray, RawFrameReader, RawImageStore, decode_image, \
+    load_image, open_raw_frames, raw_file_name, raw_written_file_name, read_image_data
+from car.tub import Tub, compact_tub, convert_tub
+
+SHAPE = (4, 4, 3)
+KEY = 'cam/image_array'
+
+
+def frame(value):
+    return np.full(SHAPE, value, dtype=np.uint8)
+
+
+def write_frames(images_path, indexes, frames_per_file=10):
+    store = RawImageStore(images_path, frames_per_file=frames_per_file, image_shape=SHAPE)
+    names = [store.put(index, KEY, frame(index)).result() for index in indexes]
+    store.close()
+    return names
+
+
+def test_raw_frames_round_trip(tmp_path):
+    images_path = str(tmp_path)
+    names = write_frames(images_path, range(25))
+    assert names[12] == '%s:2' % raw_file_name(KEY, 1)
+    reader = RawFrameReader(images_path)
+    frames = reader.read(KEY, range(25))
+    assert [int(image[0, 0, 0]) for image in frames] == list(range(25))
+    # A contiguous range of a frame file is a view of the memory mapped file
+    assert np.shares_memory(reader.read(KEY, range(10, 15)), reader.frames(raw_file_name(KEY, 1)))
+    assert [int(image[0, 0, 0]) for image in reader.read(KEY, [24, 3, 11])] == [24, 3, 11]
+    assert [int(image[0, 0, 0]) for image in reader.read_references([names[7], names[20]])] == [7, 20]
+    reader.close()
+
+
+@pytest.mark.parametrize('indexes', [[25], [29], [30], [-1], [3, 5]])
+def test_reading_a_frame_that_was_not_written_fails(tmp_path, indexes):
+    # Frame 5 failed to be written, 25 to 29 have a slot in the last file but no frame yet
+    write_frames(str(tmp_path), [index for index in range(25) if index != 5])
+    reader = RawFrameReader(str(tmp_path))
+    with pytest.raises(IndexError):
+        reader.read(KEY, indexes)
+    reader.close()
+
+
+def test_frames_are_readable_while_they_are_written(tmp_path):
+    store = RawImageStore(str(tmp_path), frames_per_file=10, image_shape=SHAPE)
+    reader = RawFrameReader(str(tmp_path))
+    for index in range(3):
+        store.put(index, KEY, frame(index))
+    assert reader.read(KEY, [2])[0, 0, 0, 0] == 2
+    with pytest.raises(IndexError):
+        reader.read(KEY, [3])
+    store.put(3, KEY, frame(3))
+    assert reader.read(KEY, [3])[0, 0, 0, 0] == 3
+    store.close()
+    reader.close()
+
+
+def test_frame_files_without_written_slots(tmp_path):
+    # Frame files written before slots were marked count as complete
+    write_frames(str(tmp_path), range(5))
+    os.remove(str(tmp_path / raw_written_file_name(raw_file_name(KEY, 0))))
+    reader = RawFrameReader(str(tmp_path))
+    assert len(reader.read(KEY, range(10))) == 10
+    reader.close()
+
+    write_frames(str(tmp_path), [5])
+    reader = RawFrameReader(str(tmp_path))
+    assert [int(image[0, 0, 0]) for image in reader.read(KEY, range(6))] == list(range(6))
+    reader.close()
+
+
+def test_convert_keeps_raw_frames_per_file(tmp_path):
+    src_path = str(tmp_path / 'src')
+    tub = Tub(src_path, inputs=[KEY], types=['image_array'], image_store='raw', image_shape=SHAPE,
+              raw_frames_per_file=7)
+    for index in range(20):
+        tub.write_record({KEY: frame(index)}, timestamp_ms=index)
+    tub.delete_record(0)
+    tub.close()
+
+    compact_tub(src_path)
+    dst_path = str(tmp_path / 'dst')
+    convert_tub(src_path, dst_path, catalog_format='binary', compact=True, raw_frames_per_file=5)
+    for path, frames_per_file in ((src_path, 7), (dst_path, 5)):
+        images_path = os.path.join(path, Tub.images())
+        assert len(open_raw_frames(images_path, raw_file_name(KEY, 0))) == frames_per_file
+        tub = Tub(path, read_only=True)
+        assert [int(image[0, 0, 0]) for image in tub.load_frames(KEY, range(19))] == list(range(1, 20))
+        with pytest.raises(IndexError):
+            tub.load_frames(KEY, [19])
+        tub.close()
+
+
+def gradient(index):
+    # Lossless formats must give back every pixel
+    return (np.arange(np.prod(SHAPE)).reshape(SHAPE) * 3 + index).astype(np.uint8)
+
+
+@pytest.mark.parametrize('image_format', ['png', 'npy', 'jpg'])
+@pytest.mark.parametrize('store_class', [FileImageStore, ChunkImageStore])
+def test_image_stores_round_trip(tmp_path, store_class, image_format):
+    store = store_class(str(tmp_path), image_format=image_format)
+    names = [store.put(index, KEY, gradient(index), catalog_number=index // 4).result() for index in range(10)]
+    store.close()
+    for index, name in enumerate(names):
+        image = load_image(str(tmp_path), name)
+        assert image.shape == SHAPE
+        if image_format == 'jpg':
+            assert np.abs(image.astype(int) - gradient(index)).mean() < 20
+        else:
+            assert np.array_equal(image, gradient(index))
+        assert np.array_equal(decode_image(read_image_data(str(tmp_path), name)), image)
+    with pytest.raises(ValueError):
+        store_class(str(tmp_path), image_format='gif')
+
+
+def test_chunks_line_up_with_catalogs(tmp_path):
+    path = str(tmp_path / 'tub')
+    tub = Tub(path, inputs=[KEY], types=['image_array'], max_catalog_len=4, image_store='chunks',
+              image_format='png')
+    for index in range(10):
+        tub.write_record({KEY: gradient(index)}, timestamp_ms=index)
+    tub.close()
+    images_path = os.path.join(path, Tub.images())
+    assert sorted(os.listdir(images_path)) == ['chunk_0.frames', 'chunk_1.frames', 'chunk_2.frames']
+
+    tub = Tub(path, read_only=True)
+    assert tub[5][KEY].startswith('chunk_1.frames:')
+    images = tub.to_arrays(include_images=True)[KEY]
+    assert all(np.array_equal(images[index], gradient(index)) for index in range(10))
+    assert np.array_equal(images[[9, 0]], np.stack([gradient(9), gradient(0)]))
+    tub.close()
+
+
+def test_missing_images_are_zero_frames_in_batches(tmp_path):
+    name = FileImageStore(str(tmp_path), image_format='png').put(0, KEY, gradient(1)).result()
+    images = LazyImageArray(str(tmp_path), np.array([name, None], dtype=object))
+    assert images[1] is None
+    batch = images[np.arange(2)]
+    assert np.array_equal(batch[0], gradient(1))
+    assert not batch[1].any()
+
+
+@pytest.mark.parametrize('image_store', ['files', 'chunks'])
+def test_images_encoded_on_workers_keep_record_order(tmp_path, image_store):
+    path = str(tmp_path / 'tub')
+    tub = Tub(path, inputs=[KEY, 'user/angle'], types=['image_array', 'float'], max_catalog_len=8,
+              image_store=image_store, image_format='png', image_workers=3)
+    for index in range(30):
+        tub.write_record({KEY: gradient(index), 'user/angle': float(index)}, timestamp_ms=index)
+        # Records wait for their images, at most 2 per worker
+        assert len(tub.pending) <= 6
+    # Pending records are written before they are read
+    assert list(tub.select(t0=25)) == [25, 26, 27, 28, 29]
+    tub.close()
+
+    tub = Tub(path, read_only=True)
+    arrays = tub.to_arrays(include_images=True)
+    assert list(arrays['_index']) == list(range(30))
+    assert all(np.array_equal(arrays[KEY][index], gradient(index)) for index in range(30))
+    tub.close()
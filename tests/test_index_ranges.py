@@ -0,0 +1,103 @@
+import json
+import os
+import random
+
+import numpy as np
+
+from car.datastore import IndexRanges
+from car.tub import Tub
+
+
+def check(ranges, expected, size=120):
+    assert len(ranges) == len(expected)
+    assert list(ranges) == sorted(expected)
+    assert [index in ranges for index in range(-2, size)] == [index in expected for index in range(-2, size)]
+    kept = [index for index in range(size + len(expected)) if index not in expected]
+    assert [ranges.skip(position) for position in range(size)] == kept[:size]
+    assert list(np.flatnonzero(ranges.mask(10, 90)) + 10) == sorted(index for index in expected if 10 <= index < 90)
+    # Stored ranges are disjoint, sorted and do not touch
+    pairs = ranges.ranges()
+    assert all(start < end for start, end in pairs)
+    assert all(end < next_start for (_, end), (next_start, _) in zip(pairs, pairs[1:]))
+
+
+def test_ranges_merge():
+    ranges = IndexRanges()
+    ranges.add_range(10, 20)
+    ranges.add_range(30, 40)
+    ranges.add(20)
+    ranges.add_range(25, 30)
+    assert ranges.ranges() == [[10, 21], [25, 40]]
+    ranges.add_range(5, 50)
+    assert ranges.ranges() == [[5, 50]]
+    assert len(ranges) == 45
+    ranges.add_range(60, 60)
+    assert ranges.ranges() == [[5, 50]]
+    assert repr(IndexRanges([[3, 4]])) == 'IndexRanges([[3, 4]])'
+
+
+def test_ranges_match_a_set():
+    generator = random.Random(7)
+    ranges = IndexRanges()
+    expected = set()
+    for _ in range(200):
+        operation = generator.random()
+        start = generator.randrange(100)
+        if operation < 0.4:
+            ranges.add(start)
+            expected.add(start)
+        elif operation < 0.8:
+            end = start + generator.randrange(8)
+            ranges.add_range(start, end)
+            expected.update(range(start, end))
+        else:
+            mask = [generator.random() < 0.3 for _ in range(10)]
+            ranges.add_mask(start, mask)
+            expected.update(start + i for i, value in enumerate(mask) if value)
+        check(ranges, expected)
+
+
+def test_ranges_from_indexes():
+    indexes = [9, 3, 4, 5, 20, 8]
+    ranges = IndexRanges.from_indexes(indexes)
+    assert ranges.ranges() == [[3, 6], [8, 10], [20, 21]]
+    check(ranges, set(indexes))
+    copy = IndexRanges(ranges.ranges())
+    assert copy.ranges() == ranges.ranges()
+    updated = IndexRanges()
+    updated.update(range(3, 6))
+    updated.update([8, 9, 20])
+    assert updated.ranges() == ranges.ranges()
+
+
+def test_empty_ranges():
+    ranges = IndexRanges()
+    check(ranges, set())
+    assert ranges.skip(5) == 5
+    assert ranges.mask(5, 3).shape == (0,)
+
+
+def test_manifests_with_a_list_of_deleted_indexes(tmp_path):
+    path = str(tmp_path / 'tub')
+    tub = Tub(path, inputs=['user/angle'], types=['float'])
+    for index in range(10):
+        tub.write_record({'user/angle': float(index)}, timestamp_ms=index)
+    tub.close()
+    # Written before deleted indexes were stored as ranges
+    manifest_path = os.path.join(path, 'manifest.json')
+    with open(manifest_path) as manifest_file:
+        lines = manifest_file.read().splitlines()
+    catalog_metadata = json.loads(lines[4])
+    del catalog_metadata['deleted_ranges']
+    catalog_metadata['deleted_indexes'] = [7, 2, 3]
+    lines[4] = json.dumps(catalog_metadata)
+    with open(manifest_path, 'w') as manifest_file:
+        manifest_file.write('\n'.join(lines) + '\n')
+
+    tub = Tub(path, inputs=['user/angle'], types=['float'])
+    assert [record['_index'] for record in tub] == [0, 1, 4, 5, 6, 8, 9]
+    tub.delete_record(8)
+    tub.close()
+    tub = Tub(path, read_only=True)
+    assert tub.manifest.deleted_indexes.ranges() == [[2, 4], [7, 9]]
+    tub.close()
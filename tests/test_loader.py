@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pytest
+
+from car.loader import TubLoader
+from car.tub import Tub
+
+SHAPE = (4, 4, 3)
+KEY = 'cam/image_array'
+
+
+@pytest.fixture
+def tub_paths(tmp_path):
+    # Two tubs of 45 and 30 records, the angle identifies the record and its image
+    paths = list()
+    for number, count in enumerate((45, 30)):
+        path = str(tmp_path / ('tub_%d' % number))
+        tub = Tub(path, inputs=[KEY, 'user/angle'], types=['image_array', 'float'], image_format='png')
+        for index in range(count):
+            value = number * 100 + index
+            tub.write_record({KEY: np.full(SHAPE, value % 256, dtype=np.uint8), 'user/angle': float(value)},
+                             timestamp_ms=index)
+        # A record whose image was not written is skipped
+        tub.write_record({'user/angle': -1.0})
+        tub.delete_record(3)
+        tub.close()
+        paths.append(path)
+    return paths
+
+
+EXPECTED = sorted([float(index) for index in range(45) if index != 3] +
+                  [float(100 + index) for index in range(30) if index != 3])
+
+
+def read_epoch(loader, epoch):
+    batches = list(loader.batches(epoch))
+    for batch in batches:
+        # Images follow their records
+        assert np.array_equal(batch[KEY][:, 0, 0, 0], (batch['user/angle'] % 256).astype(np.uint8))
+    return batches
+
+
+def angles(batches):
+    return [float(value) for batch in batches for value in batch['user/angle']]
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_every_record_once_per_epoch(tub_paths, workers):
+    loader = TubLoader(tub_paths, keys=[KEY, 'user/angle'], batch_size=16, workers=workers,
+                       shuffle_buffer=10, block_len=8, seed=3)
+    first = read_epoch(loader, 0)
+    assert sorted(angles(first)) == EXPECTED
+    assert all(len(batch['user/angle']) <= 16 for batch in first)
+    assert first[0][KEY].shape[1:] == SHAPE
+    # The same epoch gives the same batches, another epoch is shuffled differently
+    assert angles(read_epoch(loader, 0)) == angles(first)
+    second = read_epoch(loader, 1)
+    assert sorted(angles(second)) == EXPECTED
+    assert angles(second) != angles(first)
+
+
+def test_drop_last(tub_paths):
+    loader = TubLoader(tub_paths, keys=['user/angle'], batch_size=16, drop_last=True)
+    batches = list(loader)
+    assert len(batches) == len(loader) == len(EXPECTED) // 16
+    assert all(len(batch['user/angle']) == 16 for batch in batches)
+    assert loader.epoch == 1
+
+
+def test_stopping_early_releases_shared_memory(tub_paths):
+    if not os.path.isdir('/dev/shm'):
+        pytest.skip('Shared memory blocks are not listed')
+    before = set(os.listdir('/dev/shm'))
+    loader = TubLoader(tub_paths, keys=[KEY, 'user/angle'], batch_size=4, workers=2, prefetch=2)
+    batches = loader.batches(0)
+    next(batches)
+    batches.close()
+    assert set(os.listdir('/dev/shm')) - before == set()
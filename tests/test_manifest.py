@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from car.datastore import Manifest
+
+INPUTS = ['user/angle', 'user/mode']
+TYPES = ['float', 'str']
+
+
+def open_manifest(path, read_only=False, journal_limit=1000):
+    return Manifest(path, inputs=INPUTS, types=TYPES, max_len=10, read_only=read_only, journal_limit=journal_limit)
+
+
+def write_records(manifest, start, count):
+    for index in range(start, start + count):
+        manifest.write_record({'_index': index, '_timestamp_ms': index, 'user/angle': float(index),
+                               'user/mode': 'user'})
+
+
+def manifest_lines(path):
+    with open(str(path / 'manifest.json')) as manifest_file:
+        return manifest_file.read().splitlines()
+
+
+def check_manifest(path, count, deleted):
+    manifest = open_manifest(str(path), read_only=True)
+    assert len(manifest.catalog_paths) == (count + 9) // 10
+    assert manifest.current_index == count
+    assert list(manifest.deleted_indexes) == deleted
+    manifest.close()
+
+
+def test_changes_are_journaled_after_the_snapshot(tmp_path):
+    manifest = open_manifest(str(tmp_path))
+    write_records(manifest, 0, 25)
+    manifest.delete_records(3, 6)
+    manifest.delete_record(20)
+    manifest.seekable.commit()
+    lines = manifest_lines(tmp_path)
+    # 4 header lines, the snapshot, then one event per change
+    assert json.loads(lines[4])['current_index'] == 0
+    events = [json.loads(line) for line in lines[5:]]
+    assert [event['event'] for event in events].count('catalog') == 2
+    assert events[-2:] == [{'event': 'delete', 'start': 3, 'end': 6}, {'event': 'delete', 'start': 20, 'end': 21}]
+
+    # Read only manifests replay the journal
+    check_manifest(tmp_path, 25, [3, 4, 5, 20])
+    manifest.close()
+    # Closing compacts the journal into the snapshot
+    lines = manifest_lines(tmp_path)
+    assert len(lines) == 5
+    assert json.loads(lines[4])['deleted_ranges'] == [[3, 6], [20, 21]]
+    check_manifest(tmp_path, 25, [3, 4, 5, 20])
+
+
+def test_journal_is_compacted_at_its_limit(tmp_path):
+    manifest = open_manifest(str(tmp_path), journal_limit=8)
+    for count in range(1, 31):
+        write_records(manifest, count - 1, 1)
+        assert len(manifest_lines(tmp_path)) <= 5 + 8
+        assert manifest.journal_length <= 8
+    manifest.seekable.commit()
+    check_manifest(tmp_path, 30, [])
+    manifest.close()
+
+
+@pytest.mark.parametrize('torn', ['{"event": "app', '{"event": "append", "index": 1'])
+def test_torn_journal_event_is_ignored(tmp_path, torn):
+    manifest = open_manifest(str(tmp_path))
+    write_records(manifest, 0, 12)
+    manifest.delete_record(4)
+    manifest.seekable.commit()
+    # Crashes while appending an event
+    with open(str(tmp_path / 'manifest.json'), 'a') as manifest_file:
+        manifest_file.write(torn)
+    check_manifest(tmp_path, 12, [4])
+
+    # Writable manifests start from a clean snapshot
+    manifest = open_manifest(str(tmp_path))
+    assert manifest.journal_length == 0
+    assert len(manifest_lines(tmp_path)) == 5
+    write_records(manifest, 12, 3)
+    manifest.close()
+    check_manifest(tmp_path, 15, [4])
@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+import pytest
+
+from car.tub import Tub, merge_tubs, split_tub
+
+INPUTS = ['cam/image_array', 'user/angle']
+TYPES = ['image_array', 'float']
+SHAPE = (4, 4, 3)
+
+
+def open_tub(path, catalog_format='json', image_store='files'):
+    return Tub(path, inputs=INPUTS, types=TYPES, max_catalog_len=30, catalog_format=catalog_format,
+               image_store=image_store, image_shape=SHAPE, raw_frames_per_file=20)
+
+
+def write_records(tub, values, start_ms=0):
+    # Each image is filled with its value, and so is the angle
+    for number, value in enumerate(values):
+        tub.write_record({'cam/image_array': np.full(SHAPE, value, dtype=np.uint8), 'user/angle': float(value)},
+                         timestamp_ms=start_ms + number)
+
+
+def image_values(tub):
+    arrays = tub.to_arrays(include_images=True)
+    images = arrays['cam/image_array'][np.arange(len(arrays['_index']))]
+    return [int(image[0, 0, 0]) for image in images]
+
+
+@pytest.fixture(params=['json', 'binary'])
+def catalog_format(request):
+    return request.param
+
+
+@pytest.fixture(params=['files', 'chunks', 'raw'])
+def image_store(request):
+    return request.param
+
+
+def make_tubs(tmp_path, catalog_format, image_store):
+    paths = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    for number, path in enumerate(paths):
+        tub = open_tub(path, catalog_format, image_store)
+        write_records(tub, range(number * 50, number * 50 + 35))
+        tub.close()
+    return paths
+
+
+def test_merge_renumbers_records(tmp_path, catalog_format, image_store):
+    paths = make_tubs(tmp_path, catalog_format, image_store)
+    merged_path = str(tmp_path / 'merged')
+    assert merge_tubs(paths, merged_path) == 70
+
+    tub = Tub(merged_path, read_only=True)
+    assert len(tub) == 70
+    assert [record['_index'] for record in tub] == list(range(70))
+    assert tub[35]['user/angle'] == 50.0
+    assert image_values(tub) == list(range(35)) + list(range(50, 85))
+    tub.close()
+
+
+def test_records_written_after_a_merge_stay_out_of_it(tmp_path, catalog_format, image_store):
+    paths = make_tubs(tmp_path, catalog_format, image_store)
+    merged_path = str(tmp_path / 'merged')
+    merge_tubs(paths, merged_path)
+
+    # The last catalog and image file of the source are still written to
+    source = open_tub(paths[1], catalog_format, image_store)
+    write_records(source, [200] * 5)
+    source.close()
+    merged = open_tub(merged_path, catalog_format, image_store)
+    write_records(merged, [99])
+    merged.close()
+
+    tub = Tub(merged_path, read_only=True)
+    assert len(tub) == 71
+    assert [record['_index'] for record in tub] == list(range(71))
+    arrays = tub.to_arrays()
+    assert list(arrays['_index']) == list(range(71))
+    assert list(arrays['user/angle'][-2:]) == [84.0, 99.0]
+    assert image_values(tub)[-2:] == [84, 99]
+    tub.close()
+
+    tub = Tub(paths[1], read_only=True)
+    assert len(tub) == 40
+    assert image_values(tub) == list(range(50, 85)) + [200] * 5
+    tub.close()
+
+
+def test_split_keeps_a_time_range(tmp_path, catalog_format, image_store):
+    source_path = str(tmp_path / 'source')
+    tub = open_tub(source_path, catalog_format, image_store)
+    write_records(tub, range(90), start_ms=1000)
+    tub.close()
+
+    split_path = str(tmp_path / 'split')
+    assert split_tub(source_path, split_path, start_ms=1040, end_ms=1050) == 10
+    tub = open_tub(split_path, catalog_format, image_store)
+    assert image_values(tub) == list(range(40, 50))
+    # Record indexes of the split tub overlap the source's, its own images must not replace the source's
+    write_records(tub, [250] * 3)
+    tub.close()
+
+    tub = Tub(source_path, read_only=True)
+    assert image_values(tub) == list(range(90))
+    tub.close()
+    tub = Tub(split_path, read_only=True)
+    assert image_values(tub) == list(range(40, 50)) + [250] * 3
+    tub.close()
+
+
+def test_merge_refuses_an_existing_tub(tmp_path):
+    paths = make_tubs(tmp_path, 'json', 'files')
+    with pytest.raises(ValueError):
+        merge_tubs(paths, paths[0])
+    assert os.path.exists(os.path.join(paths[0], 'manifest.json'))
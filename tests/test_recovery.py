@@ -0,0 +1,184 @@
+import json
+import os
+
+import pytest
+
+from car import catalog_base
+from car.catalog_base import CommitPolicy, Seekable
+from car.datastore import Catalog
+from car.tub import Tub
+
+INPUTS = ['user/angle', 'user/mode']
+TYPES = ['float', 'str']
+
+
+def open_tub(path, catalog_format='json', read_only=False, commit_policy=None):
+    return Tub(path, inputs=INPUTS, types=TYPES, max_catalog_len=10, catalog_format=catalog_format,
+               read_only=read_only, commit_policy=commit_policy)
+
+
+def write_records(tub, start, count):
+    for index in range(start, start + count):
+        tub.write_record({'user/angle': float(index), 'user/mode': 'user'}, timestamp_ms=index)
+
+
+def check_records(path, count, catalog_format='json'):
+    tub = open_tub(path, catalog_format, read_only=True)
+    assert len(tub) == count
+    assert [record['_index'] for record in tub] == list(range(count))
+    assert [record['user/angle'] for record in tub] == [float(index) for index in range(count)]
+    tub.close()
+
+
+@pytest.fixture(params=['json', 'binary'])
+def catalog_format(request):
+    return request.param
+
+
+def last_catalog(path, catalog_format):
+    extension = '.catalog' if catalog_format == 'json' else '.bincatalog'
+    names = [name for name in os.listdir(path) if name.endswith(extension)]
+    return os.path.join(path, max(names, key=lambda name: int(name.split('_')[1].split('.')[0])))
+
+
+def test_records_survive_a_crash(tmp_path, catalog_format):
+    # Every write is flushed with the default policy, the tub is never closed
+    path = str(tmp_path / 'tub')
+    tub = open_tub(path, catalog_format)
+    write_records(tub, 0, 25)
+
+    check_records(path, 25, catalog_format)
+    tub = open_tub(path, catalog_format)
+    write_records(tub, 25, 5)
+    tub.close()
+    check_records(path, 30, catalog_format)
+
+
+def test_torn_record_is_dropped(tmp_path, catalog_format):
+    path = str(tmp_path / 'tub')
+    tub = open_tub(path, catalog_format)
+    write_records(tub, 0, 15)
+    tub.close()
+    with open(last_catalog(path, catalog_format), 'ab') as catalog_file:
+        catalog_file.write(b'{"_index": 15, "user/an')
+
+    tub = open_tub(path, catalog_format)
+    assert len(tub) == 15
+    write_records(tub, 15, 3)
+    tub.close()
+    check_records(path, 18, catalog_format)
+
+
+def test_record_missing_from_the_journal_is_recovered(tmp_path):
+    # The catalog was written, but the manifest journal event was lost
+    path = str(tmp_path / 'tub')
+    tub = open_tub(path)
+    write_records(tub, 0, 15)
+    tub.close()
+    record = {'_index': 15, '_timestamp_ms': 15, 'user/angle': 15.0, 'user/mode': 'user'}
+    with open(last_catalog(path, 'json'), 'a') as catalog_file:
+        catalog_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    tub = open_tub(path)
+    assert len(tub) == 16
+    write_records(tub, 16, 2)
+    tub.close()
+    check_records(path, 18)
+
+
+def test_record_missing_from_the_catalog_is_dropped(tmp_path, catalog_format):
+    # The journal event was written, but the record did not reach the catalog
+    path = str(tmp_path / 'tub')
+    tub = open_tub(path, catalog_format)
+    write_records(tub, 0, 15)
+    tub.close()
+    catalog_path = last_catalog(path, catalog_format)
+    size = os.path.getsize(catalog_path)
+    with open(catalog_path, 'r+b') as catalog_file:
+        if catalog_format == 'json':
+            contents = catalog_file.read()
+            size = contents.rstrip(b'\n').rfind(b'\n') + 1
+        else:
+            size -= size // 5
+        catalog_file.truncate(size)
+
+    tub = open_tub(path, catalog_format)
+    assert len(tub) == 14
+    write_records(tub, 14, 2)
+    tub.close()
+    check_records(path, 16, catalog_format)
+
+
+def test_torn_journal_event_is_ignored(tmp_path):
+    path = str(tmp_path / 'tub')
+    tub = open_tub(path)
+    write_records(tub, 0, 5)
+    tub.delete_record(2)
+    tub.close()
+    with open(os.path.join(path, 'manifest.json'), 'a') as manifest_file:
+        manifest_file.write('{"event": "delete", "sta')
+
+    tub = open_tub(path, read_only=True)
+    assert len(tub) == 4
+    tub.close()
+    tub = open_tub(path)
+    assert len(tub) == 4
+    tub.delete_record(3)
+    tub.close()
+    tub = open_tub(path, read_only=True)
+    assert [record['_index'] for record in tub] == [0, 1, 4]
+    tub.close()
+
+
+def test_stale_line_offsets_are_rebuilt(tmp_path):
+    path = str(tmp_path / 'catalog_0.catalog')
+    catalog = Catalog(path)
+    for index in range(20):
+        catalog.write_record({'_index': index})
+    catalog.close()
+    # A torn offsets entry, and offsets that lag behind the catalog
+    offsets_path = str(tmp_path / 'catalog_0.catalog_offsets')
+    with open(offsets_path, 'r+b') as offsets_file:
+        offsets_file.truncate(os.path.getsize(offsets_path) - 8 * 5 - 3)
+
+    catalog = Catalog(path)
+    assert catalog.lines() == 20
+    assert catalog.read_record_at(19) == {'_index': 19}
+    catalog.write_record({'_index': 20})
+    catalog.close()
+    assert os.path.getsize(offsets_path) == 8 * 21
+    catalog = Catalog(path, read_only=True)
+    assert [catalog.read_record_at(line)['_index'] for line in range(21)] == list(range(21))
+    catalog.close()
+
+
+def test_commit_policy_batches_fsyncs(tmp_path, monkeypatch):
+    fsyncs = list()
+    monkeypatch.setattr(catalog_base.os, 'fsync', fsyncs.append)
+    seekable = Seekable(str(tmp_path / 'lines'), commit_policy=CommitPolicy('fsync', batch_size=3))
+    for line in range(7):
+        seekable.write_line('line %d' % line)
+    assert len(fsyncs) == 2
+    seekable.commit()
+    assert len(fsyncs) == 3
+    seekable.commit()
+    assert len(fsyncs) == 3
+    seekable.close()
+
+    with pytest.raises(ValueError):
+        CommitPolicy('sometimes')
+    policy = CommitPolicy('none', batch_size=1)
+    assert not policy.is_due(10, 0)
+    policy = CommitPolicy('flush', batch_size=100, batch_interval_ms=0)
+    assert policy.is_due(1, 0)
+
+
+def test_batched_records_are_committed_on_close(tmp_path, catalog_format):
+    path = str(tmp_path / 'tub')
+    tub = open_tub(path, catalog_format, commit_policy=CommitPolicy('flush', batch_size=1000))
+    write_records(tub, 0, 25)
+    tub.commit()
+    check_records(path, 25, catalog_format)
+    write_records(tub, 25, 5)
+    tub.close()
+    check_records(path, 30, catalog_format)
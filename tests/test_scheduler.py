@@ -0,0 +1,203 @@
+import pytest
+
+from car import scheduler
+from car.scheduler import LoopScheduler
+from car.vehicle import Vehicle
+
+PERIOD_NS = 10 * 1000 * 1000
+
+
+class FakeClock(object):
+    """
+    Stands in for the `time` module of the scheduler, time only moves when a part
+    runs or the scheduler sleeps.
+    """
+
+    def __init__(self):
+        self.now_ns = 0
+
+    def perf_counter_ns(self):
+        return self.now_ns
+
+    def sleep(self, seconds):
+        self.now_ns += int(seconds * 1e9)
+
+
+class ClockPart(object):
+    # Takes 3 ms per loop, and `overrun_ms` on loop `overrun_loop`
+    def __init__(self, clock, overrun_loop, overrun_ms):
+        self.clock = clock
+        self.overrun_loop = overrun_loop
+        self.overrun_ms = overrun_ms
+        self.loops = 0
+
+    def run(self):
+        duration_ms = self.overrun_ms if self.loops == self.overrun_loop else 3
+        self.clock.now_ns += duration_ms * 1000 * 1000
+        self.loops += 1
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler, 'time', clock)
+    return clock
+
+
+def run_vehicle(clock, overrun_policy, loops=20, overrun_loop=5, overrun_ms=35):
+    vehicle = Vehicle()
+    vehicle.add(ClockPart(clock, overrun_loop, overrun_ms))
+    vehicle.start(rate_hz=100, max_loop_count=loops, overrun_policy=overrun_policy)
+    return vehicle.scheduler.stats()
+
+
+def test_skip_drops_missed_loops(clock):
+    # Loop 5 starts at 50 ms and ends at 85 ms, 25 ms after its 60 ms deadline:
+    # the 60, 70 and 80 ms loops are skipped and the next loop starts at 90 ms.
+    stats = run_vehicle(clock, 'skip')
+    assert stats['overruns'] == 1
+    assert stats['skipped'] == 3
+    assert stats['loops'] == 20
+
+
+def test_catch_up_runs_missed_loops(clock):
+    # Loops 6, 7 and 8 run back to back from 85 ms, and end after their deadlines
+    # (70, 80 and 90 ms). Loop 9 ends at 97 ms and is back on time.
+    stats = run_vehicle(clock, 'catch_up')
+    assert stats['overruns'] == 4
+    assert stats['skipped'] == 0
+    assert stats['loops'] == 20
+
+
+def test_degrade_restarts_from_the_overrun(clock):
+    stats = run_vehicle(clock, 'degrade')
+    assert stats['overruns'] == 1
+    assert stats['skipped'] == 0
+
+
+def test_no_overruns_on_time(clock):
+    stats = run_vehicle(clock, 'skip', overrun_ms=3)
+    assert stats['overruns'] == 0
+    assert stats['skipped'] == 0
+    assert stats['jitter_max_us'] == 0.0
+
+
+def test_skip_counts_every_missed_deadline(clock):
+    loop = LoopScheduler(100, overrun_policy='skip')
+    loop.start()
+    # The loop started at 0 ends at 45 ms, the 10, 20, 30 and 40 ms loops are skipped
+    clock.now_ns += 4 * PERIOD_NS + PERIOD_NS // 2
+    loop.wait()
+    assert loop.overruns == 1
+    assert loop.skipped == 4
+    assert clock.now_ns == 5 * PERIOD_NS
+
+
+def test_catch_up_is_bounded_after_a_stall(clock):
+    # The loop started at 0 ends at 1005 ms, 100 deadlines are missed: the loops of the
+    # 980, 990 and 1000 ms deadlines run back to back, the older ones are skipped.
+    loop = LoopScheduler(100, overrun_policy='catch_up', max_catch_up=3)
+    loop.start()
+    clock.now_ns += 100 * PERIOD_NS + PERIOD_NS // 2
+    starts = list()
+    for _ in range(4):
+        loop.wait()
+        starts.append(clock.now_ns)
+    assert loop.skipped == 97
+    assert loop.overruns == 3
+    assert starts == [100 * PERIOD_NS + PERIOD_NS // 2] * 3 + [101 * PERIOD_NS]
+
+
+def test_catch_up_without_missed_loops_skips(clock):
+    loop = LoopScheduler(100, overrun_policy='catch_up', max_catch_up=0)
+    loop.start()
+    clock.now_ns += 4 * PERIOD_NS + PERIOD_NS // 2
+    loop.wait()
+    assert loop.skipped == 4
+    assert clock.now_ns == 5 * PERIOD_NS
+
+
+class LateClock(FakeClock):
+    """
+    Wakes up from each sleep late by the next of `latencies_us`, like the OS does. Reading
+    the clock takes `read_us`, so busy waits end.
+    """
+
+    def __init__(self, latencies_us, read_us=0):
+        super(LateClock, self).__init__()
+        self.latencies_us = list(latencies_us)
+        self.read_us = read_us
+
+    def perf_counter_ns(self):
+        self.now_ns += self.read_us * 1000
+        return self.now_ns
+
+    def sleep(self, seconds):
+        latency_us = self.latencies_us.pop(0) if self.latencies_us else 0
+        self.now_ns += int(seconds * 1e9) + latency_us * 1000
+
+
+def run_loops(clock, loops, spin_ms=0):
+    loop = LoopScheduler(100, spin_ms=spin_ms)
+    loop.start()
+    for _ in range(loops):
+        # Each loop takes 3 ms
+        clock.now_ns += 3 * 1000 * 1000
+        loop.wait()
+    return loop.stats()
+
+
+def test_jitter_percentiles(monkeypatch):
+    # Loops start 100 us late, and 2 of them 4 ms late (preempted for a time slice)
+    latencies_us = [100] * 100
+    latencies_us[30] = latencies_us[70] = 4000
+    clock = LateClock(latencies_us)
+    monkeypatch.setattr(scheduler, 'time', clock)
+    stats = run_loops(clock, 100)
+    assert stats['loops'] == 100
+    assert stats['overruns'] == 0
+    assert stats['jitter_p50_us'] == 100.0
+    assert stats['jitter_p90_us'] == 100.0
+    assert stats['jitter_p99_us'] == 4000.0
+    assert stats['jitter_max_us'] == 4000.0
+    assert stats['rate_hz'] == pytest.approx(100, rel=0.01)
+
+
+def test_jitter_history_keeps_the_last_loops(monkeypatch):
+    clock = LateClock([4000] * 10 + [100] * 20)
+    monkeypatch.setattr(scheduler, 'time', clock)
+    loop = LoopScheduler(100, history=20)
+    loop.start()
+    for _ in range(30):
+        clock.now_ns += 3 * 1000 * 1000
+        loop.wait()
+    assert loop.stats()['jitter_max_us'] == 100.0
+
+
+def test_spinning_absorbs_the_wake_up_latency(monkeypatch):
+    # Sleeps end 1 ms late, spinning for the last 2 ms of each period starts loops on time,
+    # give or take one read of the clock
+    clock = LateClock([1000] * 50, read_us=5)
+    monkeypatch.setattr(scheduler, 'time', clock)
+    stats = run_loops(clock, 50, spin_ms=2)
+    assert stats['jitter_max_us'] <= 5.0
+
+    clock = LateClock([1000] * 50, read_us=5)
+    monkeypatch.setattr(scheduler, 'time', clock)
+    stats = run_loops(clock, 50)
+    assert stats['jitter_p50_us'] >= 1000.0
+
+
+def test_max_loop_count_counts_base_rate_loops(clock):
+    # A 100 Hz part runs the drive loop at 100 Hz, base parts every 3 ticks (33.3 Hz)
+    vehicle = Vehicle()
+    base = ClockPart(clock, overrun_loop=None, overrun_ms=0)
+    fast = ClockPart(clock, overrun_loop=None, overrun_ms=0)
+    vehicle.add(base)
+    vehicle.add(fast, rate_hz=100)
+    vehicle.start(rate_hz=30, max_loop_count=10)
+    assert vehicle.scheduler.stats()['loops'] == 30
+    assert base.loops == 11
+    rates = vehicle.part_rates()['ClockPart']
+    assert rates['requested_hz'] == 30
+    assert rates['rate_hz'] == pytest.approx(100 / 3)
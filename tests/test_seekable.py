@@ -0,0 +1,60 @@
+import mmap
+
+import pytest
+
+from car.catalog_base import Seekable, _line_offsets
+
+
+@pytest.mark.parametrize('block_size', [1, 3, 7, 1 << 24])
+def test_line_offsets_across_blocks(block_size):
+    contents = b'ab\n\ncdef\ng\nlast'
+    offsets = _line_offsets(contents, len(contents), block_size=block_size)
+    assert list(offsets) == [3, 4, 9, 11, 15]
+    contents = b'ab\ncd\n'
+    assert list(_line_offsets(contents, len(contents), block_size=block_size)) == [3, 6]
+
+
+def test_offsets_are_rebuilt_from_the_file(tmp_path):
+    path = str(tmp_path / 'lines')
+    seekable = Seekable(path)
+    lines = ['line %d' % number + 'x' * (number % 7) for number in range(100)]
+    lengths = [seekable.write_line(line) for line in lines]
+    offsets = list(seekable.offsets)
+    seekable.close()
+    assert seekable.offsets.typecode == 'Q'
+    assert lengths == [len(line) + 1 for line in lines]
+
+    for read_only in (True, False):
+        seekable = Seekable(path, read_only=read_only)
+        assert isinstance(seekable.file, mmap.mmap) == read_only
+        assert list(seekable.offsets) == offsets
+        assert seekable.lines() == 100
+        for number in (1, 50, 100, 37):
+            seekable.seek_line_start(number)
+            assert seekable.read_line() == lines[number - 1]
+            assert seekable.line_length(number) == lengths[number - 1]
+        seekable.close()
+
+
+def test_given_offsets_are_checked_against_the_file(tmp_path):
+    path = str(tmp_path / 'lines')
+    seekable = Seekable(path)
+    for number in range(10):
+        seekable.write_line('%d' % number)
+    offsets = list(seekable.offsets)
+    seekable.close()
+
+    # Offsets that match the file are used as they are
+    seekable = Seekable(path, read_only=True, line_offsets=offsets)
+    assert list(seekable.offsets) == offsets
+    seekable.close()
+    seekable = Seekable(path, line_offsets=offsets[:-2])
+    assert list(seekable.offsets) == offsets
+    seekable.truncate_until_end(8)
+    seekable.write_line('last')
+    seekable.close()
+    seekable = Seekable(path, read_only=True)
+    seekable.seek_line_start(9)
+    assert [seekable.read_line(), seekable.read_line()] == ['last', '']
+    assert seekable.lines() == 9
+    seekable.close()
@@ -0,0 +1,135 @@
+import os
+
+import pytest
+
+from car.catalog_base import CatalogMetadata
+from car.catalog_index import CatalogIndex
+from car.tub import Tub
+
+INPUTS = ['user/angle', 'user/mode']
+TYPES = ['float', 'str']
+
+
+def open_tub(path, catalog_format='json', read_only=False):
+    return Tub(path, inputs=INPUTS, types=TYPES, max_catalog_len=50, catalog_format=catalog_format,
+               read_only=read_only)
+
+
+@pytest.fixture(params=['json', 'binary'])
+def catalog_format(request):
+    return request.param
+
+
+@pytest.fixture
+def tub_path(tmp_path, catalog_format):
+    # 120 records in 3 catalogs, every 10th record is driven by the pilot
+    path = str(tmp_path / 'tub')
+    tub = open_tub(path, catalog_format)
+    for index in range(120):
+        tub.write_record({'user/angle': index / 100.0, 'user/mode': 'local' if index % 10 == 0 else 'user'},
+                         timestamp_ms=1000 + index)
+    tub.close()
+    return path
+
+
+def test_select_by_time_and_mode(tub_path, catalog_format):
+    tub = open_tub(tub_path, catalog_format)
+    assert list(tub.select(t0=1045, t1=1055)) == list(range(45, 55))
+    assert list(tub.select(mode='local')) == list(range(0, 120, 10))
+    assert list(tub.select(mode=['local'], t0=1050)) == list(range(50, 120, 10))
+    with pytest.raises(ValueError):
+        tub.select(values={'user/angle': 0.1})
+    tub.delete_record(60)
+    assert list(tub.select(mode='local', t0=1050, t1=1080)) == [50, 70]
+    tub.close()
+
+
+def test_stats_of_each_catalog(tub_path, catalog_format):
+    tub = open_tub(tub_path, catalog_format, read_only=True)
+    stats = tub.stats()
+    assert [s['records'] for s in stats] == [50, 50, 20]
+    assert stats[1]['timestamps'] == [1050, 1099]
+    assert stats[1]['values']['user/mode'] == {'local': 5, 'user': 45}
+    angle = stats[2]['inputs']['user/angle']
+    assert angle['count'] == 20
+    assert angle['min'] == pytest.approx(1.0)
+    assert angle['max'] == pytest.approx(1.19)
+    assert angle['mean'] == pytest.approx(1.095)
+    tub.close()
+
+
+def test_updates_change_indexes_and_stats(tub_path, catalog_format, monkeypatch):
+    tub = open_tub(tub_path, catalog_format)
+    tub.select(mode='local')
+
+    # Updates change the indexes in place, catalogs are not read again to rebuild them
+    def from_columns(*args, **kwargs):
+        raise AssertionError('index rebuilt from the catalog')
+    monkeypatch.setattr(CatalogIndex, 'from_columns', from_columns)
+    tub.update_records({11: {'user/mode': 'local'}, 20: {'user/mode': 'user'},
+                        12: {'user/angle': 2.0}, 110: {'user/mode': 'local', 'user/angle': -1.0}})
+    assert list(tub.select(mode='local', t1=1050)) == [0, 10, 11, 30, 40]
+    assert list(tub.select(mode='local', t0=1100)) == [100, 110]
+    stats = tub.stats()
+    assert stats[0]['values']['user/mode'] == {'local': 5, 'user': 45}
+    assert stats[0]['inputs']['user/angle']['max'] == pytest.approx(2.0)
+    assert stats[2]['inputs']['user/angle']['min'] == pytest.approx(-1.0)
+    assert stats[2]['inputs']['user/angle']['mean'] == pytest.approx((sum(range(100, 120)) / 100.0 - 2.1) / 20)
+    tub.close()
+    monkeypatch.undo()
+
+    # The indexes and statistics of finished catalogs are saved with the updates
+    tub = open_tub(tub_path, catalog_format, read_only=True)
+    assert list(tub.select(mode='local', t1=1050)) == [0, 10, 11, 30, 40]
+    assert tub.stats()[0]['inputs']['user/angle']['max'] == pytest.approx(2.0)
+    assert tub[12]['user/angle'] == pytest.approx(2.0)
+    tub.close()
+
+
+def test_index_update_keeps_min_and_max_as_bounds():
+    index = CatalogIndex(['user/mode'], ['user/angle'])
+    records = [{'_timestamp_ms': t, 'user/mode': 'user', 'user/angle': float(t)} for t in range(4)]
+    for record in records:
+        index.add(record)
+    index.update(3, records[3], dict(records[3], **{'user/angle': 1.0, 'user/mode': 'local'}))
+    index.update(0, records[0], dict(records[0], **{'user/angle': float('nan')}))
+    summary = index.summary()
+    assert summary['values']['user/mode'] == {'user': 3, 'local': 1}
+    assert summary['inputs']['user/angle'] == {'count': 3, 'min': 0.0, 'max': 3.0, 'mean': 4.0 / 3}
+    assert list(index.select(values={'user/mode': 'local'}).nonzero()[0]) == [3]
+
+
+def test_stats_are_read_from_catalog_headers(tub_path, catalog_format, monkeypatch):
+    tub = open_tub(tub_path, catalog_format, read_only=True)
+
+    # Neither finished catalogs nor their indexes are opened
+    def open_catalog(*args, **kwargs):
+        raise AssertionError('catalog opened')
+    monkeypatch.setattr(tub.manifest, '_open_catalog', open_catalog)
+    monkeypatch.setattr(CatalogIndex, 'load', open_catalog)
+    stats = [tub.manifest.catalog_stats(number) for number in range(2)]
+    assert [s['timestamps'] for s in stats] == [[1000, 1049], [1050, 1099]]
+    monkeypatch.undo()
+
+    # Catalogs without a time in [t0, t1) are skipped
+    assert list(tub.select(t0=1010, t1=1030)) == list(range(10, 30))
+    assert 1 not in tub.manifest.catalog_indexes
+    tub.close()
+
+
+def test_stats_of_catalogs_finished_without_them(tub_path, catalog_format):
+    tub = open_tub(tub_path, catalog_format)
+    expected = tub.stats()
+    tub.close()
+    # Finished before statistics were kept
+    for number in range(2):
+        metadata = CatalogMetadata(os.path.join(tub_path, tub.manifest.catalog_paths[number]))
+        metadata.update_contents('stats', None)
+        metadata.close()
+
+    tub = open_tub(tub_path, catalog_format)
+    assert tub.stats() == expected
+    tub.close()
+    metadata = CatalogMetadata(os.path.join(tub_path, tub.manifest.catalog_paths[0]), read_only=True)
+    assert metadata.contents['stats'] == expected[0]
+    metadata.close()
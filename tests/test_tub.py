@@ -0,0 +1,75 @@
+import threading
+
+import numpy as np
+import pytest
+
+from car.tub import Tub
+
+INPUTS = ['user/angle', 'user/mode']
+TYPES = ['float', 'str']
+
+
+@pytest.fixture(params=['json', 'binary'])
+def tub(tmp_path, request):
+    tub = Tub(str(tmp_path / 'tub'), inputs=INPUTS, types=TYPES, max_catalog_len=20, catalog_format=request.param)
+    yield tub
+    tub.close()
+
+
+def write_records(tub, count):
+    for index in range(count):
+        tub.write_record({'user/angle': float(index), 'user/mode': 'user'}, timestamp_ms=index)
+
+
+def test_random_access(tub):
+    write_records(tub, 50)
+    tub.delete_record(3)
+    assert len(tub) == 49
+    assert tub[3]['_index'] == 4
+    assert tub[-1]['user/angle'] == 49.0
+    assert [record['_index'] for record in tub[18:22]] == [19, 20, 21, 22]
+    assert [record['_index'] for record in tub.get_batch([0, 40, 2])] == [0, 41, 2]
+    assert [record['_index'] for record in tub.get_records([21, 5])] == [21, 5]
+    with pytest.raises(IndexError):
+        tub[49]
+
+
+def test_reads_while_a_thread_writes(tub):
+    # Reads see whole records and consistent arrays while catalogs fill up and roll over
+    writer = threading.Thread(target=write_records, args=(tub, 400))
+    writer.start()
+    errors = list()
+    try:
+        while writer.is_alive():
+            arrays = tub.to_arrays()
+            assert len(arrays['user/angle']) == len(arrays['_index'])
+            assert np.array_equal(arrays['_index'], np.arange(len(arrays['_index'])))
+            assert np.array_equal(arrays['user/angle'], arrays['_index'].astype(np.float64))
+            count = len(tub)
+            if count > 0:
+                last = tub[count - 1]
+                assert last['user/angle'] == float(last['_index'])
+                batch = tub.get_batch(list(range(max(0, count - 25), count)))
+                assert [record['_index'] for record in batch] == list(range(max(0, count - 25), count))
+    except Exception as error:
+        errors.append(error)
+    writer.join()
+    assert errors == []
+    assert len(tub) == 400
+
+
+def test_to_arrays(tub):
+    write_records(tub, 50)
+    tub.write_record({'user/mode': 'local'}, timestamp_ms=50)
+    tub.delete_record(3)
+    arrays = tub.to_arrays()
+    assert sorted(arrays) == ['_index', '_timestamp_ms', 'user/angle', 'user/mode']
+    assert list(arrays['_index']) == [index for index in range(51) if index != 3]
+    assert arrays['user/angle'].dtype.kind == 'f'
+    assert np.isnan(arrays['user/angle'][-1])
+    assert list(arrays['user/mode'][-2:]) == ['user', 'local']
+
+    # Catalogs are skipped by their statistics
+    arrays = tub.to_arrays(keys=['_index'], where=lambda stats: stats['timestamps'][1] >= 45)
+    assert list(arrays) == ['_index']
+    assert list(arrays['_index']) == list(range(40, 51))
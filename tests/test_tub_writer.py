@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+from car.tub import RecordQueue, Tub, TubWriter
+
+INPUTS = ['user/angle', 'user/mode']
+TYPES = ['float', 'str']
+
+
+def test_queue_drops_the_newest_record():
+    queue = RecordQueue(2, policy='drop_newest')
+    assert [queue.put(record) for record in range(3)] == [True, True, False]
+    assert queue.dropped == 1
+    assert [queue.get(), queue.get()] == [0, 1]
+
+
+def test_queue_drops_the_oldest_record():
+    queue = RecordQueue(2, policy='drop_oldest')
+    assert [queue.put(record) for record in range(4)] == [True] * 4
+    assert queue.dropped == 2
+    assert [queue.get(), queue.get()] == [2, 3]
+    queue.done()
+    queue.done()
+    # The dropped records count as handled
+    queue.join()
+
+
+def test_queue_blocks_until_the_writer_catches_up():
+    queue = RecordQueue(2)
+    received = list()
+
+    def writer():
+        record = queue.get()
+        while record is not None:
+            received.append(record)
+            queue.done()
+            record = queue.get()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    for record in range(50):
+        assert queue.put(record)
+        assert len(queue) <= 2
+    queue.join()
+    assert received == list(range(50))
+    queue.close()
+    thread.join()
+    assert not queue.put(50)
+    assert queue.get() is None
+    with pytest.raises(ValueError):
+        RecordQueue(2, policy='sometimes')
+
+
+def test_queued_records_are_written_in_order(tmp_path):
+    path = str(tmp_path / 'tub')
+    writer = TubWriter(path, inputs=INPUTS, types=TYPES, max_catalog_len=20, queue_size=8)
+    for index in range(100):
+        writer.run(float(index), 'user')
+    writer.delete_last_n_records(3)
+    writer.run(100.0, 'user')
+    writer.close()
+    assert writer.stats() == {'written': 101, 'queued': 101, 'dropped': 0, 'pending': 0}
+
+    tub = Tub(path, read_only=True)
+    assert [record['user/angle'] for record in tub] == [float(index) for index in range(97)] + [100.0]
+    tub.close()
+
+
+def test_a_stalled_writer_drops_records(tmp_path):
+    path = str(tmp_path / 'tub')
+    writer = TubWriter(path, inputs=INPUTS, types=TYPES, queue_size=4, queue_policy='drop_newest')
+    # The writer thread stalls on the tub lock, the drive loop does not
+    with writer.tub.lock:
+        for index in range(20):
+            writer.run(float(index), 'user')
+        stats = writer.stats()
+    writer.close()
+    assert stats['dropped'] >= 15
+    stats = writer.stats()
+    assert stats['written'] + stats['dropped'] == 20
+
+    tub = Tub(path, read_only=True)
+    assert len(tub) == stats['written']
+    tub.close()